@@ -1,4 +1,5 @@
-import multiprocessing
+import shlex
+import shutil
 import sys
 import time
 
@@ -6,7 +7,7 @@ from utils import *
 
 
 class Action():
-    def __init__(self, name, function, short_desc, desc='', args={}, alias=None):
+    def __init__(self, name, function, short_desc, desc='', args={}, alias=None, timed=True, locked=False):
         # name of the action, used in the CLI to invoke it
         self.name = name
 
@@ -22,22 +23,230 @@ class Action():
         # alias that can also be used in the CLI to invoke the action
         self.alias = alias
 
+        # whether the duration of the action is recorded (see action stats),
+        # actions that only display something aren't worth it
+        self.timed = timed
+
+        # whether the action waits for the other locked actions on the same
+        # pg_venv to be done (see lock_pg_venv)
+        self.locked = locked
+
 
     def execute(self, kwargs):
-        self.function(**kwargs)
+        pg_venv = kwargs.get('pg_venv') or os.environ.get('PG_VENV')
+
+        with contextlib.ExitStack() as stack:
+            if self.locked and pg_venv and pg_virtualenv_exists(pg_venv):
+                stack.enter_context(lock_pg_venv(pg_venv))
+
+            if not self.timed:
+                return self.function(**kwargs)
+
+            # actions are timed for the pg_venv they work on, see action stats
+            with timed(self.name, pg_venv, kind='action') as timing:
+                timing['return_code'] = self.function(**kwargs)
+
+            return timing['return_code']
+
+
+def bench(pg_venvs=None, workload='tpcb-like', scale=1, clients=1, threads=1, duration=60, init=False):
+    '''
+    Run pgbench against some pg_venvs (the current one by default), one after
+    the other, and store the results (see run_pgbench)
+    '''
+    if not pg_venvs:
+        pg_venvs = [get_env_var('PG_VENV')]
+    for pg_venv in pg_venvs:
+        if not pg_virtualenv_exists(pg_venv):
+            log('This virtualenv does not exist: {}'.format(pg_venv), 'error')
+            return 1
+
+    results = []
+    for pg_venv in pg_venvs:
+        result = run_pgbench(pg_venv, workload, scale, clients, threads, duration, init)
+        if result is None:
+            return 1
+        results.append(result)
+
+    print_bench_runs(results)
+
+    return 0
+
+
+def bench_report(pg_venv=None, workload=None, limit=20, as_json=False):
+    '''
+    Show the results of the last benchmark runs, for all the pg_venvs and
+    workloads unless pg_venv or workload is set
+
+    If as_json is True, the results are printed as JSON.
+    '''
+    runs = get_bench_runs(pg_venv, workload, limit)
+
+    if as_json:
+        print(json.dumps(runs, indent=4))
+        return 0
+
+    if not runs:
+        log('No benchmark run recorded, use `pg bench` to run one')
+        return 0
+
+    print_bench_runs(runs)
+
+    return 0
+
+
+def build(make_args=[], pg_venv=None, docs=False, no_install=False, verbose=True, exit_on_fail=False):
+    '''
+    Compile and install postgresql, contrib, and the documentation if docs is
+    True
+
+    With autoconf, everything is done by a single make: all the steps share
+    the same jobserver, contrib is compiled while core is installed, and the
+    documentation alongside everything (see write_build_makefile). The
+    duration of each step is reported.
+    With meson, this is the same as actions make and install.
+
+    Returns true if all commands run returned 0, false otherwise.
+    '''
+    if not pg_venv:
+        pg_venv = get_env_var('PG_VENV')
+
+    if recover_tmpfs(pg_venv, ['build']) != 0:
+        return 1
+
+    return_code, result = run_api(
+        'build_async',
+        {'pg_venv': pg_venv, 'make_args': make_args, 'docs': docs, 'install': not no_install, 'verbose': verbose},
+        'Compiling and installing PostgreSQL' if not no_install else 'Compiling PostgreSQL',
+        verbose,
+        exit_on_fail,
+    )
+    if result is not None and verbose:
+        print_build_result(result)
+
+    return return_code
 
 
-def configure(additional_args=None, pg_venv=None, verbose=True, exit_on_fail=False):
+def ccache_stats(pg_venv):
+    '''
+    Show the compiler cache statistics of a pg_venv, or of all pg_venvs if
+    none is specified
     '''
-    Run `./configure` in pg_venv's copy of postgresql's source
+    pg_venvs = [pg_venv] if pg_venv is not None else available_pg_venvs()
+
+    format_str = '{:<30}{:>8}{:>8}{:>8}{:>10}{:>14}{:>12}'
+    print(format_str.format('PG_VENV', 'BUILDS', 'HITS', 'MISSES', 'HIT RATE', 'LAST BUILD', 'TIME SAVED'))
+    for pg_venv in pg_venvs:
+        builds = get_pg_metadata(pg_venv).get('ccache_builds', [])
+        if not builds:
+            continue
+
+        hits = sum(b['hits'] for b in builds)
+        misses = sum(b['misses'] for b in builds)
+        hit_rate = '{:.0%}'.format(hits / (hits + misses)) if hits + misses else '-'
+        last_build = '{}/{} hits'.format(builds[-1]['hits'], builds[-1]['hits'] + builds[-1]['misses'])
+        compilation_duration = estimate_compilation_duration(builds)
+        time_saved = '{:.0f}s'.format(hits * compilation_duration) if compilation_duration else '-'
+
+        print(format_str.format(pg_venv, len(builds), hits, misses, hit_rate, last_build, time_saved))
+
+    log('shared cache: {} (max size {})'.format(get_ccache_dir(), os.environ.get('PG_CCACHE_MAXSIZE', '20G')))
+
+    return 0
+
+
+def compare(baseline, candidate, rounds=5, warmup=10, workload='tpcb-like', scale=1, clients=1, threads=1, duration=60):
+    '''
+    Compare the performance of two pg_venvs with pgbench (see run_pgbench),
+    in interleaved rounds, and report the TPS delta of candidate over
+    baseline with its 95% confidence interval
+
+    Each round runs both pg_venvs, in alternating order (ABBA...) so that
+    drift (thermal, caches...) affects both equally. Before each run, the
+    other server is stopped, the benchmarked one is restarted and warmed up
+    with warmup seconds of the same workload. Rounds are paired: the
+    confidence interval is computed by bootstrap over the ratios of the TPS
+    of each round.
+    '''
+    for pg_venv in [baseline, candidate]:
+        if not pg_virtualenv_exists(pg_venv):
+            log('This virtualenv does not exist: {}'.format(pg_venv), 'error')
+            return 1
+
+    results = {baseline: [], candidate: []}
+    for i in range(rounds):
+        log('Round {}/{}'.format(i + 1, rounds))
+        order = [baseline, candidate] if i % 2 == 0 else [candidate, baseline]
+        for pg_venv in order:
+            other_pg_venv = candidate if pg_venv == baseline else baseline
+            if pg_is_running(other_pg_venv):
+                stop(other_pg_venv)
+            if pg_is_running(pg_venv):
+                stop(pg_venv)
+            if start(pg_venv) != 0:
+                return 1
+
+            if warmup > 0 and run_pgbench(pg_venv, workload, scale, clients, threads, warmup, record=False) is None:
+                return 1
+            result = run_pgbench(pg_venv, workload, scale, clients, threads, duration)
+            if result is None:
+                return 1
+            results[pg_venv].append(result)
+
+    ratios = [c['tps'] / b['tps'] for b, c in zip(results[baseline], results[candidate])]
+
+    format_str = '{:<8}{:>16}{:>16}{:>10}'
+    print(format_str.format('ROUND', 'BASELINE TPS', 'CANDIDATE TPS', 'RATIO'))
+    for i, (b, c) in enumerate(zip(results[baseline], results[candidate])):
+        print(format_str.format(i + 1, '{:.1f}'.format(b['tps']), '{:.1f}'.format(c['tps']), '{:.3f}'.format(c['tps'] / b['tps'])))
+
+    delta = sum(ratios) / len(ratios) - 1
+    ci_low, ci_high = bootstrap_ci(ratios)
+    ci_low, ci_high = ci_low - 1, ci_high - 1
+    log('{} vs {}: {:+.2f}% TPS (95% CI [{:+.2f}%, {:+.2f}%])'.format(candidate, baseline, delta * 100, ci_low * 100, ci_high * 100))
+
+    if rounds < 2:
+        log('Not enough rounds to conclude, use at least 2', 'warning')
+    elif ci_low > 0:
+        log('{} is significantly faster than {}'.format(candidate, baseline), 'success')
+    elif ci_high < 0:
+        log('{} is significantly slower than {}'.format(candidate, baseline), 'warning')
+    else:
+        log('No significant difference between {} and {}'.format(candidate, baseline))
+
+    return 0
+
+
+def configure(additional_args=None, pg_venv=None, verbose=True, exit_on_fail=False, build_system=None):
+    '''
+    Run `./configure` in pg_venv's copy of postgresql's source, or `meson
+    setup` if the pg_venv uses meson
 
     additional_args parameter allows to add more options to configure
 
+    build_system (autoconf or meson) changes the build system of the pg_venv.
+    If it is not set, the one already used by the pg_venv is kept.
+
+    Unless PG_CONFIGURE_CACHE=0, the results of configure's tests are cached
+    for all pg_venvs using the same compiler, options and major version.
+
     Returns true if all commands run returned 0, false otherwise.
     '''
     if not pg_venv:
         pg_venv = get_env_var('PG_VENV')
     pg_src_dir = get_pg_src(pg_venv)
+
+    if build_system is None:
+        build_system = get_build_system(pg_venv)
+    if build_system not in get_supported_build_systems(pg_venv):
+        log('The source of {} can not be built with {}'.format(pg_venv, build_system), 'error')
+        if exit_on_fail:
+            raise PgVenvError('the source of {} can not be built with {}'.format(pg_venv, build_system))
+        return 1
+
+    if build_system == 'meson':
+        return meson_setup(additional_args, pg_venv, verbose, exit_on_fail)
+
     pg_configure_options = os.environ.get('PG_CONFIGURE_OPTIONS', '')
 
     # if prefix is set in PG_CONFIGURE_OPTIONS, ignore it and display a warning
@@ -45,13 +254,62 @@ def configure(additional_args=None, pg_venv=None, verbose=True, exit_on_fail=Fal
 
     pg_configure_options += ' --prefix {}'.format(get_pg_venv_dir(pg_venv))
 
+    # compile through the shared compiler cache, unless the user chose a
+    # compiler explicitly
+    use_ccache = ccache_enabled() and 'CC=' not in pg_configure_options + ' '.join(additional_args or [])
+    if use_ccache:
+        pg_configure_options += ' CC="ccache {}"'.format(get_cc())
+
     if additional_args is None:
         additional_args = []
     # convert additional_args list to a string
     additional_args = ' '.join(additional_args)
 
-    cmd = 'cd {} && ./configure --quiet {} {}'.format(pg_src_dir, pg_configure_options, additional_args)
-    configure_return_code = execute_cmd(cmd, 'Running configure script', verbose=verbose, exit_on_fail=exit_on_fail)
+    # share the results of configure's tests with the other pg_venvs using the
+    # same toolchain and options. The pg_venv works on its own copy of the
+    # cache, which replaces the shared one if configure succeeds.
+    shared_cache_file = None
+    if configure_cache_enabled():
+        shared_cache_file = get_configure_cache_file(
+            pg_venv,
+            pg_configure_options.replace(' --prefix {}'.format(get_pg_venv_dir(pg_venv)), '') + ' ' + additional_args,
+        )
+    cache_file = os.path.join(get_pg_venv_dir(pg_venv), 'config.cache')
+    cache_used = shared_cache_file is not None and os.path.isfile(shared_cache_file)
+    if cache_used:
+        shutil.copyfile(shared_cache_file, cache_file)
+    elif os.path.isfile(cache_file):
+        os.unlink(cache_file)
+
+    cache_option = '--cache-file={}'.format(cache_file) if shared_cache_file else ''
+    cmd = 'cd {} && ./configure --quiet {} {} {}'.format(pg_src_dir, cache_option, pg_configure_options, additional_args)
+    configure_return_code = execute_cmd(
+        cmd,
+        'Running configure script{}'.format(' (cached)' if cache_used else ''),
+        verbose=verbose,
+        exit_on_fail=exit_on_fail and not cache_used,
+    )
+
+    # the cache may be stale (e.g. a test changed in configure), so try again
+    # without it
+    if configure_return_code != 0 and cache_used:
+        log('configure failed with the shared cache, discarding it', 'warning')
+        os.unlink(shared_cache_file)
+        os.unlink(cache_file)
+        configure_return_code = execute_cmd(cmd, 'Running configure script', verbose=verbose, exit_on_fail=exit_on_fail)
+
+    if configure_return_code == 0 and shared_cache_file and configure_cache_is_valid(cache_file):
+        os.makedirs(os.path.dirname(shared_cache_file), exist_ok=True)
+        shutil.copyfile(cache_file, shared_cache_file + '.{}.tmp'.format(os.getpid()))
+        os.replace(shared_cache_file + '.{}.tmp'.format(os.getpid()), shared_cache_file)
+
+    if configure_return_code == 0:
+        update_pg_metadata(
+            pg_venv,
+            build_system='autoconf',
+            ccache=use_ccache,
+            configure_options=' '.join([os.environ.get('PG_CONFIGURE_OPTIONS', ''), additional_args]).strip(),
+        )
 
     # display warning if necessary
     if warning_prefix_ignored:
@@ -61,11 +319,25 @@ def configure(additional_args=None, pg_venv=None, verbose=True, exit_on_fail=Fal
     return configure_return_code
 
 
-def create_virtualenv(pg_venv, pg_branch):
+def create_virtualenv(pg_venv, pg_branch=None, seed=None, build_system=None, tmpfs=False, tmpfs_build=False, profile=None):
     '''
     Create a new venv, by creating a new git worktree, configuring, compiling,
     installing, initializing the cluster, creating a db and starting the
     server.
+
+    If seed is set, the build products of an existing pg_venv are copied to
+    the new worktree first, so that only the files that differ are compiled.
+    seed is either the name of that pg_venv, or 'auto' to use the closest one
+    in git history.
+
+    build_system is autoconf or meson. By default, PG_BUILD_SYSTEM is used if
+    the source supports it, autoconf otherwise.
+
+    If tmpfs is True, the data directory is on tmpfs, and so is the build
+    directory if tmpfs_build is True (meson only), see action tmpfs.
+
+    profile is the configuration profile applied after initdb (default:
+    PG_CONF_PROFILE), see action profile.
     '''
     if pg_venv is None:
         pg_venv = get_env_var('PG_VENV')
@@ -74,30 +346,74 @@ def create_virtualenv(pg_venv, pg_branch):
     if pg_branch is not None:
         pg_branch = pg_branch[0]
 
-    worktree_return_code = create_git_worktree(pg_venv, pg_branch)
-
-    configure_return_code = configure(pg_venv=pg_venv, exit_on_fail=True)
-    make_return_code = make(additional_args=['-j {}'.format(multiprocessing.cpu_count())], pg_venv=pg_venv, exit_on_fail=True)
-    install_return_code = install(pg_venv=pg_venv, exit_on_fail=True)
-
-    initdb_return_code = initdb(pg_venv, exit_on_fail=True)
-
-    start_return_code = start(pg_venv, exit_on_fail=True)
-
-    # sleep for a while to give the server time to start
-    # it would be better to use the `--wait` option of pg_ctl, but it was only introduced in pg10
-    time.sleep(1)
-
-    cmd = os.path.join(get_pg_bin(pg_venv), 'createdb -p {}'.format(get_pg_port(pg_venv)))
-    createdb_return_code = execute_cmd(cmd, 'Creating a database', exit_on_fail=True)
+    # duration of each phase, see action stats
+    durations = {}
+
+    with timed('worktree', pg_venv) as timing:
+        worktree_return_code = create_git_worktree(pg_venv, pg_branch)
+    durations['worktree'] = timing['wall']
+
+    # used by `pg workon` instead of starting python
+    write_activation_script(pg_venv)
+    update_index([pg_venv])
+
+    if build_system is None:
+        build_system = get_build_system(pg_venv)
+
+    # meson writes absolute paths in its build directory, so it can't be
+    # copied to another worktree
+    if seed is not None and build_system == 'meson':
+        log('Build trees can only be seeded with autoconf, building from scratch', 'warning')
+        seed = None
+    if seed == 'auto':
+        seed = find_closest_pg_venv(pg_venv, os.environ.get('PG_CONFIGURE_OPTIONS', ''))
+        if seed is None:
+            log('No pg_venv built with the same configure options was found, building from scratch', 'warning')
+    if seed is not None:
+        with timed('seed') as timing:
+            seed_build_tree(pg_venv, seed)
+        durations['seed'] = timing['wall']
+
+    if tmpfs_build and build_system != 'meson':
+        log('Only the build directory of meson can be on tmpfs, building on disk', 'warning')
+        tmpfs_build = False
+    if tmpfs:
+        set_tmpfs(pg_venv, 'data', True)
+    if tmpfs_build:
+        set_tmpfs(pg_venv, 'build', True)
+
+    if profile is not None:
+        update_pg_metadata(pg_venv, conf_profile=profile)
+
+    with timed('configure') as timing:
+        configure_return_code = configure(pg_venv=pg_venv, exit_on_fail=True, build_system=build_system)
+    durations['configure'] = timing['wall']
+
+    with timed('build') as timing:
+        build_return_code = build(pg_venv=pg_venv, exit_on_fail=True)
+    durations['build'] = timing['wall']
+
+    with timed('initdb') as timing:
+        initdb_return_code = initdb(pg_venv, exit_on_fail=True)
+    durations['initdb'] = timing['wall']
+
+    # start() waits until the server accepts connections
+    with timed('start') as timing:
+        start_return_code = start(pg_venv, exit_on_fail=True)
+    durations['start'] = timing['wall']
+
+    with timed('createdb') as timing:
+        cmd = os.path.join(get_pg_bin(pg_venv), 'createdb -p {}'.format(get_pg_port(pg_venv)))
+        createdb_return_code = execute_cmd(cmd, 'Creating a database', exit_on_fail=True)
+    durations['createdb'] = timing['wall']
 
     log('pg_virtualenv {} created. Run `pg workon {}` to use it.'.format(pg_venv, pg_venv), 'success')
-    log('worktree {} configure {} make {} install {} initdb {} start {} createdb {}'.format(worktree_return_code, configure_return_code, make_return_code, install_return_code, initdb_return_code, start_return_code, createdb_return_code))
+    log('worktree {} configure {} build {} initdb {} start {} createdb {}'.format(worktree_return_code, configure_return_code, build_return_code, initdb_return_code, start_return_code, createdb_return_code))
+    log(', '.join('{} {}'.format(phase, format_duration(duration)) for phase, duration in durations.items()))
 
     return worktree_return_code \
         + configure_return_code \
-        + make_return_code \
-        + install_return_code \
+        + build_return_code \
         + initdb_return_code \
         + start_return_code \
         + createdb_return_code
@@ -150,6 +466,228 @@ def create_git_worktree(pg_venv, pg_branch):
     return worktree_return_code
 
 
+def seed_build_tree(pg_venv, seed_pg_venv):
+    '''
+    Copy the build products (object files, config.status, generated files...)
+    of seed_pg_venv into the worktree of pg_venv, and fix the timestamps of
+    the sources so that make only rebuilds what differs between both trees
+
+    Files are copied using reflinks if the filesystem supports them. They are
+    never hardlinked, as the compiler would then overwrite the seed's files
+    in place.
+    '''
+    seed_src = get_pg_src(seed_pg_venv)
+    pg_src = get_pg_src(pg_venv)
+
+    # copy the files ignored by git, except test outputs
+    cmd = 'cd {} && git ls-files -z --others --ignored --exclude-standard' \
+        ' | grep -zv -e "^tmp_install/" -e "/tmp_check/" -e "/results/"' \
+        ' | xargs -0 --no-run-if-empty cp -a --reflink=auto --parents -t {}'.format(seed_src, pg_src)
+    copy_return_code = execute_cmd(
+        cmd,
+        'Copying build products from pg_venv {}'.format(seed_pg_venv),
+        process_output=False,
+    )
+    if copy_return_code != 0:
+        return copy_return_code
+
+    # files that differ between the seed's working tree and the new worktree
+    pg_head = subprocess.check_output('cd {} && git rev-parse HEAD'.format(pg_src), shell=True).strip().decode('utf-8')
+    cmd = 'cd {} && git diff --name-only -z {}'.format(seed_src, pg_head)
+    changed_files = set(subprocess.check_output(cmd, shell=True).decode('utf-8').split('\0'))
+
+    # the files that are identical get the seed's timestamps, so that they are
+    # older than the copied build products. The other ones keep the time of
+    # the checkout, so they will be rebuilt.
+    cmd = 'cd {} && git ls-files -z'.format(pg_src)
+    tracked_files = subprocess.check_output(cmd, shell=True).decode('utf-8').split('\0')
+    for tracked_file in tracked_files:
+        if not tracked_file or tracked_file in changed_files:
+            continue
+
+        try:
+            seed_stat = os.stat(os.path.join(seed_src, tracked_file))
+            os.utime(os.path.join(pg_src, tracked_file), ns=(seed_stat.st_atime_ns, seed_stat.st_mtime_ns))
+        except FileNotFoundError:
+            pass
+
+    log('{} files differ from pg_venv {}, they will be rebuilt'.format(len(changed_files - {''}), seed_pg_venv))
+    update_pg_metadata(pg_venv, seeded_from=seed_pg_venv)
+
+    return 0
+
+
+def run_bulk(action, action_args, all_pg_venvs=False, running=False, pattern=None, parallel=None):
+    '''
+    Run an action on several pg_venvs at the same time (see select_pg_venvs),
+    on at most parallel of them at once (PG_BULK_PARALLEL, the number of CPUs
+    by default), and show a summary of the results
+
+    Each pg_venv gets its own pg_venv.py process, whose output is written to
+    the pg_venv's logs/bulk-<action>.log.
+    '''
+    import concurrent.futures
+
+    if parallel is None:
+        parallel = int(os.environ.get('PG_BULK_PARALLEL', os.cpu_count()))
+
+    pg_venvs = select_pg_venvs(all_pg_venvs, running, pattern)
+    if not pg_venvs:
+        log('No pg_venv selected', 'warning')
+        return 0
+
+    argv = [action]
+    if action_args.get('additional_args'):
+        argv += ['--'] + action_args['additional_args']
+
+    def run_action(pg_venv):
+        log_file = get_phase_log_file(pg_venv, 'bulk {}'.format(action))
+        os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        rotate_log(log_file)
+
+        start_time = time.monotonic()
+        with open(log_file, 'wb') as f:
+            return_code = subprocess.call(
+                [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pg_venv.py')] + argv,
+                stdin=subprocess.DEVNULL,
+                stdout=f,
+                stderr=subprocess.STDOUT,
+                env=dict(os.environ, PG_VENV=pg_venv),
+            )
+
+        return return_code, time.monotonic() - start_time, log_file
+
+    log('Running {} on {} pg_venvs, {} at a time'.format(action, len(pg_venvs), min(parallel, len(pg_venvs))))
+    start_time = time.monotonic()
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        futures = {executor.submit(run_action, pg_venv): pg_venv for pg_venv in pg_venvs}
+        for future in concurrent.futures.as_completed(futures):
+            results[futures[future]] = future.result()
+            log('{} done ({}/{})'.format(futures[future], len(results), len(pg_venvs)))
+
+    pg_venv_column_size = max(max(map(len, pg_venvs)), len('PG_VENV')) + 4
+    format_str = '{:<' + str(pg_venv_column_size) + '}{:<14}{:>10}    {}'
+    print(format_str.format('PG_VENV', 'RESULT', 'DURATION', 'LOG'))
+    for pg_venv in pg_venvs:
+        return_code, duration, log_file = results[pg_venv]
+        result = 'OK' if return_code == 0 else 'failed ({})'.format(return_code)
+        print(format_str.format(pg_venv, result, format_duration(duration), log_file))
+
+    failed = sum(return_code != 0 for return_code, _, _ in results.values())
+    duration = format_duration(time.monotonic() - start_time)
+    if failed:
+        log('{} failed on {}/{} pg_venvs, in {}'.format(action, failed, len(pg_venvs), duration), 'error')
+        return 1
+
+    log('{} done on {} pg_venvs in {}'.format(action, len(pg_venvs), duration), 'success')
+
+    return 0
+
+
+def run_api(function, kwargs, cmd_description=None, verbose=True, exit_on_fail=False):
+    '''
+    Run a coroutine function of the Python API (see api.py) for an action,
+    given by its name, and display how it went after cmd_description
+
+    If it fails, the end of the output of the failed command is displayed,
+    with the log file where the rest of it is, and PgVenvError is raised if
+    exit_on_fail is True.
+
+    Returns the return code of the function (the one of the failed command if
+    there is one) and its result (None if it failed).
+    '''
+    import asyncio
+    import api
+
+    if verbose and cmd_description:
+        log('{}... '.format(cmd_description), end='')
+
+    try:
+        result = asyncio.run(getattr(api, function)(**kwargs))
+    except PgVenvError as e:
+        # display the end of the output of the failed command
+        if isinstance(e, CommandError):
+            print() # new line
+            print(e.output, end='')
+            if e.log_file is not None:
+                log('Full output in {}'.format(e.log_file), 'error')
+        if verbose and cmd_description:
+            log('failed', 'error', prefix=isinstance(e, CommandError))
+        log(str(e), 'error')
+        if exit_on_fail:
+            raise
+        return getattr(e, 'return_code', 1), None
+
+    if verbose and cmd_description:
+        log('OK', 'success', prefix=False)
+
+    return 0, result
+
+
+def run_pgbench(pg_venv, workload='tpcb-like', scale=1, clients=1, threads=1, duration=60, init=False, record=True):
+    '''
+    Run pgbench against a pg_venv (see api.bench_async), and return the
+    result of the run, with its id if it was recorded, or None if it failed
+    '''
+    if recover_tmpfs(pg_venv, ['data']) != 0:
+        return None
+
+    _, run = run_api(
+        'bench_async',
+        {
+            'pg_venv': pg_venv,
+            'workload': workload,
+            'scale': scale,
+            'clients': clients,
+            'threads': threads,
+            'duration': duration,
+            'init': init,
+            'record': record,
+        },
+        'Running {} on {} ({} clients, {}s)'.format(os.path.basename(workload), pg_venv, clients, duration),
+    )
+
+    return run
+
+
+def disk_usage(pg_venv, rescan=False):
+    '''
+    Show the disk space used by each component of a pg_venv, and how to
+    reclaim it
+    If a pg_venv name is not provided, show it for the current one.
+    '''
+    if pg_venv is None:
+        pg_venv = get_env_var('PG_VENV')
+
+    if rescan:
+        breakdown = update_disk_usage(pg_venv)
+    else:
+        breakdown = get_disk_usage_breakdown(pg_venv)
+
+    how_to_clean = {
+        'build': 'pg make_clean',
+        'data': 'pg rm_data',
+        'log': 'truncate {}'.format(get_pg_log(pg_venv)),
+        'snapshots': 'pg rm_snapshot',
+    }
+
+    format_str = '{:<12}{:>10}{:>10}{:>22}    {}'
+    print(format_str.format('COMPONENT', 'SIZE', 'SHARED', 'SCANNED', 'TO CLEAN'))
+    for component in get_disk_usage_components(pg_venv):
+        usage = breakdown[component]
+        print(format_str.format(
+            component,
+            ('' if usage['complete'] else '>') + format_size(usage['bytes']),
+            format_size(usage['shared_bytes']),
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(usage['time'])),
+            how_to_clean.get(component, ''),
+        ))
+    print(format_str.format('total', get_disk_usage(pg_venv), '', '', ''))
+
+    return 0
+
+
 def get_shell_function():
     '''
     Return the text for the function pg(), used as a wrapper around this
@@ -181,6 +719,15 @@ def get_shell_function():
     output += prefix + if_clause
     prefix += '    '
 
+    # source the activation script of the pg_venv if it exists, which is
+    # much faster than starting python
+    output += prefix + 'if [[ -n $2 && -f "$PG_VIRTUALENV_HOME/$2/activate" ]]; then\n'
+    prefix += '    '
+    output += prefix + 'source "$PG_VIRTUALENV_HOME/$2/activate"\n'
+    output += prefix + 'return\n'
+    prefix = prefix[:-4]
+    output += prefix + 'fi\n'
+
     output += prefix + 'cmd_output=$({} $@ 2>&1)\n'.format(script_path)
     output += prefix + 'if [ $? -eq 0 ]; then\n'
     prefix += '    '
@@ -212,29 +759,82 @@ def install(pg_venv=None, verbose=True, exit_on_fail=False):
     '''
     Run make install in postgresql source dir
 
+    Core and contrib are installed by a single make, one after the other.
+    Unless PG_INSTALL_STORE=0, the files are installed in a staging directory
+    first, then deduplicated in the install store shared by all the pg_venvs,
+    and hardlinked in the install prefix.
+
     Returns true if all commands run returned 0, false otherwise.
     '''
     if not pg_venv:
         pg_venv = get_env_var('PG_VENV')
-    pg_src_dir = get_pg_src(pg_venv)
-    cmd = 'cd {} && make -s install && cd contrib && make -s install'.format(pg_src_dir)
-    install_return_code = execute_cmd(cmd, 'Installing PostgreSQL', verbose, process_output=False, exit_on_fail=exit_on_fail)
 
-    return install_return_code
+    if recover_tmpfs(pg_venv, ['build']) != 0:
+        return 1
 
+    return_code, result = run_api('install_async', {'pg_venv': pg_venv, 'verbose': verbose}, 'Installing PostgreSQL', verbose, exit_on_fail)
+    if result is not None and verbose:
+        print_build_result(result)
 
-def list_pg_venv():
+    return return_code
+
+
+def jobs(job_id=None):
+    '''
+    List the jobs of pg_venvd (see pg_venvd.py), or show the output of one
+    of them if job_id is set
+    '''
+    answer = daemon_request('jobs')
+    if answer is None:
+        log('pg_venvd is not running', 'error')
+        return 1
+
+    if job_id is not None:
+        job = [job for job in answer['jobs'] if job['id'] == job_id]
+        if not job:
+            log('There is no job {}'.format(job_id), 'error')
+            return 1
+        with open(job[0]['log']) as f:
+            print(f.read(), end='')
+        return 0
+
+    format_str = '{:>5}  {:<10}{:<20}{:>10}{:>6}  {}'
+    print(format_str.format('ID', 'STATE', 'PG_VENV', 'DURATION', 'RC', 'COMMAND'))
+    for job in answer['jobs']:
+        if job['start_time'] is None:
+            duration = '-'
+        else:
+            duration = format_duration((job['end_time'] or time.time()) - job['start_time'])
+        return_code = job['return_code'] if job['return_code'] is not None else '-'
+        print(format_str.format(job['id'], job['state'], job['pg_venv'] or '-', duration, return_code, ' '.join(job['argv'])))
+
+    return 0
+
+
+def list_pg_venv(as_json=False):
     '''
     List active and inactive pg_venv
+
+    If as_json is True, the list is printed as JSON.
+    The information comes from pg_venvd if it is running (see pg_venvd.py).
     '''
-    pg_venvs = available_pg_venvs()
+    import api
+
     current_pg_venv = get_env_var('PG_VENV', error_on_fail=False)
+    pg_venvs_info = api.list_pg_venvs()
+    pg_venvs = [pg_venv_info['pg_venv'] for pg_venv_info in pg_venvs_info]
+
+    if as_json:
+        for pg_venv_info in pg_venvs_info:
+            pg_venv_info['current'] = pg_venv_info['pg_venv'] == current_pg_venv
+        print(json.dumps(pg_venvs_info, indent=4))
+        return 0
 
     current_str = ' [current]'
     sep_size = 4
 
     pg_venv_column_size = max(
-        max(map(len, pg_venvs)),
+        max(map(len, pg_venvs), default=0),
         len(current_pg_venv if current_pg_venv else []) + len(current_str)
     ) + sep_size
     port_column_size = 5 + sep_size
@@ -251,34 +851,67 @@ def list_pg_venv():
         '}'
 
     print(format_str.format('PG_VENV', 'PORT', 'VERSION', 'RUNNING', 'DISK USAGE'))
-    for pg_venv in pg_venvs:
+    for pg_venv_info in pg_venvs_info:
+        pg_venv = pg_venv_info['pg_venv']
         pg_venv_str = pg_venv + current_str if pg_venv == current_pg_venv else pg_venv
-        running_str = colorize('Yes        ', 'success') if pg_is_running(pg_venv) else 'No'
-        disk_usage_str = get_disk_usage(pg_venv)
-        print(format_str.format(pg_venv_str, get_pg_port(pg_venv), get_pg_version(pg_venv), running_str, disk_usage_str))
+        running_str = colorize('Yes        ', 'success') if pg_venv_info['running'] else 'No'
+        print(format_str.format(pg_venv_str, pg_venv_info['port'], pg_venv_info['version'] or '-', running_str, pg_venv_info['disk_usage']))
+
+    return 0
+
+
+def list_snapshots(pg_venv):
+    '''
+    List the snapshots of a pg_venv's data
+    If a pg_venv name is not provided, list the ones of the current one.
+    '''
+    if pg_venv is None:
+        pg_venv = get_env_var('PG_VENV')
+
+    snapshots = get_snapshots(pg_venv)
+    if not snapshots:
+        log('No snapshot for {}, use `pg snapshot` to take one'.format(pg_venv))
+        return 0
+
+    snapshot_column_size = max(len('SNAPSHOT'), *[len(s['name']) for s in snapshots]) + 4
+    format_str = '{:<' + str(snapshot_column_size) + '}{:<23}{:<11}{:<11}{:>10}'
+    print(format_str.format('SNAPSHOT', 'TAKEN', 'METHOD', 'VERSION', 'SIZE'))
+    for snapshot in snapshots:
+        print(format_str.format(
+            snapshot['name'],
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(snapshot['time'])),
+            snapshot['method'],
+            snapshot['pg_version'] or '-',
+            format_size(snapshot['bytes']),
+        ))
+
+    return 0
 
 
 def make(additional_args=[], pg_venv=None, verbose=True, exit_on_fail=False):
     '''
-    Run make in the postgresql source dir
+    Run make in the postgresql source dir, or ninja if the pg_venv uses meson
 
     Uses env var PG_DIR
     <make_args> options that are passed to make
 
+    Core and contrib are built by a single make, sharing the same jobserver.
+    If <make_args> contains targets, make is run for these targets in the
+    source dir, then in contrib.
+
     Returns true if all commands run returned 0, false otherwise.
     '''
     if not pg_venv:
         pg_venv = get_env_var('PG_VENV')
 
-    pg_src_dir = get_pg_src(pg_venv)
-
-    # convert make_args list into a string
-    additional_args = ' '.join(additional_args)
+    if recover_tmpfs(pg_venv, ['build']) != 0:
+        return 1
 
-    cmd = 'cd {} && make -s {} && cd contrib && make -s {}'.format(pg_src_dir, additional_args, additional_args)
-    make_return_code = execute_cmd(cmd, 'Compiling PostgreSQL', verbose, exit_on_fail=exit_on_fail, process_output=False)
+    return_code, result = run_api('make_async', {'pg_venv': pg_venv, 'make_args': additional_args, 'verbose': verbose}, 'Compiling PostgreSQL', verbose, exit_on_fail)
+    if result is not None and verbose:
+        print_build_result(result)
 
-    return make_return_code
+    return return_code
 
 
 def make_check(pg_venv=None):
@@ -290,11 +923,14 @@ def make_check(pg_venv=None):
     if pg_venv is None:
         pg_venv = get_env_var('PG_VENV')
 
-    pg_src_dir = get_pg_src(pg_venv)
-    cmd = 'cd {} && make -s check'.format(pg_src_dir)
-    make_check_return_code = execute_cmd(cmd, 'Running make check', process_output=False)
+    if recover_tmpfs(pg_venv, ['build']) != 0:
+        return 1
 
-    return make_check_return_code
+    return_code, result = run_api('make_check_async', {'pg_venv': pg_venv, 'verbose': True}, 'Running make check')
+    if result is not None:
+        print_build_result(result)
+
+    return return_code
 
 
 def make_clean(pg_venv=None):
@@ -307,13 +943,340 @@ def make_clean(pg_venv=None):
         pg_venv = get_env_var('PG_VENV')
 
     pg_src_dir = get_pg_src(pg_venv)
-    cmd = 'cd {} && make -s clean'.format(pg_src_dir)
+    if get_build_system(pg_venv) == 'meson':
+        cmd = 'ninja -C {} clean'.format(get_pg_build_dir(pg_venv))
+    else:
+        cmd = 'cd {} && make -s clean'.format(pg_src_dir)
     execute_cmd(cmd, 'Running make clean')
 
 
+def meson_setup(additional_args=None, pg_venv=None, verbose=True, exit_on_fail=False):
+    '''
+    Run `meson setup` in pg_venv's copy of postgresql's source, with the build
+    directory in the source directory
+
+    additional_args parameter allows to add more options to meson
+
+    Returns true if all commands run returned 0, false otherwise.
+    '''
+    if not pg_venv:
+        pg_venv = get_env_var('PG_VENV')
+    pg_meson_options = os.environ.get('PG_MESON_OPTIONS', '')
+
+    if additional_args is None:
+        additional_args = []
+    # convert additional_args list to a string
+    additional_args = ' '.join(additional_args)
+
+    # meson only picks the compiler when the build directory is created
+    use_ccache = ccache_enabled()
+    env = {'CC': 'ccache {}'.format(get_cc()) if use_ccache else get_cc()}
+
+    build_dir = get_pg_build_dir(pg_venv)
+    reconfigure = '--reconfigure' if os.path.isfile(os.path.join(build_dir, 'build.ninja')) else ''
+    cmd = 'cd {} && meson setup {} {} --prefix={} {} {}'.format(
+        get_pg_src(pg_venv),
+        reconfigure,
+        build_dir,
+        get_pg_venv_dir(pg_venv),
+        pg_meson_options,
+        additional_args,
+    )
+    setup_return_code = execute_cmd(cmd, 'Running meson setup', verbose=verbose, exit_on_fail=exit_on_fail, process_output=False, env=env)
+
+    if setup_return_code == 0:
+        update_pg_metadata(
+            pg_venv,
+            build_system='meson',
+            ccache=use_ccache if not reconfigure else get_pg_metadata(pg_venv).get('ccache', False),
+            configure_options=' '.join([pg_meson_options, additional_args]).strip(),
+        )
+
+    return setup_return_code
+
+
+def profile(profile_name=None, pg_venv=None):
+    '''
+    Apply a configuration profile to a pg_venv (see
+    get_conf_profile_settings), or show the current one if profile_name is
+    not provided
+    If a pg_venv name is not provided, use the current one.
+
+    If the server is running, its configuration is reloaded, or it is
+    restarted if a setting that changed can only be set at server start.
+    '''
+    if pg_venv is None:
+        pg_venv = get_env_var('PG_VENV')
+
+    if profile_name is None:
+        current_profile = get_pg_metadata(pg_venv).get('conf_profile')
+        log('Configuration profile of {}: {}'.format(pg_venv, current_profile or 'none (default configuration)'))
+        for name, value in read_conf_profile(pg_venv).items():
+            print('    {} = {}'.format(name, value))
+        log('Available profiles: {}'.format(', '.join(CONF_PROFILES)))
+        return 0
+
+    changed_settings = apply_conf_profile(pg_venv, profile_name)
+    log('Configuration profile {} applied, {} settings changed'.format(profile_name, len(changed_settings)), 'success')
+
+    if not changed_settings or not pg_is_running(pg_venv):
+        return 0
+
+    restart_settings = [s for s in changed_settings if s in CONF_RESTART_SETTINGS]
+    if restart_settings:
+        log('Restarting, because of {}'.format(', '.join(restart_settings)))
+        return restart(pg_venv)
+
+    cmd = '{} reload -D {}'.format(os.path.join(get_pg_bin(pg_venv), 'pg_ctl'), get_pg_data(pg_venv))
+    return execute_cmd(cmd, 'Reloading PostgreSQL configuration', process_output=False)
+
+
+def perf_bisect(good, bad, pg_venv='perf_bisect', threshold=5, runs=3, snapshot_name=None, workload='tpcb-like', scale=1, clients=1, threads=1, duration=60):
+    '''
+    Find the commit that made a workload slower, with `git bisect` between
+    good and bad, in the worktree of a dedicated pg_venv (created if it
+    doesn't exist)
+
+    At each step, the commit is built incrementally and installed, the data
+    directory is restored from snapshot snapshot_name (or reset if not
+    provided), and the workload is run runs times (see run_pgbench). The
+    commit is bad if its median TPS is more than threshold percent below the
+    one of good. Installed files and results are cached for each commit, so
+    commits that were already measured cost nothing.
+    '''
+    if not pg_virtualenv_exists(pg_venv):
+        create_git_worktree(pg_venv, None)
+        # autoconf only tracks the dependencies on headers with
+        # --enable-depend, which incremental builds need
+        configure_args = ['--enable-depend'] if get_build_system(pg_venv) == 'autoconf' else []
+        if configure(configure_args, pg_venv=pg_venv) != 0:
+            return 1
+
+    pg_src = get_pg_src(pg_venv)
+
+    def git(*args):
+        return subprocess.run(['git'] + list(args), cwd=pg_src, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+
+    def measure(commit):
+        '''
+        Return the median TPS of the workload on a commit, None if it can't be
+        built
+        '''
+        cached_runs = [
+            r for r in get_bench_runs(pg_venv, workload)
+            if (r['git_commit'], r['scale'], r['clients'], r['threads'], r['duration']) == (commit, scale, clients, threads, duration)
+        ]
+        if len(cached_runs) >= runs:
+            log('Using the {} recorded runs of {}'.format(len(cached_runs), commit[:10]))
+            return percentile(sorted(r['tps'] for r in cached_runs[-runs:]), 50)
+
+        if pg_is_running(pg_venv):
+            stop(pg_venv)
+
+        if os.path.isdir(get_build_cache_dir(pg_venv, commit)):
+            log('Installing {} from the build cache'.format(commit[:10]))
+            install_from_build_cache(pg_venv, commit)
+        elif build(pg_venv=pg_venv) == 0:
+            save_build_to_cache(pg_venv, commit)
+        else:
+            return None
+
+        # a snapshot taken with another catalog version can't be started, in
+        # which case the data directory is reset
+        if snapshot_name is None or restore(snapshot_name, pg_venv) != 0 or start(pg_venv) != 0:
+            if pg_is_running(pg_venv):
+                stop(pg_venv)
+            if snapshot_name is not None:
+                log('Snapshot {} can not be used with {}, resetting the data directory'.format(snapshot_name, commit[:10]), 'warning')
+            if reset_data(pg_venv, force=True) != 0 or start(pg_venv) != 0:
+                return None
+
+        results = [run_pgbench(pg_venv, workload, scale, clients, threads, duration) for _ in range(runs)]
+        if None in results:
+            return None
+
+        return percentile(sorted(r['tps'] for r in results), 50)
+
+    good_commit = git('rev-parse', '--verify', good + '^{commit}').stdout.strip()
+    bad_commit = git('rev-parse', '--verify', bad + '^{commit}').stdout.strip()
+    git('bisect', 'reset')
+    # the branch (or commit) of the worktree, to check it out at the end
+    original_head = git('symbolic-ref', '--quiet', '--short', 'HEAD').stdout.strip() or git('rev-parse', 'HEAD').stdout.strip()
+
+    tps = {}
+    for commit in [good_commit, bad_commit]:
+        checkout = git('checkout', '--detach', commit)
+        if checkout.returncode != 0:
+            log(checkout.stdout, 'error')
+            return 1
+        tps[commit] = measure(commit)
+        if tps[commit] is None:
+            log('Could not measure {}'.format(commit[:10]), 'error')
+            return 1
+
+    tps_limit = tps[good_commit] * (1 - threshold / 100)
+    if tps[bad_commit] >= tps_limit:
+        log('{} is not more than {}% slower than {} ({:.1f} vs {:.1f} TPS), nothing to bisect'.format(bad, threshold, good, tps[bad_commit], tps[good_commit]), 'error')
+        return 1
+
+    bisect = git('bisect', 'start', bad_commit, good_commit)
+    first_bad_commit = None
+    while first_bad_commit is None:
+        if bisect.returncode != 0:
+            log(bisect.stdout, 'error')
+            break
+        log(bisect.stdout.strip().splitlines()[0])
+
+        commit = git('rev-parse', 'HEAD').stdout.strip()
+        tps[commit] = measure(commit)
+        if tps[commit] is None:
+            verdict = 'skip'
+        else:
+            verdict = 'bad' if tps[commit] < tps_limit else 'good'
+        log('{}: {} ({} TPS, limit {:.1f})'.format(
+            commit[:10], verdict, '{:.1f}'.format(tps[commit]) if tps[commit] is not None else '-', tps_limit))
+
+        bisect = git('bisect', verdict)
+        match = re.search(r'^([0-9a-f]{40}) is the first bad commit', bisect.stdout, re.MULTILINE)
+        if match:
+            first_bad_commit = match.group(1)
+        elif 'only skipped commits left' in bisect.stdout:
+            log(bisect.stdout, 'warning')
+            break
+
+    git('bisect', 'reset', original_head)
+    if pg_is_running(pg_venv):
+        stop(pg_venv)
+
+    if first_bad_commit is None:
+        return 1
+
+    log('First bad commit: {}'.format(git('log', '-1', '--format=%h %s', first_bad_commit).stdout.strip()), 'success')
+    log('{:.1f} TPS, against {:.1f} TPS for {}'.format(tps[first_bad_commit], tps[good_commit], good))
+
+    return 0
+
+
+def print_bench_runs(runs):
+    '''
+    Print benchmark runs, as returned by get_bench_runs, as a table
+    The id of a run is the one it has in the results database.
+    '''
+    pg_venv_column_size = max(len('PG_VENV'), *[len(r['pg_venv']) for r in runs]) + 4
+    workload_column_size = max(len('WORKLOAD'), *[len(os.path.basename(r['workload'])) for r in runs]) + 4
+    format_str = '{:>6}  {:<18}{:<' + str(pg_venv_column_size) + '}{:<12}{:<' + str(workload_column_size) + '}{:>6}{:>8}{:>12}{:>10}{:>10}{:>10}'
+
+    print(format_str.format('ID', 'TIME', 'PG_VENV', 'COMMIT', 'WORKLOAD', 'SCALE', 'CLIENTS', 'TPS', 'P50 (ms)', 'P90 (ms)', 'P99 (ms)'))
+    for run in runs:
+        print(format_str.format(
+            run.get('id', '-'),
+            time.strftime('%Y-%m-%d %H:%M', time.localtime(run['time'])),
+            run['pg_venv'],
+            (run['git_commit'] or '-')[:10],
+            os.path.basename(run['workload']),
+            run['scale'],
+            run['clients'],
+            '{:.1f}'.format(run['tps']),
+            *['{:.3f}'.format(run[p]) if run[p] is not None else '-' for p in ['latency_p50', 'latency_p90', 'latency_p99']]
+        ))
+
+
+def print_build_result(result):
+    '''
+    Print what a build did, as returned by api.run_build_async
+    '''
+    if result['installed_files'] is not None:
+        log('{} files linked from the install store'.format(result['installed_files']))
+
+    if result['ccache'] is not None:
+        log('ccache: {} hits, {} misses{}'.format(
+            result['ccache']['hits'],
+            result['ccache']['misses'],
+            ', about {:.0f}s saved'.format(result['ccache']['saved']) if result['ccache']['saved'] is not None else '',
+        ))
+
+    for phase in result['phases']:
+        log('{:<20}{:>8.1f}s  (started at {:.1f}s)'.format(phase['phase'], phase['duration'], phase['start']))
+
+
+def recover_tmpfs(pg_venv, components=None):
+    '''
+    Recover the directories of a pg_venv that were on tmpfs and have been
+    lost, e.g. after a reboot: the data directory is restored from the latest
+    snapshot if there is one, otherwise initdb is run; meson setup is run
+    again for the build directory.
+    components limits the recovery to some directories (data and/or build).
+    '''
+    lost_components = recreate_tmpfs_dirs(pg_venv, components)
+    recover_return_code = 0
+
+    if 'build' in lost_components:
+        log('The build directory of {} on tmpfs was lost, setting it up again'.format(pg_venv), 'warning')
+        # configure_options starts with PG_MESON_OPTIONS, that meson_setup adds
+        # again
+        configure_options = get_pg_metadata(pg_venv).get('configure_options', '')
+        pg_meson_options = os.environ.get('PG_MESON_OPTIONS', '')
+        if pg_meson_options and configure_options.startswith(pg_meson_options):
+            configure_options = configure_options[len(pg_meson_options):]
+        recover_return_code += meson_setup(shlex.split(configure_options), pg_venv)
+
+    if 'data' in lost_components:
+        if get_snapshots(pg_venv):
+            log('The data directory of {} on tmpfs was lost, restoring the latest snapshot'.format(pg_venv), 'warning')
+            recover_return_code += restore(pg_venv=pg_venv)
+        else:
+            log('The data directory of {} on tmpfs was lost, initializing a new one'.format(pg_venv), 'warning')
+            recover_return_code += initdb(pg_venv)
+
+    return recover_return_code
+
+
+def reset_data(pg_venv, force=False):
+    '''
+    Replace the data directory of a pg_venv by a new one, copied from its
+    initdb template, and restart the server if it was running.
+    If a pg_venv is not provided, reset the data directory of the current one.
+    Unless force is True, a confirmation is asked.
+    '''
+    if pg_venv is None:
+        pg_venv = get_env_var('PG_VENV')
+
+    pg_data_dir = os.path.realpath(get_pg_data(pg_venv))
+
+    if not force:
+        log(
+            'You are about to delete all the data in your database, located in {}. '
+            'Please type its name to confirm:'.format(pg_data_dir),
+            message_type='warning'
+        )
+        if input() != pg_venv:
+            log("The data won't be deleted.", message_type='error')
+            return False
+
+    was_running = pg_is_running(pg_venv)
+    if was_running:
+        stop_return_code = stop(pg_venv)
+        if stop_return_code != 0:
+            return stop_return_code
+
+    # removing the old data takes time, so do it once the server is back
+    old_pg_data_dir = '{}.old.{}'.format(pg_data_dir, os.getpid())
+    if os.path.isdir(pg_data_dir):
+        os.rename(pg_data_dir, old_pg_data_dir)
+
+    reset_return_code = initdb(pg_venv)
+    if reset_return_code == 0 and was_running:
+        reset_return_code = start(pg_venv)
+
+    shutil.rmtree(old_pg_data_dir, ignore_errors=True)
+
+    return reset_return_code
+
+
 def restart(pg_venv):
     '''
     Runs actions stop and start
+    Like start, only returns once the server accepts connections.
     '''
     if pg_is_running(pg_venv):
         stop(pg_venv)
@@ -322,6 +1285,71 @@ def restart(pg_venv):
     return return_code
 
 
+def restore(snapshot_name=None, pg_venv=None):
+    '''
+    Replace the data directory of a pg_venv by a snapshot of it (the latest
+    one by default), and restart the server if it was running
+    If a pg_venv name is not provided, restore the current one.
+
+    btrfs and reflink snapshots are restored in seconds whatever their size,
+    tarballs have to be decompressed.
+    '''
+    if pg_venv is None:
+        pg_venv = get_env_var('PG_VENV')
+
+    snapshots = {s['name']: s for s in get_snapshots(pg_venv)}
+    if not snapshots:
+        log('No snapshot for {}, use `pg snapshot` to take one'.format(pg_venv), 'error')
+        return 1
+    if snapshot_name is None:
+        snapshot_name = max(snapshots.values(), key=lambda s: s['time'])['name']
+    if snapshot_name not in snapshots:
+        log('Snapshot {} does not exist, see `pg list_snapshots`'.format(snapshot_name), 'error')
+        return 1
+
+    snapshot = snapshots[snapshot_name]
+    snapshot_file = os.path.join(get_snapshot_dir(pg_venv, snapshot_name), snapshot['file'])
+    pg_data_dir = os.path.realpath(get_pg_data(pg_venv))
+
+    was_running = pg_is_running(pg_venv)
+    if was_running:
+        stop_return_code = stop(pg_venv)
+        if stop_return_code != 0:
+            return stop_return_code
+
+    # keep the current data until the snapshot is restored, in case it fails
+    old_pg_data_dir = '{}.old.{}'.format(pg_data_dir, os.getpid())
+    if os.path.lexists(pg_data_dir):
+        os.rename(pg_data_dir, old_pg_data_dir)
+
+    # the data directory may have moved to another filesystem since the
+    # snapshot was taken (e.g. to tmpfs), in which case it is copied
+    same_filesystem = os.stat(snapshot_file).st_dev == os.stat(os.path.dirname(pg_data_dir)).st_dev
+    if snapshot['method'] == 'btrfs' and same_filesystem:
+        cmd = 'btrfs subvolume snapshot {} {}'.format(snapshot_file, pg_data_dir)
+    elif snapshot['method'] in ['btrfs', 'reflink']:
+        cmd = 'cp -a --reflink=auto {} {}'.format(snapshot_file, pg_data_dir)
+    else:
+        decompressor = 'zstd' if snapshot_file.endswith('.zst') else 'gzip'
+        cmd = 'mkdir -m 700 {} && tar -x -I {} -f {} -C {}'.format(pg_data_dir, decompressor, snapshot_file, pg_data_dir)
+    restore_return_code = execute_cmd(cmd, 'Restoring snapshot {}'.format(snapshot_name), process_output=False)
+
+    if restore_return_code != 0:
+        remove_data_dir(pg_data_dir)
+        if os.path.lexists(old_pg_data_dir):
+            os.rename(old_pg_data_dir, pg_data_dir)
+        return restore_return_code
+
+    if was_running:
+        restore_return_code = start(pg_venv)
+
+    # removing the old data takes time, so do it once the server is back
+    remove_data_dir(old_pg_data_dir)
+    update_disk_usage(pg_venv, ['data'])
+
+    return restore_return_code
+
+
 def rm_data(pg_venv):
     '''
     Removes the data directory for the specified pg_venv.
@@ -348,10 +1376,37 @@ def rm_data(pg_venv):
             stop(pg_venv)
         cmd = 'rm -r {}/*'.format(pg_data_dir)
         rm_return_code = execute_cmd(cmd, 'Removing all the data')
+        update_disk_usage(pg_venv, ['data'])
 
         return rm_return_code
 
 
+def rm_snapshot(snapshot_name, pg_venv=None):
+    '''
+    Remove a snapshot of a pg_venv's data
+    If a pg_venv name is not provided, remove a snapshot of the current one.
+    '''
+    if pg_venv is None:
+        pg_venv = get_env_var('PG_VENV')
+
+    snapshot_dir = get_snapshot_dir(pg_venv, snapshot_name)
+    if not os.path.isfile(os.path.join(snapshot_dir, 'snapshot.json')):
+        log('Snapshot {} does not exist, see `pg list_snapshots`'.format(snapshot_name), 'error')
+        return 1
+
+    log('Removing snapshot {}... '.format(snapshot_name), end='')
+    # remove the metadata first, so that a partially removed snapshot is not
+    # listed anymore
+    os.unlink(os.path.join(snapshot_dir, 'snapshot.json'))
+    for snapshot_file in os.listdir(snapshot_dir):
+        remove_data_dir(os.path.join(snapshot_dir, snapshot_file))
+    shutil.rmtree(snapshot_dir, ignore_errors=True)
+    log('OK', 'success', prefix=False)
+    update_disk_usage(pg_venv, ['snapshots'])
+
+    return 0
+
+
 def rm_virtualenv(pg_venv):
     '''
     Remove everything about a virtualenv
@@ -395,11 +1450,21 @@ def rm_virtualenv(pg_venv):
         # remove the virtualenv dir
         cmd = 'rm -r {}'.format(pg_venv_dir)
         rm_dir_return_code = execute_cmd(cmd, 'Removing virtualenv data')
+        shutil.rmtree(get_tmpfs_dir(pg_venv), ignore_errors=True)
+        update_index()
 
         # remove the branch in postgres repository
         cmd = 'cd {} && git branch -d {}'.format(pg_dir, pg_venv)
         rm_branch_return_code = execute_cmd(cmd, 'Removing associated postgres branch', process_output=False)
 
+        # remove the installed files no other pg_venv uses. The initdb
+        # templates are kept, they are cheap to keep and costly to check (see
+        # action store_gc).
+        log('Removing unused files from the install store... ', end='')
+        freed = gc_install_store()
+        log('OK', 'success', prefix=False)
+        log('{:.1f} MB freed'.format(freed / 1024 / 1024))
+
         return rm_dir_return_code + rm_worktree_return_code + rm_branch_return_code
 
 
@@ -416,26 +1481,212 @@ def server_log(pg_venv):
     execute_cmd(cmd, 'Displaying server log')
 
 
-def start(pg_venv, exit_on_fail=False):
+def snapshot(snapshot_name=None, pg_venv=None):
+    '''
+    Take a snapshot of the data directory of a pg_venv, that can be restored
+    with the restore action
+    If a pg_venv name is not provided, snapshot the current one.
+    If a snapshot name is not provided, the current date is used.
+
+    The server is stopped while the snapshot is taken, so that the data
+    directory is consistent, and restarted afterwards. See
+    get_snapshot_method for how the snapshot is stored.
+    '''
+    if pg_venv is None:
+        pg_venv = get_env_var('PG_VENV')
+
+    if snapshot_name is None:
+        snapshot_name = time.strftime('%Y%m%d-%H%M%S')
+    if snapshot_name.startswith('.') or os.sep in snapshot_name:
+        log('Invalid snapshot name: {}'.format(snapshot_name), 'error')
+        return 1
+
+    pg_data_dir = os.path.realpath(get_pg_data(pg_venv))
+    snapshot_dir = get_snapshot_dir(pg_venv, snapshot_name)
+    if os.path.lexists(snapshot_dir):
+        log('Snapshot {} already exists, remove it with `pg rm_snapshot {}`'.format(snapshot_name, snapshot_name), 'error')
+        return 1
+    if not os.path.isdir(pg_data_dir) or not os.listdir(pg_data_dir):
+        log('Data directory {} is empty, nothing to snapshot'.format(pg_data_dir), 'error')
+        return 1
+
+    was_running = pg_is_running(pg_venv)
+    if was_running:
+        stop_return_code = stop(pg_venv)
+        if stop_return_code != 0:
+            return stop_return_code
+
+    with open(os.path.join(pg_data_dir, 'PG_VERSION')) as f:
+        pg_data_version = f.read().strip()
+
+    # the snapshot is taken aside, so that it only becomes visible once it's
+    # complete
+    method = get_snapshot_method(pg_venv)
+    tmp_snapshot_dir = os.path.join(get_snapshots_dir(pg_venv), '.{}.{}.tmp'.format(snapshot_name, os.getpid()))
+    os.makedirs(tmp_snapshot_dir)
+
+    if method == 'btrfs':
+        snapshot_file = 'data'
+        cmd = 'btrfs subvolume snapshot {} {}'.format(pg_data_dir, os.path.join(tmp_snapshot_dir, snapshot_file))
+    elif method == 'reflink':
+        snapshot_file = 'data'
+        cmd = 'cp -a --reflink=always {} {}'.format(pg_data_dir, os.path.join(tmp_snapshot_dir, snapshot_file))
+    else:
+        compressor, extension = get_snapshot_compressor()
+        snapshot_file = 'data.{}'.format(extension)
+        cmd = "tar -c -I '{}' -f {} -C {} .".format(compressor, os.path.join(tmp_snapshot_dir, snapshot_file), pg_data_dir)
+    snapshot_return_code = execute_cmd(cmd, 'Taking snapshot {} ({})'.format(snapshot_name, method), process_output=False)
+
+    if was_running:
+        start(pg_venv)
+
+    if snapshot_return_code != 0:
+        remove_data_dir(os.path.join(tmp_snapshot_dir, snapshot_file))
+        shutil.rmtree(tmp_snapshot_dir, ignore_errors=True)
+        return snapshot_return_code
+
+    with open(os.path.join(tmp_snapshot_dir, 'snapshot.json'), 'w') as f:
+        json.dump({
+            'name': snapshot_name,
+            'time': int(time.time()),
+            'method': method,
+            'file': snapshot_file,
+            'pg_version': pg_data_version,
+            'bytes': scan_disk_usage(tmp_snapshot_dir)[0],
+        }, f, indent=4)
+    os.rename(tmp_snapshot_dir, snapshot_dir)
+    update_disk_usage(pg_venv, ['snapshots'])
+
+    return 0
+
+
+def start(pg_venv, exit_on_fail=False, wait=True, timeout=None):
     '''
     Start a postgresql instance
     If a pg_venv name is not provided, start the current one.
+
+    If wait is True, only return once the server accepts connections, or
+    after timeout seconds (PG_READY_TIMEOUT by default), in which case the
+    start is considered failed.
     '''
     if pg_venv is None:
         pg_venv = get_env_var('PG_VENV')
 
-    # start postgresql
-    cmd = '{} start -D {} -l {} --core-files -o "-p {}"'.format(
-        os.path.join(get_pg_bin(pg_venv), 'pg_ctl'),
-        get_pg_data(pg_venv),
-        get_pg_log(pg_venv),
-        get_pg_port(pg_venv)
-    )
-    start_return_code = execute_cmd(cmd, 'Starting PostgreSQL', process_output=False, exit_on_fail=exit_on_fail)
+    recover_return_code = recover_tmpfs(pg_venv, ['data'])
+    if recover_return_code != 0:
+        if exit_on_fail:
+            raise PgVenvError('the data directory of {} could not be recovered'.format(pg_venv))
+        return recover_return_code
+
+    if timeout is None:
+        timeout = float(os.environ.get('PG_READY_TIMEOUT', 60))
+
+    # start and stop are run in loops by scripts, they don't go through the
+    # Python API, which needs asyncio, slow to import
+    cmd, pg_ctl_waits = get_pg_ctl_start_cmd(pg_venv, wait, timeout)
+    start_return_code = execute_cmd(' '.join(shlex.quote(arg) for arg in cmd), 'Starting PostgreSQL', process_output=False, exit_on_fail=exit_on_fail)
+
+    if start_return_code == 0 and wait and not pg_ctl_waits:
+        log('Waiting for PostgreSQL to accept connections... ', end='')
+        if wait_for_pg_ready(pg_venv, timeout=timeout):
+            log('OK', 'success', prefix=False)
+        else:
+            log('failed', 'error')
+            log('PostgreSQL did not accept connections after {}s, see {}'.format(timeout, get_pg_log(pg_venv)), 'error')
+            if exit_on_fail:
+                raise PgVenvError('{} did not accept connections after {}s'.format(pg_venv, timeout))
+            start_return_code = 1
+
+    update_index([pg_venv])
 
     return start_return_code
 
 
+def stats(pg_venv=None, commands=False, last=5):
+    '''
+    Show how long the actions run on a pg_venv took, and their phases (see
+    timed), with the durations of their last runs to see the trends, and
+    the breakdown of the last run of each action
+    If a pg_venv name is not provided, show the ones of the current one.
+    If commands is True, the commands run by the actions are shown too.
+    '''
+    if pg_venv is None:
+        pg_venv = get_env_var('PG_VENV')
+
+    kinds = ['action', 'phase'] + (['command'] if commands else [])
+    timings = [t for t in read_timings(pg_venv) if t['kind'] in kinds]
+    if not timings:
+        log('No timing recorded for {}'.format(pg_venv))
+        return 0
+
+    # group the timings by action and phase, in the order they first appear
+    groups = {}
+    for timing in timings:
+        key = (timing['action'], timing['phase'], timing['kind'])
+        groups.setdefault(key, []).append(timing)
+
+    name_column_size = max(len(phase) + (2 if kind != 'action' else 0) for _, phase, kind in groups) + 4
+    format_str = '{:<' + str(name_column_size) + '}{:>6}{:>10}{:>10}{:>10}{:>10}{:>10}{:>10}    {}'
+    print(format_str.format('ACTION/PHASE', 'RUNS', 'LAST', 'MEDIAN', 'BEST', 'USER', 'SYS', 'MAX RSS', 'LAST {} RUNS'.format(last)))
+
+    for action in dict.fromkeys(action for action, _, _ in groups):
+        action_groups = sorted(
+            [(key, group) for key, group in groups.items() if key[0] == action],
+            key=lambda item: kinds.index(item[0][2]),
+        )
+        for (_, phase, kind), group in action_groups:
+            walls = sorted(t['wall'] for t in group)
+            print(format_str.format(
+                phase if kind == 'action' else '  ' + phase,
+                len(group),
+                format_duration(group[-1]['wall']),
+                format_duration(percentile(walls, 50)),
+                format_duration(walls[0]),
+                *[format_duration(group[-1][k]) if group[-1][k] is not None else '-' for k in ['user', 'sys']],
+                format_size(group[-1]['max_rss']) if group[-1]['max_rss'] is not None else '-',
+                ' '.join(format_duration(t['wall']) for t in group[-last:]),
+            ))
+
+    # what the last run of each action with phases spent its time on
+    for action in dict.fromkeys(action for action, _, kind in groups if kind == 'action'):
+        last_run = [t for t in timings if t['action'] == action][-1]['run']
+        phases = [t for t in timings if t['run'] == last_run and t['kind'] == 'phase']
+        if phases:
+            log('Last {}: {}'.format(action, ', '.join('{} {}'.format(t['phase'], format_duration(t['wall'])) for t in phases)))
+
+    return 0
+
+
+def status(pg_venv=None):
+    '''
+    Show the state of a pg_venv, and its jobs if pg_venvd is running (see
+    pg_venvd.py)
+    If a pg_venv name is not provided, show the one of the current one.
+    '''
+    import api
+
+    if pg_venv is None:
+        pg_venv = get_env_var('PG_VENV')
+
+    try:
+        pg_venv_info = api.status(pg_venv)
+    except PgVenvError as e:
+        log(str(e), 'error')
+        return 1
+
+    print('pg_venv:    {}'.format(pg_venv))
+    print('port:       {}'.format(pg_venv_info['port']))
+    print('version:    {}'.format(pg_venv_info['version'] or '-'))
+    print('running:    {}'.format('yes' if pg_venv_info['running'] else 'no'))
+    print('disk usage: {}'.format(pg_venv_info['disk_usage']))
+    if pg_venv_info['jobs'] is not None:
+        print('build:      {}'.format(pg_venv_info['build'] or '-'))
+        for job in pg_venv_info['jobs']:
+            print('job {}:      {} ({})'.format(job['id'], ' '.join(job['argv']), job['state']))
+
+    return 0
+
+
 def stop(pg_venv):
     '''
     Stop a postgresql instance
@@ -446,14 +1697,90 @@ def stop(pg_venv):
 
     pg_ctl = os.path.join(get_pg_bin(pg_venv), 'pg_ctl')
     pg_data_dir = get_pg_data(pg_venv)
-    cmd = '{} stop -D {}'.format(pg_ctl, pg_data_dir)
+    cmd = '{} stop -D {}'.format(shlex.quote(pg_ctl), shlex.quote(pg_data_dir))
 
-    # stop postgresql
+    # stop postgresql, without going through the Python API (see start)
     stop_return_code = execute_cmd(cmd, 'Stopping PostgreSQL', process_output=False)
 
+    update_index([pg_venv])
+
     return stop_return_code
 
 
+def store_gc():
+    '''
+    Remove the files of the install store that are not used by any pg_venv,
+    and the initdb templates that can't be used by any pg_venv
+    '''
+    log('Removing unused files from the install store... ', end='')
+    freed = gc_install_store()
+    log('OK', 'success', prefix=False)
+
+    log('Removing unused initdb templates... ', end='')
+    freed += gc_initdb_templates()
+    log('OK', 'success', prefix=False)
+    log('{:.1f} MB freed'.format(freed / 1024 / 1024))
+
+    return 0
+
+
+def submit_job(argv, pg_venv):
+    '''
+    Have pg_venvd run pg_venv.py with the arguments argv as a job, after the
+    other jobs of pg_venv (see pg_venvd.py), instead of running it now
+    '''
+    answer = daemon_request('submit', argv=argv, pg_venv=pg_venv, env=dict(os.environ), cwd=os.getcwd())
+    if answer is None:
+        log('pg_venvd is not running, start it with pg_venvd.py', 'error')
+        return 1
+
+    job = answer['job']
+    log('Job {} submitted, run `pg jobs` to see its state, and `pg jobs {}` its output'.format(job['id'], job['id']), 'success')
+
+    return 0
+
+
+def tmpfs(pg_venv, off=False, build=False):
+    '''
+    Move the data directory of a pg_venv to tmpfs, and its build directory too
+    if build is True (meson only), or move them back to disk if off is True
+    If a pg_venv name is not provided, move the ones of the current one.
+
+    Directories on tmpfs are lost on reboot, they are recovered by start and
+    the build actions (see recover_tmpfs).
+    '''
+    if pg_venv is None:
+        pg_venv = get_env_var('PG_VENV')
+
+    if off:
+        components = get_pg_metadata(pg_venv).get('tmpfs', [])
+    else:
+        components = ['data'] + (['build'] if build else [])
+
+    if 'build' in components and not off and get_build_system(pg_venv) != 'meson':
+        log('Only the build directory of meson can be on tmpfs', 'error')
+        return 1
+
+    was_running = pg_is_running(pg_venv)
+    if was_running and 'data' in components:
+        stop_return_code = stop(pg_venv)
+        if stop_return_code != 0:
+            return stop_return_code
+
+    for component in components:
+        log('Moving the {} directory {}... '.format(component, 'back to disk' if off else 'to tmpfs'), end='')
+        set_tmpfs(pg_venv, component, not off)
+        log('OK', 'success', prefix=False)
+
+    tmpfs_return_code = 0
+    if was_running and 'data' in components:
+        tmpfs_return_code = start(pg_venv)
+
+    update_disk_usage(pg_venv, ['data', 'build'])
+
+    return tmpfs_return_code
+
+
 def workon(pg_venv):
     '''
     Print commands to set PG_VENV, PATH, PGDATA, LD_LIBRARY_PATH, PGPORT.
@@ -462,6 +1789,9 @@ def workon(pg_venv):
     There is a default value for args even though the parameter is mandatory,
     because we want to exit gracefully (since the output of this function is
     sourced).
+
+    The shell function (see get_shell_function) sources the activation script
+    of the pg_venv instead, if it exists.
     '''
     try:
         # raise an exception if the desired virtualenv does not exist
@@ -515,6 +1845,11 @@ def workon(pg_venv):
         pg_src = get_pg_src(pg_venv)
         output += 'export PG_SRC={}\n'.format(pg_src)
 
+        # the activation script is missing (pg_venv created by an older
+        # version) or was removed, so that the next calls don't need python
+        if not os.path.isfile(get_activation_script(pg_venv)):
+            write_activation_script(pg_venv)
+
     except Exception as e:
         output = 'echo -e "\033[0;31m{}\033[0;m"'.format(e)
 
@@ -522,19 +1857,37 @@ def workon(pg_venv):
 
 
 ACTIONS = {
-    'configure': Action('configure', configure, "Run configure on postgresql's source"),
+    'bench': Action('bench', bench, 'Run pgbench and record the results'),
+    'bench_report': Action('bench_report', bench_report, 'Show the results of the last benchmarks', timed=False),
+    'build': Action('build', build, 'Compile and install postgresql', locked=True),
+    'ccache_stats': Action('ccache_stats', ccache_stats, 'Show compiler cache statistics', timed=False),
+    'compare': Action('compare', compare, 'Compare the performance of two pg_venvs'),
+    'configure': Action('configure', configure, "Run configure on postgresql's source", locked=True),
     'create_virtualenv': Action('create_virtualenv', create_virtualenv, 'Create a new pg_venv'),
-    'get_shell_function': Action('get_shell_function', get_shell_function, 'Get the shell function to source'),
-    'install': Action('install', install, "Install posgresql's binaries"),
-    'list': Action('list', list_pg_venv, 'List active and inactive pg_venv'),
-    'log': Action('log', server_log, 'Display the server log', alias='l'),
-    'make': Action('make', make, 'Compile postgresql'),
-    'make_check': Action('make_check', make_check, "Run make check on postgres' source"),
-    'make_clean': Action('make_clean', make_clean, "Run make clean on postgresql's source"),
-    'restart': Action('restart', restart, 'Restart postgresql'),
-    'rm_data': Action('rm_data', rm_data, "Remove postgresql's data directory"),
+    'disk_usage': Action('disk_usage', disk_usage, 'Show the disk usage of a pg_venv', timed=False),
+    'get_shell_function': Action('get_shell_function', get_shell_function, 'Get the shell function to source', timed=False),
+    'install': Action('install', install, "Install posgresql's binaries", locked=True),
+    'jobs': Action('jobs', jobs, 'List the jobs of pg_venvd', timed=False),
+    'list': Action('list', list_pg_venv, 'List active and inactive pg_venv', timed=False),
+    'list_snapshots': Action('list_snapshots', list_snapshots, "List the snapshots of postgresql's data directory", timed=False),
+    'log': Action('log', server_log, 'Display the server log', alias='l', timed=False),
+    'make': Action('make', make, 'Compile postgresql', locked=True),
+    'make_check': Action('make_check', make_check, "Run make check on postgres' source", locked=True),
+    'make_clean': Action('make_clean', make_clean, "Run make clean on postgresql's source", locked=True),
+    'perf_bisect': Action('perf_bisect', perf_bisect, 'Find the commit that made a workload slower'),
+    'profile': Action('profile', profile, 'Apply a configuration profile to postgresql', locked=True),
+    'reset_data': Action('reset_data', reset_data, "Replace postgresql's data directory by a new one", locked=True),
+    'restart': Action('restart', restart, 'Restart postgresql', locked=True),
+    'restore': Action('restore', restore, "Restore a snapshot of postgresql's data directory", locked=True),
+    'rm_data': Action('rm_data', rm_data, "Remove postgresql's data directory", locked=True),
+    'rm_snapshot': Action('rm_snapshot', rm_snapshot, "Remove a snapshot of postgresql's data directory", locked=True),
     'rm_virtualenv': Action('rm_virtualenv', rm_virtualenv, 'Remove a pg_venv'),
-    'start': Action('start', start, 'Start postgresql'),
-    'stop': Action('stop', stop, 'Stop postgresql'),
-    'workon': Action('workon', workon, 'Activate a pg_venv', alias='w'),
+    'snapshot': Action('snapshot', snapshot, "Take a snapshot of postgresql's data directory", locked=True),
+    'start': Action('start', start, 'Start postgresql', locked=True),
+    'stats': Action('stats', stats, 'Show how long the actions took', timed=False),
+    'status': Action('status', status, 'Show the state of a pg_venv', timed=False),
+    'stop': Action('stop', stop, 'Stop postgresql', locked=True),
+    'store_gc': Action('store_gc', store_gc, 'Remove unused files from the install store'),
+    'tmpfs': Action('tmpfs', tmpfs, "Move postgresql's data directory to tmpfs", locked=True),
+    'workon': Action('workon', workon, 'Activate a pg_venv', alias='w', timed=False),
 }
@@ -0,0 +1,453 @@
+'''
+Python API of pg_venv, to orchestrate pg_venvs from scripts (e.g. build a
+few branches concurrently, then benchmark them)
+
+The functions run in the current process, and return their results as
+dicts. They don't display anything (unless verbose is True), and raise
+PgVenvError when they can't go on, or CommandError when a command fails,
+with the end of its output and the log file where the rest of it is.
+
+Every function has an asyncio variant, suffixed with _async, that runs the
+commands (make, pg_ctl, pgbench...) with asyncio.create_subprocess_exec, so
+that one event loop can drive several pg_venvs, e.g.:
+
+    await asyncio.gather(*[api.build_async(pg_venv) for pg_venv in pg_venvs])
+
+Different pg_venvs can be driven concurrently, not the same one. What
+blocks besides the commands (hashing the installed files, scanning the disk
+usage, waiting for a lock...) runs in threads (see run_in_thread), so that a
+pg_venv doesn't stall the others.
+The actions of pg_venv.py are built on these functions (see actions.py), and
+format their results.
+
+The API works on existing pg_venvs: creating and configuring them is only
+done by the actions (`pg create_virtualenv`, `pg configure`).
+'''
+
+import asyncio
+import contextvars
+import functools
+import os
+import shlex
+import shutil
+import subprocess
+import time
+
+from utils import BENCH_WORKLOADS, CommandError, PgVenvError, available_pg_venvs, build_slot_async, daemon_request, estimate_compilation_duration, execute_cmd_async, get_build_cmd, get_build_env, get_build_phase_log, get_build_system, get_ccache_stats_log, get_host_info, get_lost_tmpfs_components, get_pg_bin, get_pg_build_dir, get_pg_ctl_start_cmd, get_pg_data, get_pg_log, get_pg_metadata, get_pg_port, get_pg_src, get_pg_venv_dir, get_pg_venvs_info, get_pg_version, histogram_percentile, install_from_staging_dir, install_store_enabled, parse_pgbench_output, pg_is_running, pg_virtualenv_exists, read_build_phase_log, read_ccache_stats_log, read_pgbench_latencies, record_bench_run, record_ccache_build, update_disk_usage, update_index, update_pg_metadata, wait_for_pg_ready_async
+
+
+def check_pg_venv(pg_venv, tmpfs_components=()):
+    '''
+    Raise PgVenvError if pg_venv doesn't exist, or if some of its
+    tmpfs_components were on tmpfs and have been lost (they are recovered by
+    the actions of pg_venv.py, see actions.recover_tmpfs)
+    '''
+    if not pg_venv or not pg_virtualenv_exists(pg_venv):
+        raise PgVenvError('This virtualenv does not exist: {}'.format(pg_venv))
+
+    for component in get_lost_tmpfs_components(pg_venv, tmpfs_components):
+        raise PgVenvError('The {} directory of {} on tmpfs was lost, run `pg start {}` to recover it'.format(component, pg_venv, pg_venv))
+
+
+async def run_in_thread(function, *args, **kwargs):
+    '''
+    Run a function that blocks (disk walk, hashes, locks, subprocess...) in a
+    thread, in the current context (see utils.timed), without blocking the
+    event loop, and return its result
+    '''
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(None, functools.partial(context.run, function, *args, **kwargs))
+
+
+async def run_build_async(pg_venv, cmds, cmd_description, compiles=True, installs=False, verbose=False):
+    '''
+    Run commands (lists of arguments) that compile, install or test
+    postgresql, one after the other, in the source dir of a pg_venv
+
+    The commands wait for their turn in the build scheduler shared by all the
+    pg_venvs, and get the environment the compiler cache and the shared job
+    pool need. If they install files, they go through the install store
+    (unless PG_INSTALL_STORE=0). Once they are done, the ccache statistics,
+    the built commit and the duration of each build phase are recorded in
+    the pg_venv's metadata.
+    If verbose is True, the wait for the build scheduler and the progress of
+    the compilation are displayed.
+
+    Returns a dict with keys pg_venv, duration (in seconds), build_commit (if
+    the commands compiled postgresql), installed_files (the number of files
+    linked from the install store, None if it wasn't used), ccache (hits,
+    misses, uncacheable and the estimated seconds saved, None if ccache isn't
+    used) and phases (see read_build_phase_log).
+    '''
+    check_pg_venv(pg_venv, ['build'])
+
+    env = get_build_env(pg_venv) or {}
+
+    ccache_used = compiles and get_pg_metadata(pg_venv).get('ccache', False)
+    if ccache_used and os.path.isfile(get_ccache_stats_log(pg_venv)):
+        ccache_stats_offset = os.path.getsize(get_ccache_stats_log(pg_venv))
+    else:
+        ccache_stats_offset = 0
+
+    staging_dir = None
+    if installs and install_store_enabled():
+        staging_dir = os.path.join(get_pg_venv_dir(pg_venv), 'install_staging')
+        if os.path.isdir(staging_dir):
+            await run_in_thread(shutil.rmtree, staging_dir)
+        env['DESTDIR'] = staging_dir
+
+    if os.path.isfile(get_build_phase_log(pg_venv)):
+        os.unlink(get_build_phase_log(pg_venv))
+
+    result = {
+        'pg_venv': pg_venv,
+        'duration': None,
+        'build_commit': None,
+        'installed_files': None,
+        'ccache': None,
+        'phases': [],
+    }
+    start_time = time.monotonic()
+    try:
+        async with build_slot_async(pg_venv, verbose) as (jobserver_env, jobserver_fds):
+            env.update(jobserver_env)
+            start_time = time.monotonic()
+            for cmd in cmds:
+                await execute_cmd_async(cmd, cmd_description, pg_venv, env=env, cwd=get_pg_src(pg_venv), pass_fds=jobserver_fds, progress=verbose)
+            result['duration'] = round(time.monotonic() - start_time, 3)
+
+        if staging_dir is not None:
+            manifest = await run_in_thread(install_from_staging_dir, pg_venv, staging_dir)
+            result['installed_files'] = len(manifest['files'])
+
+        if compiles:
+            cmd = ['git', 'rev-parse', 'HEAD']
+            result['build_commit'] = (await run_in_thread(subprocess.check_output, cmd, cwd=get_pg_src(pg_venv))).strip().decode('utf-8')
+            await run_in_thread(update_pg_metadata, pg_venv, build_commit=result['build_commit'])
+    finally:
+        if staging_dir is not None:
+            await run_in_thread(shutil.rmtree, staging_dir, ignore_errors=True)
+
+        await run_in_thread(update_disk_usage, pg_venv, (['build'] if compiles else []) + (['install'] if installs else []))
+        if installs:
+            # the version shown by the completion and action list may change
+            await run_in_thread(update_index, [pg_venv])
+
+        if ccache_used:
+            stats = await run_in_thread(read_ccache_stats_log, pg_venv, ccache_stats_offset)
+            builds = await run_in_thread(record_ccache_build, pg_venv, stats, time.monotonic() - start_time)
+            compilation_duration = estimate_compilation_duration(builds)
+            result['ccache'] = dict(stats, saved=round(stats['hits'] * compilation_duration) if compilation_duration else None)
+
+        result['phases'] = read_build_phase_log(pg_venv)
+        if result['phases']:
+            await run_in_thread(update_pg_metadata, pg_venv, build_phases=result['phases'])
+
+    return result
+
+
+async def build_async(pg_venv, make_args=(), docs=False, install=True, verbose=False):
+    '''
+    Compile postgresql, contrib, and the documentation if docs is True, and
+    install them unless install is False (see `pg build`)
+
+    Returns the result of the build, see run_build_async.
+    '''
+    check_pg_venv(pg_venv)
+
+    if get_build_system(pg_venv) == 'meson':
+        if docs:
+            make_args = list(make_args) + ['all', 'docs']
+        result = await make_async(pg_venv, make_args, verbose)
+        if install:
+            install_result = await install_async(pg_venv, verbose)
+            result['duration'] += install_result['duration']
+            result['installed_files'] = install_result['installed_files']
+
+        return result
+
+    targets = ['core', 'contrib'] + (['docs'] if docs else [])
+    if install:
+        targets += ['{}-install'.format(t) for t in targets]
+    cmd = shlex.split(await run_in_thread(get_build_cmd, pg_venv, targets, ' '.join(make_args)))
+    description = 'Compiling and installing PostgreSQL' if install else 'Compiling PostgreSQL'
+
+    return await run_build_async(pg_venv, [cmd], description, installs=install, verbose=verbose)
+
+
+def build(pg_venv, make_args=(), docs=False, install=True, verbose=False):
+    return asyncio.run(build_async(pg_venv, make_args, docs, install, verbose))
+
+
+async def make_async(pg_venv, make_args=(), verbose=False):
+    '''
+    Compile postgresql and contrib, with make, or ninja if the pg_venv uses
+    meson (see `pg make`)
+
+    Returns the result of the build, see run_build_async.
+    '''
+    check_pg_venv(pg_venv)
+
+    make_args = list(make_args)
+    if get_build_system(pg_venv) == 'meson':
+        # ninja builds contrib too
+        cmds = [['ninja', '-C', get_pg_build_dir(pg_venv)] + make_args]
+    elif all(arg.startswith('-') for arg in make_args):
+        cmds = [shlex.split(await run_in_thread(get_build_cmd, pg_venv, ['core', 'contrib'], ' '.join(make_args)))]
+    else:
+        cmds = [['make', '-s'] + make_args, ['make', '-C', 'contrib', '-s'] + make_args]
+
+    return await run_build_async(pg_venv, cmds, 'Compiling PostgreSQL', verbose=verbose)
+
+
+def make(pg_venv, make_args=(), verbose=False):
+    return asyncio.run(make_async(pg_venv, make_args, verbose))
+
+
+async def install_async(pg_venv, verbose=False):
+    '''
+    Install postgresql and contrib (see `pg install`)
+
+    Returns the result of the build, see run_build_async.
+    '''
+    check_pg_venv(pg_venv)
+
+    if get_build_system(pg_venv) == 'meson':
+        cmd = ['meson', 'install', '-C', get_pg_build_dir(pg_venv), '--quiet']
+    else:
+        cmd = shlex.split(await run_in_thread(get_build_cmd, pg_venv, ['core-install', 'contrib-install']))
+
+    return await run_build_async(pg_venv, [cmd], 'Installing PostgreSQL', compiles=False, installs=True, verbose=verbose)
+
+
+def install(pg_venv, verbose=False):
+    return asyncio.run(install_async(pg_venv, verbose))
+
+
+async def make_check_async(pg_venv, verbose=False):
+    '''
+    Run the regression tests of a pg_venv (see `pg make_check`)
+
+    Returns the result of the build, see run_build_async. A failed test
+    raises CommandError.
+    '''
+    check_pg_venv(pg_venv)
+
+    if get_build_system(pg_venv) == 'meson':
+        cmd = ['meson', 'test', '-C', get_pg_build_dir(pg_venv), '-q', '--print-errorlogs', '--suite', 'setup', '--suite', 'regress']
+    else:
+        cmd = ['make', '-s', 'check']
+
+    return await run_build_async(pg_venv, [cmd], 'Running make check', compiles=False, verbose=verbose)
+
+
+def make_check(pg_venv, verbose=False):
+    return asyncio.run(make_check_async(pg_venv, verbose))
+
+
+async def start_async(pg_venv, wait=True, timeout=None):
+    '''
+    Start the server of a pg_venv (see `pg start`)
+
+    If wait is True, only return once the server accepts connections, or
+    raise PgVenvError after timeout seconds (PG_READY_TIMEOUT by default).
+
+    Returns a dict with keys pg_venv, port, duration (in seconds) and
+    server_log.
+    '''
+    check_pg_venv(pg_venv, ['data'])
+
+    if timeout is None:
+        timeout = float(os.environ.get('PG_READY_TIMEOUT', 60))
+
+    # the version of the pg_venv comes from pg_config
+    cmd, pg_ctl_waits = await run_in_thread(get_pg_ctl_start_cmd, pg_venv, wait, timeout)
+    start_time = time.monotonic()
+    try:
+        await execute_cmd_async(cmd, 'Starting PostgreSQL', pg_venv)
+        if wait and not pg_ctl_waits and not await wait_for_pg_ready_async(pg_venv, timeout):
+            raise PgVenvError('PostgreSQL did not accept connections after {}s, see {}'.format(timeout, get_pg_log(pg_venv)))
+    finally:
+        await run_in_thread(update_index, [pg_venv])
+
+    return {
+        'pg_venv': pg_venv,
+        'port': get_pg_port(pg_venv),
+        'duration': round(time.monotonic() - start_time, 3),
+        'server_log': get_pg_log(pg_venv),
+    }
+
+
+def start(pg_venv, wait=True, timeout=None):
+    return asyncio.run(start_async(pg_venv, wait, timeout))
+
+
+async def stop_async(pg_venv):
+    '''
+    Stop the server of a pg_venv (see `pg stop`)
+
+    Returns a dict with keys pg_venv and duration (in seconds).
+    '''
+    check_pg_venv(pg_venv)
+
+    cmd = [os.path.join(get_pg_bin(pg_venv), 'pg_ctl'), 'stop', '-D', get_pg_data(pg_venv)]
+    try:
+        result = await execute_cmd_async(cmd, 'Stopping PostgreSQL', pg_venv)
+    finally:
+        await run_in_thread(update_index, [pg_venv])
+
+    return {'pg_venv': pg_venv, 'duration': result['duration']}
+
+
+def stop(pg_venv):
+    return asyncio.run(stop_async(pg_venv))
+
+
+async def restart_async(pg_venv, wait=True, timeout=None):
+    '''
+    Stop the server of a pg_venv if it is running, and start it (see
+    start_async)
+    '''
+    if pg_virtualenv_exists(pg_venv) and pg_is_running(pg_venv):
+        await stop_async(pg_venv)
+
+    return await start_async(pg_venv, wait, timeout)
+
+
+def restart(pg_venv, wait=True, timeout=None):
+    return asyncio.run(restart_async(pg_venv, wait, timeout))
+
+
+async def bench_async(pg_venv, workload='tpcb-like', scale=1, clients=1, threads=1, duration=60, init=False, record=True):
+    '''
+    Run pgbench against a pg_venv, in database pgbench, and return the
+    result of the run as a dict with the columns of the results database (see
+    open_bench_db), and its id in it if it was recorded
+
+    workload is one of pgbench's built-in scripts (see BENCH_WORKLOADS), or
+    the path of a custom script, recorded as an absolute path. The database
+    is initialized with pgbench -i if it doesn't exist or hasn't the right
+    scale, or if init is True. The server is started if needed. Unless
+    record is False, the result is stored in the results database, along
+    with what describes the pg_venv and the machine.
+    '''
+    import tempfile
+
+    check_pg_venv(pg_venv)
+
+    custom_script = workload not in BENCH_WORKLOADS
+    if custom_script:
+        workload = os.path.abspath(workload)
+        if not os.path.isfile(workload):
+            raise PgVenvError('Unknown workload {}, it is neither a built-in one ({}) nor a script'.format(workload, ', '.join(BENCH_WORKLOADS)))
+
+    if not pg_is_running(pg_venv):
+        await start_async(pg_venv)
+
+    pg_bin = get_pg_bin(pg_venv)
+    pg_port = str(get_pg_port(pg_venv))
+
+    # pgbench_branches has one row per scale unit
+    cmd = [os.path.join(pg_bin, 'psql'), '-p', pg_port, '-Atc', 'SELECT count(*) FROM pgbench_branches', 'pgbench']
+    try:
+        current_scale = int((await execute_cmd_async(cmd, 'Reading the scale of the pgbench database', pg_venv))['output'])
+    except (CommandError, ValueError):
+        current_scale = None
+
+    if current_scale is None:
+        try:
+            await execute_cmd_async([os.path.join(pg_bin, 'createdb'), '-p', pg_port, 'pgbench'], 'Creating the pgbench database', pg_venv)
+        except CommandError:
+            # the database exists, but hasn't been initialized
+            pass
+    if init or (current_scale != scale and not custom_script):
+        cmd = [os.path.join(pg_bin, 'pgbench'), '-p', pg_port, '-i', '-q', '-s', str(scale), 'pgbench']
+        await execute_cmd_async(cmd, 'Initializing the pgbench database', pg_venv)
+
+    workload_options = {
+        'select-only': ['-S'],
+        'simple-update': ['-N'],
+        'tpcb-like': [],
+    }.get(workload, ['-n', '-f', workload])
+
+    with tempfile.TemporaryDirectory(prefix='pg_bench.') as log_dir:
+        # only a sample of the transactions is logged, logging all of them
+        # would slow the run down
+        cmd = [
+            os.path.join(pg_bin, 'pgbench'),
+            '-p', pg_port,
+            *workload_options,
+            '-c', str(clients),
+            '-j', str(threads),
+            '-T', str(duration),
+            '--log',
+            '--sampling-rate={}'.format(float(os.environ.get('PG_BENCH_SAMPLING_RATE', 0.01))),
+            '--log-prefix={}'.format(os.path.join(log_dir, 'pgbench_log')),
+            'pgbench',
+        ]
+        # the summary pgbench prints at the end is parsed
+        output = (await execute_cmd_async(cmd, 'Running pgbench', pg_venv, tail_lines=100))['output']
+        latencies = await run_in_thread(read_pgbench_latencies, log_dir)
+
+    metadata = get_pg_metadata(pg_venv)
+    run = dict(
+        time=int(time.time()),
+        pg_venv=pg_venv,
+        pg_version=await run_in_thread(get_pg_version, pg_venv),
+        git_commit=metadata.get('build_commit'),
+        configure_options=metadata.get('configure_options'),
+        conf_profile=metadata.get('conf_profile'),
+        workload=workload,
+        scale=scale if not custom_script else current_scale,
+        clients=clients,
+        threads=threads,
+        duration=duration,
+        latency_p50=histogram_percentile(latencies, 50),
+        latency_p90=histogram_percentile(latencies, 90),
+        latency_p99=histogram_percentile(latencies, 99),
+        **parse_pgbench_output(output),
+        **await run_in_thread(get_host_info)
+    )
+    if record:
+        run['id'] = await run_in_thread(record_bench_run, run)
+
+    return run
+
+
+def bench(pg_venv, workload='tpcb-like', scale=1, clients=1, threads=1, duration=60, init=False, record=True):
+    return asyncio.run(bench_async(pg_venv, workload, scale, clients, threads, duration, init, record))
+
+
+def list_pg_venvs():
+    '''
+    Return the information about all the pg_venvs, as dicts with keys
+    pg_venv, port, version, running and disk_usage (and build if pg_venvd is
+    running, see pg_venvd.py)
+    '''
+    answer = daemon_request('list')
+    if answer is not None:
+        return answer['pg_venvs']
+    return get_pg_venvs_info(available_pg_venvs())
+
+
+async def list_pg_venvs_async():
+    return await run_in_thread(list_pg_venvs)
+
+
+def status(pg_venv):
+    '''
+    Return the information about a pg_venv (see list_pg_venvs), with a key
+    jobs listing its jobs if pg_venvd is running (None otherwise)
+    '''
+    check_pg_venv(pg_venv)
+
+    answer = daemon_request('status', pg_venv=pg_venv)
+    if answer is not None and 'error' in answer:
+        raise PgVenvError(answer['error'])
+    elif answer is not None:
+        return dict(answer['pg_venv'], jobs=answer['jobs'])
+    return dict(get_pg_venvs_info([pg_venv])[0], jobs=None)
+
+
+async def status_async(pg_venv):
+    return await run_in_thread(status, pg_venv)
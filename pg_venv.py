@@ -4,8 +4,8 @@ import argparse
 import os
 import sys
 
-from actions import ACTIONS
-from utils import available_pg_venvs, get_env_var, log
+from actions import ACTIONS, Action, run_bulk, submit_job
+from utils import CONF_PROFILES, PgVenvError, get_env_var, indexed_pg_venvs, log, pg_virtualenv_exists
 
 
 USAGE = '''
@@ -15,21 +15,130 @@ Usage:
     pg create_virtualenv <pg_venv>
     pg workon <pg_venv>
     pg <action> [args]
+    pg <action> [--all] [--running] [--match <pattern>] [--parallel <n>] [args]
+
+Actions install, make, make_check, restart, start and stop can run on several
+pg_venvs at once: all of them with --all, or the ones whose name matches a glob
+pattern with --match (start, stop and restart also take a pattern as
+<pg_venv>), and whose server is running with --running. The pg_venvs are
+handled by at most --parallel processes at the same time (default:
+PG_BULK_PARALLEL), the output of each one goes to its logs/bulk-<action>.log,
+and a summary of the results and durations is shown at the end.
+The actions that change a pg_venv (e.g. start, make, snapshot) wait for the
+other ones running on the same pg_venv to be done.
 
 Actions:
+    bench:
+        pg bench [--workload <workload>] [--scale <scale>] [--clients <clients>]
+                 [--threads <threads>] [--duration <duration>] [--init]
+                 [<pg_venv> ...]
+
+        <pg_venv>: which instances to benchmark (default: the current one)
+        --workload: one of pgbench's built-in scripts (tpcb-like,
+        simple-update, select-only), or the path of a custom script
+        (default: tpcb-like)
+        --scale: scale of the pgbench database (default: 1)
+        --clients, --threads: number of clients and of pgbench threads
+        (default: 1)
+        --duration: duration of the run, in seconds (default: 60)
+        --init: initialize the pgbench database again
+
+        Run pgbench against each pg_venv, in database pgbench, starting the
+        server if needed. The database is initialized with the right scale
+        if needed. The TPS and the latency percentiles of each run are stored
+        in $PG_VIRTUALENV_HOME/.bench.sqlite, along with the commit,
+        configure options and configuration profile of the pg_venv, and a
+        description of the machine (see action bench_report). The
+        percentiles are computed from a sample of the transactions (see
+        PG_BENCH_SAMPLING_RATE).
+
+    bench_report:
+        pg bench_report [--pg-venv <pg_venv>] [--workload <workload>]
+                        [--limit <limit>] [--json]
+
+        Show the results of the last <limit> benchmark runs (default: 20),
+        oldest first, for all the pg_venvs and workloads unless --pg-venv or
+        --workload is used.
+
+        --json: print all the recorded information as JSON
+
+    build:
+        pg build [--docs] [--no-install] [<make_args>]
+
+        <make_args>: options that are passed to make (e.g. '-j 4')
+
+        Compile and install postgresql and contrib (and the documentation
+        with --docs, or only compile them with --no-install), in a single
+        make: all the steps share the same jobserver, contrib is compiled
+        while core is installed, and the documentation alongside everything.
+        The duration of each step is displayed.
+        By default, jobs are drawn from the pool shared by the builds of all
+        the pg_venvs (see PG_BUILD_SCHEDULER and PG_BUILD_JOBS).
+        With meson, this runs `ninja` then `meson install`.
+        Uses environment variable PG_VENV
+
+    ccache_stats:
+        pg ccache_stats [<pg_venv>]
+
+        <pg_venv>: for which instance to show the statistics
+
+        Show how many compilations were served by the compiler cache, for each
+        pg_venv (or only the specified one), and an estimation of the time
+        this saved.
+        pg_venvs use ccache if it is installed when they are configured (see
+        PG_CCACHE). The cache is shared between all pg_venvs, and stored in
+        $PG_VIRTUALENV_HOME/.ccache.
+
+    compare:
+        pg compare [--rounds <rounds>] [--warmup <warmup>] [--workload <workload>]
+                   [--scale <scale>] [--clients <clients>] [--threads <threads>]
+                   [--duration <duration>] <baseline> <candidate>
+
+        <baseline>, <candidate>: the pg_venvs to compare
+        --rounds: number of runs of each pg_venv (default: 5)
+        --warmup: duration of the warm-up run before each run, in seconds
+        (default: 10)
+        Other options: see action bench.
+
+        Compare the performance of <candidate> to <baseline> with pgbench.
+        The runs are interleaved, in alternating order (ABBA...), so that
+        drift affects both pg_venvs equally. Before each run, the other
+        server is stopped, and the benchmarked one is restarted and warmed
+        up. The TPS delta is reported with its 95% confidence interval
+        (computed by bootstrap over the rounds), and whether the difference
+        is significant. The runs are recorded like with action bench.
+
     configure:
-        pg configure [<additional_args>]
+        pg configure [--build-system {autoconf,meson}] [<additional_args>]
 
         <additional_args>: additional options passed to the configure script
+        (or to `meson setup`)
+
+        --build-system: build system of the pg_venv, it is recorded and used
+        by all the build actions (make, install, make_check, make_clean).
+        By default, the current one of the pg_venv is kept. With meson, the
+        build directory is $PG_SRC/build, and PG_MESON_OPTIONS is used instead
+        of PG_CONFIGURE_OPTIONS.
 
         Run `./configure` in postgresql source dir.
         Postgresql's install path will be set to
         "$PG_DIR/$PG_VENV". If you want to store a specific
         pg_venv at another place, you can symlink this location to the new one.
 
-        Uses environment variables PG_DIR, PG_CONFIGURE_OPTIONS, and PG_VENV.
+        If ccache is available, the compiler is run through it, unless
+        PG_CONFIGURE_OPTIONS or <additional_args> set CC.
+
+        The results of configure's tests are cached in
+        $PG_VIRTUALENV_HOME/.configure_cache, and reused by all the pg_venvs
+        with the same compiler, options and major version. If configure fails
+        with the cache, it is run again without it.
+
+        Uses environment variables PG_DIR, PG_CONFIGURE_OPTIONS, PG_VENV,
+        PG_CCACHE and PG_CONFIGURE_CACHE.
 
-    create_virtualenv [--pg-branch <pg_branch>]:
+    create_virtualenv [--pg-branch <pg_branch>] [--seed [<seed_pg_venv>]]
+                      [--build-system {autoconf,meson}] [--tmpfs]
+                      [--tmpfs-build] [--profile <profile>]:
         Create a new pg_venv, by creating a new git worktree, compiling the 
         code, installing it, running initdb, starting the server and creating a
         db using createdb.
@@ -40,6 +149,36 @@ Actions:
         If you specify a pg_branch, that existing branch from the PostgreSQL's
         repository will be tracked instead.
 
+        With --seed, the build products of <seed_pg_venv> are copied to the
+        new worktree before compiling, so that only the files that differ
+        between both trees are rebuilt. Without <seed_pg_venv>, the pg_venv
+        whose last build is the closest in git history is used, among the ones
+        built with the same PG_CONFIGURE_OPTIONS. This is only supported with
+        autoconf.
+
+        --build-system chooses how postgresql is built, see action configure.
+        By default, PG_BUILD_SYSTEM is used if the source supports it.
+
+        --tmpfs puts the data directory on tmpfs, and --tmpfs-build the build
+        directory (meson only), see action tmpfs.
+
+        --profile chooses the configuration profile of the server, see action
+        profile. By default, PG_CONF_PROFILE is used.
+
+    disk_usage:
+        pg disk_usage [--rescan] [<pg_venv>]
+
+        <pg_venv>: for which instance to show the disk usage
+
+        Show the disk space used by each part of a pg_venv (source, build
+        products, installed files, data and log), and how to reclaim it.
+        The sizes are updated by the actions that change them (make,
+        install, initdb, rm_data), and scanned again when they are older than
+        PG_DISK_USAGE_TTL seconds, for at most PG_DISK_USAGE_SCAN_BUDGET
+        seconds. This is also where action list gets the disk usage from.
+
+        --rescan: scan everything again, without time limit
+
     get_shell_function:
         Return the function pg() that's used as a wrapper around this script
         (necessary for the actions whose output need to be sourced, such as
@@ -52,12 +191,43 @@ Actions:
         Display this help text
 
     install:
-        Run `make install` in postgresql source dir
+        Run `make install` in postgresql source dir (`meson install` with
+        meson)
 
-        Uses environment variable PG_DIR
+        The installed files are stored in a store shared by all pg_venvs
+        ($PG_VIRTUALENV_HOME/.install_store), where identical files are only
+        stored once, and hardlinked in the pg_venv's directory. Never modify
+        an installed file in place: other pg_venvs may share it.
+
+        Uses environment variables PG_DIR, PG_INSTALL_STORE
+
+    jobs:
+        pg jobs [<job_id>]
+
+        <job_id>: job whose output is shown
+
+        List the jobs run by pg_venvd (see pg_venvd.py --help), with their
+        state, duration and return code, or show the output of one of them.
+        Actions bench, build, compare, configure, create_virtualenv, install,
+        make, make_check, perf_bisect, reset_data, restart, start and stop
+        are run as jobs of pg_venvd with option --detach, which returns once
+        the job is submitted.
 
     list:
+        pg list [--json]
+
         List all available pg_venv, and show some info about them
+        The pg_venvs are probed concurrently. Their version is cached until
+        it changes, and their disk usage comes from the disk usage tracker
+        (see action disk_usage).
+        The result is saved in $PG_VIRTUALENV_HOME/.index, which is read by
+        the shell completion and to check the names of the pg_venvs given
+        as arguments. It is updated by the actions that create, remove,
+        start, stop or install a pg_venv, and rebuilt by this action.
+        If pg_venvd is running (see pg_venvd.py --help), the information
+        comes from it instead, without probing the pg_venvs.
+
+        --json: print the list as JSON
 
     log, l:
         pg log [<pg_venv>]
@@ -66,27 +236,124 @@ Actions:
 
         Show the server log, using `tail -f`.
 
+    list_snapshots:
+        pg list_snapshots [<pg_venv>]
+
+        <pg_venv>: for which instance to list the snapshots
+
+        List the snapshots of the data directory, see action snapshot.
+
     make:
         pg make [<make_args>]
 
         <make_args>: arguments that are passed to make (e.g. '-sj 4')
 
-        Run `make` in postgresql source dir
+        Run `make` in postgresql source dir (`ninja` with meson)
+        Core and contrib are built by a single make, see action build.
         Uses environment variable PG_DIR
 
     make_check:
-        Run `make check` in postgresql source dir.
+        Run `make check` in postgresql source dir (with meson, the setup and
+        regress test suites).
         Uses environment variable PG_DIR
 
     make_clean:
-        Run `make clean` in postgresql source dir
+        Run `make clean` in postgresql source dir (`ninja clean` with meson)
         Uses environment variable PG_DIR
 
+    perf_bisect:
+        pg perf_bisect [--pg-venv <pg_venv>] [--threshold <threshold>]
+                       [--runs <runs>] [--snapshot <snapshot>]
+                       [--workload <workload>] [--scale <scale>]
+                       [--clients <clients>] [--threads <threads>]
+                       [--duration <duration>] <good> <bad>
+
+        <good>, <bad>: commits before and after the regression
+        --pg-venv: pg_venv whose worktree is bisected, created (with
+        --enable-depend for autoconf) if it doesn't exist (default:
+        perf_bisect)
+        --threshold: TPS drop compared to <good>, in percent, above which a
+        commit is bad (default: 5)
+        --runs: number of runs of the workload for each commit, the median
+        TPS is used (default: 3)
+        --snapshot: snapshot of the pg_venv restored before measuring each
+        commit (see action snapshot). If the commit can't start with it
+        (e.g. catalog version change), or without --snapshot, the data
+        directory is reset.
+        Other options: see action bench.
+
+        Find the first commit that made the workload slower, with `git
+        bisect`. Each commit is built incrementally and installed. The
+        installed files of each commit are kept in $PG_VENV/build_cache (as
+        hardlinks to the install store, so only with PG_INSTALL_STORE), and
+        the results in the benchmark results, so that measuring a commit
+        again costs nothing.
+
+    profile:
+        pg profile [--pg-venv <pg_venv>] [<profile>]
+
+        <profile>: benchmark-durable, benchmark-unsafe, dev or low-memory
+        --pg-venv: which instance to configure (default: the current one)
+
+        Apply a configuration profile, or show the current one. The settings
+        of the profile are sized for the cores and RAM of the machine, and
+        written in postgresql.pg_venv.conf, which postgresql.conf includes:
+        - dev: moderate memory usage, durable
+        - benchmark-durable: 25% of the RAM for shared_buffers, large
+          max_wal_size, parallel workers for all the cores
+        - benchmark-unsafe: benchmark-durable, with fsync, synchronous_commit
+          and full_page_writes off, and wal_level minimal
+        - low-memory: as small as possible, to run many servers
+        The profile is applied again by initdb (and reset_data). If the
+        server is running, its configuration is reloaded, or it is restarted
+        if a setting that changed requires it (e.g. shared_buffers).
+
+    reset_data:
+        pg reset_data [--force] [<pg_venv>]
+
+        <pg_venv>: which instance to reset
+
+        Replace the data directory of a pg_venv by a new one, as initdb
+        would create it, and restart the server if it was running. Asks for
+        a confirmation, unless --force is used.
+
     restart:
         Similar to running `pg stop && pg start`
 
+    restore:
+        pg restore [--pg-venv <pg_venv>] [<snapshot>]
+
+        <snapshot>: which snapshot to restore (default: the latest one)
+        --pg-venv: which instance to restore (default: the current one)
+
+        Replace the data directory by a snapshot taken with action snapshot,
+        and restart the server if it was running. btrfs and reflink snapshots
+        are restored in seconds, whatever the size of the data.
+
     rm_data:
         Removes the data directory for the current pg
+        Run initdb to create a new one (or see action reset_data).
+
+    rm_snapshot:
+        pg rm_snapshot [--pg-venv <pg_venv>] <snapshot>
+
+        <snapshot>: which snapshot to remove
+        --pg-venv: which instance the snapshot belongs to (default: the
+        current one)
+
+    snapshot:
+        pg snapshot [--pg-venv <pg_venv>] [<snapshot>]
+
+        <snapshot>: name of the snapshot (default: the current date)
+        --pg-venv: which instance to snapshot (default: the current one)
+
+        Take a snapshot of the data directory, in $PG_VENV/snapshots. The
+        server is stopped while the snapshot is taken, and restarted
+        afterwards. If the data directory is a btrfs subvolume, the snapshot
+        is a btrfs snapshot; otherwise, if the filesystem supports reflinks
+        (btrfs, xfs...), it is a copy sharing its blocks with the data
+        directory; otherwise, it is a compressed tarball (see
+        PG_SNAPSHOT_METHOD).
 
     start:
         pg start [<pg_venv>]
@@ -95,7 +362,33 @@ Actions:
 
         Start a postgresql instance from pg_venv. If <pg_venv> is not specified,
         start the current one (defined by PG_VENV).
-        Uses environment variables PG_VENV
+        Waits until the server accepts connections, for at most
+        PG_READY_TIMEOUT seconds.
+        Uses environment variables PG_VENV, PG_READY_TIMEOUT
+
+    stats:
+        pg stats [--commands] [--last <last>] [<pg_venv>]
+
+        <pg_venv>: for which instance to show the statistics
+
+        Show how long the actions run on the pg_venv took, and the phases of
+        the ones that have some (e.g. create_virtualenv: configure, build,
+        initdb...): number of runs, duration of the last run, median and best
+        durations, user and system CPU time and peak RSS of the last run, and
+        the durations of the last <last> runs (default: 5). Then, show the
+        breakdown of the last run of each action.
+        Every action (except the ones that only display something) and every
+        command they run is timed, in $PG_VENV/timings.jsonl.
+
+        --commands: show the commands run by the actions too
+
+    status:
+        pg status [<pg_venv>]
+
+        <pg_venv>: which instance to show (default: the current one)
+
+        Show the port, version, state and disk usage of a pg_venv, and, if
+        pg_venvd is running, its build in progress and its jobs.
 
     stop:
         pg stop [<pg_venv>]
@@ -106,6 +399,24 @@ Actions:
         current one (defined by PG_VENV)
         Uses environment variables PG_VENV
 
+    store_gc:
+        Remove the files of the install store that are not used by any
+        pg_venv anymore, and the initdb templates no pg_venv can use. This is
+        done automatically by rm_virtualenv (which doesn't remove templates).
+
+    tmpfs:
+        pg tmpfs [--build] [--off] [<pg_venv>]
+
+        <pg_venv>: which instance to move (default: the current one)
+
+        Move the data directory to tmpfs (in PG_TMPFS_DIR), and the build
+        directory too with --build (meson only: autoconf builds in the source
+        directory). With --off, move them back to disk. The server is
+        restarted if it was running.
+        Directories on tmpfs don't survive a reboot: start recovers the data
+        directory from the latest snapshot (see action snapshot), or runs
+        initdb if there is none; the build actions run meson setup again.
+
     workon, w:
         pg workon <pg_venv>
 
@@ -116,20 +427,128 @@ Actions:
         output of this action is made to be sourced by bash (because it changes
         the environment). See action 'get-shell-function' to ease that.
 
+        The shell function sources $PG_VENV/activate instead, if it exists.
+        That script is generated when the pg_venv is created (or by this
+        action if it is missing), so that switching pg_venvs does not need to
+        start python.
+
 Environment variables:
+    PG_BENCH_SAMPLING_RATE:
+        Fraction of the transactions of `pg bench` whose latency is logged to
+        compute the latency percentiles (default: 0.01). Logging all of them
+        slows fast workloads down
+
+    PG_BUILD_JOBS:
+        Number of jobs shared by all the builds running at the same time, in
+        all the pg_venvs (default: the number of CPUs). If the build scheduler
+        is disabled, number of jobs of each build (default: the number of CPUs
+        minus the current load average)
+
+    PG_BUILD_SCHEDULER:
+        Set to 0 to let builds run without the build scheduler (default: 1).
+        The scheduler makes all the builds (make, install, make_check...) of
+        all the pg_venvs draw their jobs from a shared GNU make jobserver in
+        $PG_VIRTUALENV_HOME/.jobserver, and admits them in order of arrival,
+        at most PG_MAX_CONCURRENT_BUILDS at a time
+
+    PG_BUILD_SYSTEM:
+        Build system used by new pg_venvs when the source supports it:
+        autoconf or meson (default: autoconf)
+
+    PG_BULK_PARALLEL:
+        Number of pg_venvs an action run on several of them handles at the
+        same time (default: the number of CPUs)
+
+    PG_CCACHE:
+        Set to 0 to disable the use of ccache when configuring pg_venvs
+        (default: 1)
+
+    PG_CCACHE_MAXSIZE:
+        Maximum size of the compiler cache shared by the pg_venvs (default:
+        20G)
+
+    PG_CONF_PROFILE:
+        Configuration profile applied to the new pg_venvs (default: none),
+        see action profile
+
     PG_CONFIGURE_OPTIONS:
         Options that are passed to the configure script
         If it contains '--prefix', PG_VENV will have no effect during action
         'configure'
 
+    PG_CONFIGURE_CACHE:
+        Set to 0 to run configure without the cache shared by the pg_venvs
+        (default: 1)
+
     PG_DIR:
         Contains path to the postgresql original repository
 
+    PG_INITDB_OPTIONS:
+        Options that are passed to initdb
+
+    PG_INITDB_TEMPLATE:
+        Set to 0 to run initdb for each new data directory (default: 1).
+        Otherwise, initdb is run once for each major version, catalog
+        version, configure options and initdb options, in
+        $PG_VIRTUALENV_HOME/.initdb_templates, and new data directories are
+        copies of this template (using reflinks if possible). This is used by
+        create_virtualenv, reset_data, and initdb when called by pg_venv.
+
+    PG_INSTALL_STORE:
+        Set to 0 to install files directly in the pg_venvs, instead of
+        deduplicating them in the install store (default: 1)
+
+    PG_DISK_USAGE_SCAN_BUDGET:
+        How long the parts of a pg_venv whose disk usage is outdated can be
+        scanned before a size is displayed, in seconds (default: 1)
+
+    PG_DISK_USAGE_TTL:
+        How long the disk usage of the parts of a pg_venv is considered
+        accurate, in seconds (default: 600)
+
+    PG_LOG_ROTATE:
+        Number of previous logs kept for each phase, see PG_LOG_TAIL_LINES
+        (default: 3)
+
+    PG_LOG_TAIL_LINES:
+        The output of the commands run by the actions (e.g. make, install,
+        initdb) is written to $PG_VENV/logs/<phase>.log, and only its last
+        PG_LOG_TAIL_LINES lines are displayed if the command fails
+        (default: 50)
+
+    PG_MAX_CONCURRENT_BUILDS:
+        Maximum number of builds the build scheduler runs at the same time,
+        the other ones wait for their turn (default: a quarter of the number
+        of CPUs)
+
+    PG_MESON_OPTIONS:
+        Options that are passed to `meson setup`, for pg_venvs built with
+        meson
+
+    PG_PROGRESS:
+        Set to 0 to hide the progress of compilations (number of files
+        compiled) when stdout is a terminal (default: 1)
+
+    PG_READY_TIMEOUT:
+        How long to wait for a server to accept connections after starting
+        it, in seconds (default: 60)
+
+    PG_SNAPSHOT_METHOD:
+        How snapshots are taken (see action snapshot): btrfs, reflink or tar
+        (default: the fastest one the filesystem supports)
+
+    PG_TMPFS_DIR:
+        Directory on tmpfs where the directories moved by action tmpfs are
+        stored (default: /dev/shm/pg_venv-<uid>)
+
     PG_VIRTUALENV_HOME:
         Contains the data for a pg_venv, including a copy of the source code
         that was used to generate the binaries, the binaries themselves, and
         the data dir.
 
+    PG_VENVD_POLL_INTERVAL, PG_VENVD_TIMEOUT:
+        See pg_venvd.py --help
+
     PG_VENV:
         Version of postgresql we are currently working on.
         Do not change this manually, use the 'workon' action.
@@ -138,84 +557,466 @@ Environment variables:
 '''
 
 
-def execute_action(action, action_args):
-    '''
-    Execute the function corresponding to an action
-    This action can also be an alias
-    '''
-    try:
-        ACTIONS[action].execute(action_args)
-    except TypeError as e:
-        log('some arguments were not understood', 'error')
-        log('error message: {}'.format(e))
-        exit(2)
+# arguments that must name an existing pg_venv, except for the actions that
+# create it
+EXISTING_PG_VENV_ARGUMENTS = ['pg_venv', 'baseline', 'candidate']
+NEW_PG_VENV_ACTIONS = ['create_virtualenv', 'perf_bisect']
 
+# actions that can be run on several pg_venvs at the same time (see run_bulk)
+BULK_ACTIONS = ['install', 'make', 'make_check', 'restart', 'start', 'stop']
+BULK_OPTIONS = ['all_pg_venvs', 'running', 'pattern', 'parallel']
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    subparsers = parser.add_subparsers(dest='action', metavar='<action>')
-    subparsers.required = True
+# actions that can be run by pg_venvd (see pg_venvd.py)
+DETACHABLE_ACTIONS = ['bench', 'build', 'compare', 'configure', 'create_virtualenv', 'install', 'make', 'make_check', 'perf_bisect', 'reset_data', 'restart', 'start', 'stop']
 
-    # create a subparser for each action
-    action_parsers = {}
-    for _, action in ACTIONS.items():
-        action_parsers[action.name] = subparsers.add_parser(
-            action.name,
-            help=action.short_desc,
-            aliases = [action.alias] if action.alias else [],
-        )
-        action_parsers[action.name].set_defaults(func=getattr(action, 'execute'))
 
+def add_arguments(action, parser):
+    '''
+    Define the arguments of an action in its parser
+
+    The existence of the pg_venvs given as arguments is not checked here, so
+    that parsing doesn't touch the filesystem (see check_pg_venv_arguments).
+    '''
     # define mandatory pg_venv argument for workon action
-    action_parsers['workon'].add_argument(
-        'pg_venv',
-        choices=available_pg_venvs(),
-        help='Existing pg_venv',
-        metavar='<pg_venv>'
-    )
+    if action == 'workon':
+        parser.add_argument(
+            'pg_venv',
+            help='Existing pg_venv',
+            metavar='<pg_venv>'
+        )
 
     #define mandatory pg_venv argument for create_virtualenv action
-    action_parsers['create_virtualenv'].add_argument(
-        'pg_venv',
-        help='New pg_venv',
-        metavar='<pg_venv>'
-    )
+    if action == 'create_virtualenv':
+        parser.add_argument(
+            'pg_venv',
+            help='New pg_venv',
+            metavar='<pg_venv>'
+        )
 
     # define optional argument branch for create_virtualenv action
-    action_parsers['create_virtualenv'].add_argument(
-        '--pg-branch',
-        nargs=1,
-        help='PostgreSQL branch to checkout in the worktree',
-        metavar='<pg_branch>'
-    )
+    if action == 'create_virtualenv':
+        parser.add_argument(
+            '--pg-branch',
+            nargs=1,
+            help='PostgreSQL branch to checkout in the worktree',
+            metavar='<pg_branch>'
+        )
+
+    # define optional argument build system for actions that need it
+    if action in ['configure', 'create_virtualenv']:
+        parser.add_argument(
+            '--build-system',
+            choices=['autoconf', 'meson'],
+            help='Build system used to compile postgresql (meson requires pg16 or later)',
+        )
+
+    # define optional argument seed for create_virtualenv action
+    if action == 'create_virtualenv':
+        parser.add_argument(
+            '--seed',
+            nargs='?',
+            const='auto',
+            help='Existing pg_venv whose build products are reused (default: the closest one in git history)',
+            metavar='<seed_pg_venv>'
+        )
 
     # define optional pg_venv argument for actions that need it
-    for action in ['log', 'restart', 'rm_data', 'rm_virtualenv', 'start', 'stop']:
-        action_parsers[action].add_argument(
+    if action in ['ccache_stats', 'disk_usage', 'list_snapshots', 'log', 'reset_data', 'restart', 'rm_data', 'rm_virtualenv', 'start', 'stats', 'status', 'stop', 'tmpfs']:
+        parser.add_argument(
             'pg_venv',
             nargs='?',
-            choices=available_pg_venvs(),
             const=get_env_var('PG_VENV', error_on_fail=False),
             help='Existing pg_venv',
             metavar='<pg_venv>',
         )
 
+    # define snapshot argument and optional pg_venv option for snapshot actions
+    if action in ['restore', 'rm_snapshot', 'snapshot']:
+        parser.add_argument(
+            'snapshot_name',
+            nargs=None if action == 'rm_snapshot' else '?',
+            help='Name of the snapshot',
+            metavar='<snapshot>',
+        )
+        parser.add_argument(
+            '--pg-venv',
+            help='Existing pg_venv (default: the current one)',
+            metavar='<pg_venv>',
+        )
+
+    # define optional arguments profile for create_virtualenv and profile actions
+    if action == 'create_virtualenv':
+        parser.add_argument(
+            '--profile',
+            choices=CONF_PROFILES,
+            help='Configuration profile of the server',
+        )
+    if action == 'profile':
+        parser.add_argument(
+            'profile_name',
+            nargs='?',
+            choices=CONF_PROFILES,
+            help='Configuration profile to apply',
+            metavar='<profile>',
+        )
+        parser.add_argument(
+            '--pg-venv',
+            help='Existing pg_venv (default: the current one)',
+            metavar='<pg_venv>',
+        )
+
+    # define arguments for bench action
+    if action == 'bench':
+        parser.add_argument(
+            'pg_venvs',
+            nargs='*',
+            help='Existing pg_venvs (default: the current one)',
+            metavar='<pg_venv>',
+        )
+    if action in ['bench', 'compare', 'perf_bisect']:
+        parser.add_argument(
+            '--workload',
+            default='tpcb-like',
+            help="pgbench's built-in script, or path of a custom script",
+        )
+        for option, default in [('--scale', 1), ('--clients', 1), ('--threads', 1), ('--duration', 60)]:
+            parser.add_argument(option, type=int, default=default)
+    if action == 'bench':
+        parser.add_argument(
+            '--init',
+            action='store_true',
+            help='Initialize the pgbench database again',
+        )
+
+    # define arguments for compare action
+    if action == 'compare':
+        for argument in ['baseline', 'candidate']:
+            parser.add_argument(
+                argument,
+                help='Existing pg_venv',
+                metavar='<{}>'.format(argument),
+            )
+        parser.add_argument(
+            '--rounds',
+            type=int,
+            default=5,
+            help='Number of runs of each pg_venv',
+        )
+        parser.add_argument(
+            '--warmup',
+            type=int,
+            default=10,
+            help='Duration of the warm-up run before each run, in seconds',
+        )
+
+    # define arguments for perf_bisect action
+    if action == 'perf_bisect':
+        for argument in ['good', 'bad']:
+            parser.add_argument(
+                argument,
+                help='{} commit'.format(argument.capitalize()),
+                metavar='<{}>'.format(argument),
+            )
+        parser.add_argument(
+            '--pg-venv',
+            default='perf_bisect',
+            help='pg_venv whose worktree is used, created if needed (default: perf_bisect)',
+            metavar='<pg_venv>',
+        )
+        parser.add_argument(
+            '--threshold',
+            type=float,
+            default=5,
+            help='TPS drop, in percent, above which a commit is bad',
+        )
+        parser.add_argument(
+            '--runs',
+            type=int,
+            default=3,
+            help='Number of runs of the workload for each commit',
+        )
+        parser.add_argument(
+            '--snapshot',
+            dest='snapshot_name',
+            help='Snapshot of the data directory restored before each commit is measured',
+            metavar='<snapshot>',
+        )
+
+    # define optional arguments for bench_report action
+    if action == 'bench_report':
+        parser.add_argument(
+            '--pg-venv',
+            help='Only show the runs of this pg_venv',
+            metavar='<pg_venv>',
+        )
+        parser.add_argument(
+            '--workload',
+            help='Only show the runs of this workload',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            default=20,
+            help='Number of runs to show',
+        )
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            dest='as_json',
+            help='Print the runs as JSON',
+        )
+
+    # define optional arguments for stats action
+    if action == 'stats':
+        parser.add_argument(
+            '--commands',
+            action='store_true',
+            help='Show the commands run by the actions too',
+        )
+        parser.add_argument(
+            '--last',
+            type=int,
+            default=5,
+            help='Number of runs whose durations are shown',
+        )
+
+    # define optional argument rescan for disk_usage action
+    if action == 'disk_usage':
+        parser.add_argument(
+            '--rescan',
+            action='store_true',
+            help='Scan the whole pg_venv again',
+        )
+
+    # define optional argument force for reset_data action
+    if action == 'reset_data':
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Do not ask for a confirmation',
+        )
+
+    # define optional arguments tmpfs for create_virtualenv action
+    if action == 'create_virtualenv':
+        parser.add_argument(
+            '--tmpfs',
+            action='store_true',
+            help='Put the data directory on tmpfs',
+        )
+        parser.add_argument(
+            '--tmpfs-build',
+            action='store_true',
+            help='Put the build directory on tmpfs (meson only)',
+        )
+
+    # define optional arguments for tmpfs action
+    if action == 'tmpfs':
+        parser.add_argument(
+            '--build',
+            action='store_true',
+            help='Move the build directory too (meson only)',
+        )
+        parser.add_argument(
+            '--off',
+            action='store_true',
+            help='Move the directories back to disk',
+        )
+
+    # define optional argument json for list action
+    if action == 'list':
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            dest='as_json',
+            help='Print the list as JSON',
+        )
+
+    # define optional arguments for build action
+    if action == 'build':
+        parser.add_argument(
+            '--docs',
+            action='store_true',
+            help='Build and install the documentation too',
+        )
+        parser.add_argument(
+            '--no-install',
+            action='store_true',
+            help='Only compile, without installing',
+        )
+        parser.add_argument(
+            'make_args',
+            nargs='*',
+            help='Additional options to pass to make',
+            metavar='<make_args>',
+        )
+
     # define additional_options argument for actions that need it
-    for action in ['configure', 'make']:
-        action_parsers[action].add_argument(
+    if action in ['configure', 'make']:
+        parser.add_argument(
             'additional_args',
             nargs='*',
             help='Additional options to pass to the underlying command',
             metavar='<additional_args>',
         )
 
-    args = parser.parse_args()
+    # define optional argument job_id for jobs action
+    if action == 'jobs':
+        parser.add_argument(
+            'job_id',
+            nargs='?',
+            type=int,
+            help='Job whose output is shown',
+            metavar='<job_id>',
+        )
+
+    # define optional argument detach for the actions pg_venvd can run
+    if action in DETACHABLE_ACTIONS:
+        parser.add_argument(
+            '--detach',
+            action='store_true',
+            help='Have pg_venvd run the action in the background',
+        )
+
+    # define the options selecting the pg_venvs of bulk actions
+    if action in BULK_ACTIONS:
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            dest='all_pg_venvs',
+            help='Run the action on all the pg_venvs',
+        )
+        parser.add_argument(
+            '--running',
+            action='store_true',
+            help='Run the action on the pg_venvs whose server is running',
+        )
+        parser.add_argument(
+            '--match',
+            dest='pattern',
+            help='Run the action on the pg_venvs whose name matches a glob pattern',
+            metavar='<pattern>',
+        )
+        parser.add_argument(
+            '--parallel',
+            type=int,
+            help='Number of pg_venvs the action runs on at the same time (default: PG_BULK_PARALLEL)',
+            metavar='<n>',
+        )
+
+
+def check_pg_venv_arguments(action, parser, action_args):
+    '''
+    Make sure the arguments that name pg_venvs name existing ones, once the
+    arguments of action have been parsed
+    '''
+    if action in NEW_PG_VENV_ACTIONS:
+        return
+
+    for argument in EXISTING_PG_VENV_ARGUMENTS:
+        pg_venv = action_args.get(argument)
+        if pg_venv is not None and not pg_virtualenv_exists(pg_venv):
+            parser.error('pg_venv {!r} does not exist (choose from {})'.format(
+                pg_venv,
+                ', '.join(map(repr, indexed_pg_venvs())),
+            ))
+
+
+def get_invoked_action(argv):
+    '''
+    Return the name of the action invoked by the command line arguments argv
+    (not its alias), or None if it is missing or unknown
+    '''
+    aliases = {action.alias: action.name for action in ACTIONS.values() if action.alias}
+    for arg in argv:
+        if not arg.startswith('-'):
+            action = aliases.get(arg, arg)
+            return action if action in ACTIONS else None
+
+    return None
+
+
+def parse_args(argv):
+    '''
+    Parse the command line arguments argv, and return the function executing
+    the invoked action and its arguments
+
+    Only the parser of the invoked action is defined, the ones of all the
+    actions are only needed to display the help or an error.
+    '''
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='action', metavar='<action>')
+    subparsers.required = True
+
+    invoked_action = get_invoked_action(argv)
+
+    # create a subparser for each action
+    action_parsers = {}
+    for _, action in ACTIONS.items():
+        if invoked_action is not None and action.name != invoked_action:
+            continue
+
+        action_parsers[action.name] = subparsers.add_parser(
+            action.name,
+            help=action.short_desc,
+            aliases = [action.alias] if action.alias else [],
+        )
+        action_parsers[action.name].set_defaults(func=getattr(action, 'execute'))
+        add_arguments(action.name, action_parsers[action.name])
+
+    args = parser.parse_args(argv)
     action = args.func
     action_args = vars(args)
 
     # remove arguments that are not used by the action functions
     del action_args['func']
-    del action_args['action']
+    invoked_action = get_invoked_action([action_args.pop('action')])
+
+    # a pg_venv given as a glob pattern selects several pg_venvs
+    if invoked_action in BULK_ACTIONS and any(c in (action_args.get('pg_venv') or '') for c in '*?['):
+        action_args['pattern'] = action_args['pg_venv']
+        action_args['pg_venv'] = None
+
+    check_pg_venv_arguments(invoked_action, action_parsers[invoked_action], action_args)
+
+    return action, action_args
+
+
+def main(argv):
+    '''
+    Run the action invoked by the command line arguments argv, and return its
+    return code
+    '''
+    action, action_args = parse_args(argv)
+
+    if action_args.pop('detach', False):
+        pg_venv = action_args.get('pg_venv') or os.environ.get('PG_VENV')
+        return submit_job([arg for arg in argv if arg != '--detach'], pg_venv)
+
+    bulk_options = {option: action_args.pop(option) for option in BULK_OPTIONS if option in action_args}
+    if bulk_options.get('all_pg_venvs') or bulk_options.get('running') or bulk_options.get('pattern'):
+        return run_bulk(get_invoked_action(argv), action_args, **bulk_options)
+
+    try:
+        return action(action_args)
+    except TypeError as e:
+        # only a TypeError raised when calling the action's function comes
+        # from a wrong combination of arguments, others are bugs
+        traceback = e.__traceback__
+        while traceback.tb_next is not None:
+            traceback = traceback.tb_next
+        if traceback.tb_frame.f_code is not Action.execute.__code__:
+            raise
+
+        log('some arguments were not understood', 'error')
+        log('error message: {}'.format(e))
+        return 2
+
+
+if __name__ == '__main__':
+    try:
+        return_code = main(sys.argv[1:])
+    except PgVenvError:
+        # the reason has already been logged
+        return_code = -1
 
-    return_code = action(action_args)
     exit(return_code)
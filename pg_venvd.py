@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import signal
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+
+from utils import available_pg_venvs, get_build_states, get_daemon_dir, get_daemon_socket, get_disk_usage, daemon_request, lock_index, log, read_index, refresh_index_entry, write_index
+
+
+USAGE = '''
+pg_venvd keeps the state of all the pg_venvs in memory, and answers the
+commands of pg_venv.py on a unix socket ($PG_VIRTUALENV_HOME/.pg_venvd/socket),
+so that they don't have to probe every pg_venv. It is optional: without it,
+pg_venv.py does the work itself.
+
+Every PG_VENVD_POLL_INTERVAL seconds, it checks which pg_venvs exist, whether
+their server is running (from their postmaster.pid), their version (only
+read again when pg_config changes) and their builds in progress, and updates
+the index read by the shell completion when that changed.
+
+It also runs actions as jobs (`pg <action> --detach`), so that long builds
+don't tie up a terminal. The jobs of a pg_venv run one after the other, in
+order of submission, the ones of different pg_venvs run concurrently. Their
+output is written to $PG_VIRTUALENV_HOME/.pg_venvd/<job_id>.log, see action
+jobs.
+
+Usage:
+    pg_venvd.py
+
+It runs in the foreground until it gets SIGINT or SIGTERM.
+
+Environment variables:
+    PG_VENVD_POLL_INTERVAL:
+        Interval between two checks of the pg_venvs, in seconds (default: 1)
+
+    PG_VENVD_TIMEOUT:
+        How long pg_venv.py waits for the answer of pg_venvd, in seconds
+        (default: 10)
+
+    PG_VIRTUALENV_HOME:
+        See `pg_venv.py --help`
+'''
+
+
+class Daemon():
+    def __init__(self, poll_interval=1):
+        self.poll_interval = poll_interval
+
+        # serializes the refreshes, that the watch thread, the job threads
+        # and the refresh command may start at the same time, so that an
+        # older state never replaces a newer one
+        self.refresh_lock = threading.Lock()
+
+        # protects everything below
+        self.lock = threading.Lock()
+
+        # entries of the index (see read_index), disk usage and builds in
+        # progress of each pg_venv
+        self.index = {}
+        self.disk_usages = {}
+        self.build_states = {}
+
+        # jobs by id, and the ids of the jobs waiting for each pg_venv
+        self.jobs = {}
+        self.job_queues = {}
+        self.next_job_id = 1
+
+        self.stopped = threading.Event()
+
+
+    def get_pg_venv_info(self, pg_venv):
+        '''
+        Return the information about a pg_venv displayed by action list (see
+        utils.get_pg_venv_info), with the state of its build, if any
+
+        Everything comes from memory, as it is called with the lock held.
+        '''
+        entry = self.index[pg_venv]
+        return {
+            'pg_venv': pg_venv,
+            'port': entry['port'],
+            'version': entry['version'],
+            'running': entry['running'],
+            'disk_usage': self.disk_usages[pg_venv],
+            'build': self.build_states.get(pg_venv),
+        }
+
+
+    def handle(self, request):
+        '''
+        Execute a command sent by pg_venv.py, and return the answer
+        '''
+        command = request.get('command')
+
+        if command == 'list':
+            with self.lock:
+                return {'pg_venvs': [self.get_pg_venv_info(pg_venv) for pg_venv in sorted(self.index)]}
+
+        elif command == 'status':
+            with self.lock:
+                if request['pg_venv'] not in self.index:
+                    return {'error': 'This virtualenv does not exist: {}'.format(request['pg_venv'])}
+                return {
+                    'pg_venv': self.get_pg_venv_info(request['pg_venv']),
+                    'jobs': [job for job in self.jobs.values() if job['pg_venv'] == request['pg_venv']],
+                }
+
+        elif command == 'jobs':
+            with self.lock:
+                return {'jobs': list(self.jobs.values())}
+
+        elif command == 'submit':
+            return {'job': self.submit(request['argv'], request['pg_venv'], request['env'], request['cwd'])}
+
+        elif command == 'refresh':
+            self.refresh()
+            return {}
+
+        return {'error': 'Unknown command: {}'.format(command)}
+
+
+    def refresh(self):
+        '''
+        Update the state of the pg_venvs, and write the index if it changed
+
+        The disk usage is only scanned again, and recorded in the metadata of
+        a pg_venv, once it is older than PG_DISK_USAGE_TTL (see
+        utils.get_disk_usage_breakdown): refreshing doesn't write anything
+        otherwise.
+        '''
+        with self.refresh_lock:
+            pg_venvs = available_pg_venvs()
+            build_states = get_build_states()
+
+            with self.lock:
+                index = {pg_venv: dict(self.index.get(pg_venv, {})) for pg_venv in pg_venvs}
+
+            # refreshing an entry only reads postmaster.pid, and runs pg_config
+            # if it changed
+            for pg_venv in pg_venvs:
+                refresh_index_entry(pg_venv, index[pg_venv])
+            # this may scan the pg_venvs, it mustn't block the clients
+            disk_usages = {pg_venv: get_disk_usage(pg_venv) for pg_venv in pg_venvs}
+
+            with self.lock:
+                index_changed = index != self.index
+                self.index = index
+                self.disk_usages = disk_usages
+                self.build_states = build_states
+
+            if index_changed or index != read_index():
+                with lock_index():
+                    write_index(index)
+
+
+    def run_jobs(self, pg_venv):
+        '''
+        Run the jobs waiting for a pg_venv, one after the other, until there
+        are none left
+        '''
+        while True:
+            with self.lock:
+                if not self.job_queues[pg_venv]:
+                    del self.job_queues[pg_venv]
+                    return
+                job, env, cwd = self.job_queues[pg_venv].pop(0)
+                job['state'] = 'running'
+                job['start_time'] = time.time()
+
+            with open(job['log'], 'wb') as log_file:
+                process = subprocess.run(
+                    [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pg_venv.py')] + job['argv'],
+                    stdin=subprocess.DEVNULL,
+                    stdout=log_file,
+                    stderr=subprocess.STDOUT,
+                    env=env,
+                    cwd=cwd,
+                )
+
+            with self.lock:
+                job['state'] = 'done'
+                job['end_time'] = time.time()
+                job['return_code'] = process.returncode
+
+            # the job probably changed the state of the pg_venv
+            self.refresh()
+
+
+    def submit(self, argv, pg_venv, env, cwd):
+        '''
+        Queue the execution of pg_venv.py with the arguments argv, in the
+        environment env and the directory cwd of the client, after the other
+        jobs of pg_venv, and return the job
+        '''
+        with self.lock:
+            job = {
+                'id': self.next_job_id,
+                'argv': argv,
+                'pg_venv': pg_venv,
+                'state': 'waiting',
+                'submit_time': time.time(),
+                'start_time': None,
+                'end_time': None,
+                'return_code': None,
+                'log': os.path.join(get_daemon_dir(), '{}.log'.format(self.next_job_id)),
+            }
+            self.next_job_id += 1
+            self.jobs[job['id']] = job
+
+            if pg_venv not in self.job_queues:
+                self.job_queues[pg_venv] = []
+                threading.Thread(target=self.run_jobs, args=(pg_venv,), daemon=True).start()
+            self.job_queues[pg_venv].append((job, env, cwd))
+
+            return dict(job)
+
+
+    def watch(self):
+        '''
+        Refresh the state of the pg_venvs every poll_interval seconds
+        '''
+        while not self.stopped.wait(self.poll_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                log('Could not refresh the state of the pg_venvs: {}'.format(e), 'error')
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            answer = self.server.daemon.handle(json.loads(self.rfile.readline()))
+        except Exception as e:
+            answer = {'error': '{}: {}'.format(type(e).__name__, e)}
+        self.wfile.write(json.dumps(answer).encode('utf-8') + b'\n')
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(poll_interval=1):
+    '''
+    Run pg_venvd until it gets SIGINT or SIGTERM
+    '''
+    if daemon_request('jobs') is not None:
+        log('pg_venvd is already running', 'error')
+        return 1
+
+    os.makedirs(get_daemon_dir(), mode=0o700, exist_ok=True)
+    if os.path.exists(get_daemon_socket()):
+        # left by a pg_venvd that didn't exit cleanly
+        os.unlink(get_daemon_socket())
+
+    daemon = Daemon(poll_interval)
+    daemon.refresh()
+
+    server = Server(get_daemon_socket(), RequestHandler)
+    # only the owner of the pg_venvs can send commands, since jobs run them
+    os.chmod(get_daemon_socket(), 0o600)
+    server.daemon = daemon
+
+    def stop(signum, frame):
+        daemon.stopped.set()
+        # shutdown() waits for serve_forever() to return, in this thread
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    threading.Thread(target=daemon.watch, daemon=True).start()
+    log('pg_venvd listening on {}'.format(get_daemon_socket()), 'success')
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(get_daemon_socket())
+
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=USAGE, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args()
+
+    exit(serve(float(os.environ.get('PG_VENVD_POLL_INTERVAL', 1))))
@@ -1,14 +1,23 @@
 #! /usr/bin/env python3
 
+import asyncio
+import contextlib
+import io
+import json
 import multiprocessing
 import os
 import shutil
+import subprocess
 import sys
+import time
 import unittest
 from unittest.mock import patch
 
-from actions import configure, create_virtualenv, get_shell_function, install, list_pg_venv, make, make_check, make_clean, restart, rm_data, rm_virtualenv, server_log, start, stop, workon
-from utils import pg_is_running, get_env_var, get_pg_src, get_pg_bin, initdb, get_pg_data, get_pg_venv_dir, execute_cmd
+import api
+import pg_venv
+from actions import ACTIONS, run_bulk, configure, create_virtualenv, get_shell_function, install, list_pg_venv, make, make_check, make_clean, restart, restore, rm_data, rm_snapshot, rm_virtualenv, server_log, snapshot, start, stop, workon
+from pg_venvd import Daemon
+from utils import CommandError, PgVenvError, pg_is_running, get_bool_env_var, get_env_var, get_pg_src, get_pg_bin, initdb, get_pg_data, get_pg_venv_dir, execute_cmd, parse_pg_version, read_postmaster_pid, wait_for_pg_ready_async, get_ccache_stats_log, read_ccache_stats_log, estimate_compilation_duration, format_size, scan_disk_usage, get_snapshots, set_tmpfs, recreate_tmpfs_dirs, apply_conf_profile, get_conf_profile_settings, read_conf_profile, parse_pgbench_output, percentile, histogram_percentile, read_pgbench_latencies, record_bench_run, get_bench_runs, bootstrap_ci, format_duration, read_timings, timed, rotate_log, stream_output, get_activation_script, get_index_file, indexed_pg_venvs, read_index, update_index, lock_pg_venv, select_pg_venvs, get_phase_log_file, install_from_staging_dir, gc_install_store, get_install_manifest_file, write_build_makefile, get_build_phase_log, build_slot_async, execute_cmd_async, get_build_queue, get_jobserver_dir, get_disk_usage_breakdown, update_disk_usage, get_pg_metadata, update_pg_metadata, get_pg_log
 
 
 TMP_DIR = os.path.abspath('.test_data')
@@ -115,12 +124,569 @@ class ActionsTestCase(unittest.TestCase):
         self.assertTrue(pg_is_running(PERSISTENT_PG_VENV))
 
 
+class UtilsTestCase(unittest.TestCase):
+    '''
+    Test the helpers that don't need a postgres build
+    '''
+    @classmethod
+    def setUpClass(cls):
+        cls.pg_venv_home = os.path.abspath('.test_utils_data')
+        if os.path.isdir(cls.pg_venv_home):
+            shutil.rmtree(cls.pg_venv_home)
+        os.makedirs(os.path.join(cls.pg_venv_home, TMP_PG_VENV, 'data'))
+        os.environ['PG_VIRTUALENV_HOME'] = cls.pg_venv_home
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.pg_venv_home)
+
+    def setUp(self):
+        os.environ['PG_VIRTUALENV_HOME'] = self.pg_venv_home
+
+    def write_postmaster_pid(self, lines):
+        with open(os.path.join(get_pg_data(TMP_PG_VENV), 'postmaster.pid'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+
+    def test_activation_script(self):
+        previous_pg_bin = get_pg_bin('previous_pg_venv')
+        env = {
+            'PATH': '{}:/usr/bin:/bin:{}'.format(previous_pg_bin, previous_pg_bin),
+            'LD_LIBRARY_PATH': '',
+            'PG_VENV': 'previous_pg_venv',
+            'PS1': '[pg:previous_pg_venv:1234]$ ',
+        }
+        with patch.dict(os.environ, env):
+            # workon generates the activation script if it is missing
+            with contextlib.redirect_stdout(io.StringIO()) as workon_output:
+                workon(TMP_PG_VENV)
+            self.assertTrue(os.path.isfile(get_activation_script(TMP_PG_VENV)))
+
+            show_env = '\necho "$PATH|$LD_LIBRARY_PATH|$PGPORT|$PS1|$PG_VENV|$PGDATA|$PG_SRC"'
+            from_workon = subprocess.check_output(['bash', '-c', workon_output.getvalue() + show_env], env=os.environ)
+            from_script = subprocess.check_output(['bash', '-c', 'source {}'.format(get_activation_script(TMP_PG_VENV)) + show_env], env=os.environ)
+
+        self.assertEqual(from_script, from_workon)
+        self.assertTrue(from_script.startswith('{}:/usr/bin:/bin|'.format(get_pg_bin(TMP_PG_VENV)).encode()))
+        os.remove(get_activation_script(TMP_PG_VENV))
+
+
+    def test_bench(self):
+        output = '\n'.join([
+            'number of transactions actually processed: 12000',
+            'latency average = 5.012 ms',
+            'tps = 1995.123 (including connections establishing)',
+            'tps = 1996.456 (excluding connections establishing)',
+        ])
+        self.assertEqual(parse_pgbench_output(output), {'transactions': 12000, 'tps': 1996.456, 'latency_avg': 5.012})
+        self.assertEqual(parse_pgbench_output('tps = 12.5 (without initial connection time)')['tps'], 12.5)
+
+        self.assertEqual(percentile([1, 2, 3, 4, 5], 50), 3)
+        self.assertEqual(percentile([1, 2], 50), 1.5)
+        self.assertIsNone(percentile([], 99))
+
+        low, high = bootstrap_ci([1.02, 1.03, 1.01, 1.04, 1.02])
+        self.assertTrue(1 < low < 1.025 < high < 1.04)
+        self.assertEqual(bootstrap_ci([1.0, 1.0]), (1.0, 1.0))
+
+        log_dir = os.path.join(self.pg_venv_home, 'bench_logs')
+        os.makedirs(log_dir)
+        with open(os.path.join(log_dir, 'pgbench_log.123'), 'w') as f:
+            f.write('0 0 3000 0 1577836800 1\n0 1 1000 0 1577836800 2\n1 0 failed 0 1577836800 3\n1 1 12345 0 1577836800 4\n0 2 1000 0 1577836800 5\n')
+        latencies = read_pgbench_latencies(log_dir)
+        self.assertEqual(latencies, {1: 2, 3: 1, 12.3: 1})
+        self.assertEqual(os.listdir(log_dir), [])
+        shutil.rmtree(log_dir)
+
+        self.assertEqual(histogram_percentile(latencies, 50), percentile([1, 1, 3, 12.3], 50))
+        self.assertEqual(histogram_percentile(latencies, 99), percentile([1, 1, 3, 12.3], 99))
+        self.assertEqual(histogram_percentile({5: 1}, 90), 5)
+        self.assertIsNone(histogram_percentile({}, 50))
+
+        for tps in [100, 110]:
+            record_bench_run({'time': 1577836800 + tps, 'pg_venv': TMP_PG_VENV, 'workload': 'tpcb-like', 'tps': tps})
+        record_bench_run({'time': 1577836900, 'pg_venv': 'other', 'workload': 'select-only', 'tps': 500})
+        self.assertEqual([r['tps'] for r in get_bench_runs(TMP_PG_VENV)], [100, 110])
+        self.assertEqual([r['tps'] for r in get_bench_runs(limit=2)], [500, 110])
+        self.assertEqual([r['pg_venv'] for r in get_bench_runs(workload='select-only')], ['other'])
+
+
+    def test_conf_profile(self):
+        gb = 1024 * 1024 * 1024
+        settings = get_conf_profile_settings('benchmark-durable', 16, 64 * gb)
+        self.assertEqual(settings['shared_buffers'], '16384MB')
+        self.assertEqual(settings['max_parallel_workers'], '16')
+        self.assertNotIn('fsync', settings)
+        self.assertEqual(get_conf_profile_settings('benchmark-unsafe', 16, 64 * gb)['fsync'], 'off')
+        # settings unknown to old versions are left out
+        self.assertNotIn('max_parallel_workers', get_conf_profile_settings('dev', 4, 8 * gb, (9, 6)))
+
+        data_dir = get_pg_data(TMP_PG_VENV)
+        with open(os.path.join(data_dir, 'PG_VERSION'), 'w') as f:
+            f.write('16\n')
+        with open(os.path.join(data_dir, 'postgresql.conf'), 'w') as f:
+            f.write("#shared_buffers = 128MB\n")
+
+        self.assertIn('shared_buffers', apply_conf_profile(TMP_PG_VENV, 'dev'))
+        self.assertEqual(apply_conf_profile(TMP_PG_VENV, 'dev'), [])
+        self.assertEqual(read_conf_profile(TMP_PG_VENV)['work_mem'], '16MB')
+        changed_settings = apply_conf_profile(TMP_PG_VENV, 'low-memory')
+        self.assertIn('max_connections', changed_settings)
+        with open(os.path.join(data_dir, 'postgresql.conf')) as f:
+            self.assertEqual(f.read().count('include_if_exists'), 1)
+
+        for f in os.listdir(data_dir):
+            os.unlink(os.path.join(data_dir, f))
+
+
+    def test_stream_output(self):
+        log_file = os.path.join(get_pg_venv_dir(TMP_PG_VENV), 'logs', 'make.log')
+        output = [b'line %d\n' % i for i in range(1000)]
+        with patch.dict(os.environ, {'PG_LOG_TAIL_LINES': '2', 'PG_LOG_ROTATE': '2'}):
+            for _ in range(4):
+                tail = stream_output(iter(output), log_file)
+            self.assertEqual(tail, ['line 998\n', 'line 999\n'])
+            self.assertEqual(sorted(os.listdir(os.path.dirname(log_file))), ['make.log', 'make.log.1', 'make.log.2'])
+            with open(log_file, 'rb') as f:
+                self.assertEqual(f.readlines(), output)
+        shutil.rmtree(os.path.dirname(log_file))
+
+
+    def test_timings(self):
+        self.assertEqual(format_duration(4.21), '4.2s')
+        self.assertEqual(format_duration(41), '41s')
+        self.assertEqual(format_duration(192), '3m12s')
+        self.assertEqual(format_duration(3720), '1h02m')
+
+        with timed('create_virtualenv', TMP_PG_VENV, kind='action') as timing:
+            with timed('configure'):
+                execute_cmd('true', verbose=False)
+            timing['return_code'] = 0
+        self.assertEqual(timing['phase'], 'create_virtualenv')
+
+        timings = read_timings(TMP_PG_VENV)[-3:]
+        self.assertEqual([t['kind'] for t in timings], ['command', 'phase', 'action'])
+        self.assertEqual({t['action'] for t in timings}, {'create_virtualenv'})
+        self.assertEqual(len({t['run'] for t in timings}), 1)
+        self.assertEqual(timings[0]['return_code'], 0)
+        self.assertTrue(timings[2]['wall'] >= timings[1]['wall'] >= timings[0]['wall'] >= 0)
+        os.unlink(os.path.join(get_pg_venv_dir(TMP_PG_VENV), 'timings.jsonl'))
+
+
+    def test_index(self):
+        if os.path.isfile(get_index_file()):
+            os.remove(get_index_file())
+
+        # the index is built when it is missing
+        self.assertEqual(indexed_pg_venvs(), [TMP_PG_VENV])
+        self.assertEqual(read_index(), {TMP_PG_VENV: {'running': False, 'port': 18854, 'version': None, 'pg_config_mtime': None}})
+
+        os.makedirs(get_pg_venv_dir('other_pg_venv'))
+        update_index(['other_pg_venv'])
+        self.assertEqual(indexed_pg_venvs(), ['other_pg_venv', TMP_PG_VENV])
+
+        # removed pg_venvs are removed from the index
+        os.rmdir(get_pg_venv_dir('other_pg_venv'))
+        update_index()
+        self.assertEqual(list(read_index()), [TMP_PG_VENV])
+
+        with open(get_index_file()) as f:
+            self.assertEqual(f.read(), '{}\tstopped\t18854\t-\t-\n'.format(TMP_PG_VENV))
+
+
+    def test_get_bool_env_var(self):
+        with patch.dict(os.environ, {'PG_CCACHE': 'Off', 'PG_PROGRESS': 'yes'}):
+            os.environ.pop('PG_INSTALL_STORE', None)
+            self.assertFalse(get_bool_env_var('PG_CCACHE'))
+            self.assertTrue(get_bool_env_var('PG_PROGRESS', default=False))
+            self.assertTrue(get_bool_env_var('PG_INSTALL_STORE'))
+            self.assertFalse(get_bool_env_var('PG_INSTALL_STORE', default=False))
+
+
+    def test_main(self):
+        # a wrong combination of arguments is a usage error
+        with patch.object(ACTIONS['disk_usage'], 'function', lambda: 0), \
+                contextlib.redirect_stdout(io.StringIO()), \
+                contextlib.redirect_stderr(io.StringIO()) as output:
+            self.assertEqual(pg_venv.main(['disk_usage', TMP_PG_VENV]), 2)
+        self.assertIn('some arguments were not understood', output.getvalue())
+
+        # other TypeErrors are bugs
+        def disk_usage(pg_venv, rescan):
+            return None + 1
+        with patch.object(ACTIONS['disk_usage'], 'function', disk_usage), self.assertRaises(TypeError):
+            pg_venv.main(['disk_usage', TMP_PG_VENV])
+
+
+    def test_parse_pg_version(self):
+        self.assertEqual(parse_pg_version('9.6.1'), (9, 6, 1))
+        self.assertEqual(parse_pg_version('12.1'), (12, 1))
+        self.assertEqual(parse_pg_version('16devel'), (16,))
+        self.assertEqual(parse_pg_version('17beta1'), (17,))
+        self.assertTrue(parse_pg_version('9.6.1') < (10,))
+
+
+    def test_read_postmaster_pid(self):
+        self.write_postmaster_pid([str(os.getpid()), get_pg_data(TMP_PG_VENV), '1577836800', '5433', '/tmp', 'localhost', '  5433001  32768', 'ready   '])
+        postmaster_pid = read_postmaster_pid(TMP_PG_VENV)
+
+        self.assertEqual(postmaster_pid['pid'], os.getpid())
+        self.assertEqual(postmaster_pid['port'], 5433)
+        self.assertEqual(postmaster_pid['socket_dir'], '/tmp')
+        self.assertEqual(postmaster_pid['status'], 'ready')
+        self.assertTrue(asyncio.run(wait_for_pg_ready_async(TMP_PG_VENV, timeout=0)))
+
+        # file being written by a starting server
+        self.write_postmaster_pid([str(os.getpid()), get_pg_data(TMP_PG_VENV)])
+        self.assertIsNone(read_postmaster_pid(TMP_PG_VENV))
+        self.assertFalse(asyncio.run(wait_for_pg_ready_async(TMP_PG_VENV, timeout=0.1)))
+
+
+    def test_read_ccache_stats_log(self):
+        with open(get_ccache_stats_log(TMP_PG_VENV), 'w') as f:
+            f.write('# src/backend/a.c\ndirect_cache_hit\n')
+            f.write('# src/backend/b.c\ndirect_cache_miss\npreprocessed_cache_hit\n')
+            f.write('# src/backend/c.c\ncache_miss\n')
+            offset = f.tell()
+            f.write('# src/backend/d.c\ncalled_for_link\n')
+
+        self.assertEqual(read_ccache_stats_log(TMP_PG_VENV), {'hits': 2, 'misses': 1, 'uncacheable': 1})
+        self.assertEqual(read_ccache_stats_log(TMP_PG_VENV, offset), {'hits': 0, 'misses': 0, 'uncacheable': 1})
+
+        builds = [{'hits': 0, 'misses': 100, 'duration': 50}, {'hits': 99, 'misses': 1, 'duration': 2}]
+        self.assertEqual(estimate_compilation_duration(builds), 52 / 101)
+        self.assertIsNone(estimate_compilation_duration([{'hits': 10, 'misses': 0, 'duration': 1}]))
+
+
+    @patch.dict(os.environ, {'PG_BUILD_SCHEDULER': '1', 'PG_MAX_CONCURRENT_BUILDS': '1', 'PG_BUILD_JOBS': '2'})
+    def test_build_slot(self):
+        # a ticket left by a dead process, whose pid is used by a live one
+        queue_dir = os.path.join(get_jobserver_dir(), 'queue')
+        os.makedirs(queue_dir, exist_ok=True)
+        open(os.path.join(queue_dir, '{:020d}-{}-other_pg_venv'.format(0, os.getpid())), 'w').close()
+
+        async def build():
+            async with build_slot_async(TMP_PG_VENV, verbose=True) as (env, fds):
+                self.assertEqual(len(get_build_queue()), 1)
+                self.assertIn('-j --jobserver-', env['MAKEFLAGS'])
+
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            asyncio.run(build())
+        self.assertEqual(output.getvalue(), '')
+        self.assertEqual(get_build_queue(), [])
+
+        shutil.rmtree(get_jobserver_dir())
+
+
+    def test_build_makefile(self):
+        pg_src = get_pg_src(TMP_PG_VENV)
+        for subdir in ['', 'contrib']:
+            os.makedirs(os.path.join(pg_src, subdir), exist_ok=True)
+            with open(os.path.join(pg_src, subdir, 'Makefile'), 'w') as f:
+                f.write('all:\n\tsleep 0.2\ninstall:\n\tsleep 0.2\n')
+
+        cmd = ['make', '-s', '-j', '4', '-f', write_build_makefile(TMP_PG_VENV), 'core', 'contrib', 'core-install', 'contrib-install']
+        subprocess.check_call(cmd, cwd=pg_src)
+        with open(get_build_phase_log(TMP_PG_VENV)) as f:
+            phases = {phase: (float(start), float(end)) for phase, start, end in map(str.split, f)}
+
+        # contrib rebuilds parts of core, it must not run concurrently with it
+        self.assertGreaterEqual(phases['contrib'][0], phases['core'][1])
+        self.assertGreaterEqual(phases['contrib-install'][0], phases['core-install'][1])
+        # but it is compiled while core is installed
+        self.assertLess(phases['contrib'][0], phases['core-install'][1])
+
+        shutil.rmtree(pg_src)
+        os.unlink(get_build_phase_log(TMP_PG_VENV))
+        os.unlink(os.path.join(get_pg_venv_dir(TMP_PG_VENV), 'build.mk'))
+
+
+    def test_daemon(self):
+        daemon = Daemon()
+        os.makedirs(os.path.join(self.pg_venv_home, '.pg_venvd'), exist_ok=True)
+        daemon.refresh()
+
+        # the disk usage is computed by refresh, outside of the lock
+        with patch('pg_venvd.get_disk_usage', side_effect=AssertionError):
+            pg_venvs = daemon.handle({'command': 'list'})['pg_venvs']
+        self.assertEqual([(p['pg_venv'], p['running'], p['build']) for p in pg_venvs], [(TMP_PG_VENV, False, None)])
+        self.assertIn('error', daemon.handle({'command': 'status', 'pg_venv': 'other_pg_venv'}))
+
+        # once the disk usage has been scanned, refreshing doesn't write the
+        # metadata of the pg_venvs
+        with patch('utils.update_pg_metadata', side_effect=AssertionError):
+            daemon.refresh()
+
+        # jobs of a pg_venv run one after the other, in order of submission
+        for argv in [['status', TMP_PG_VENV], ['list', '--json']]:
+            daemon.handle({'command': 'submit', 'argv': argv, 'pg_venv': TMP_PG_VENV, 'env': dict(os.environ), 'cwd': os.getcwd()})
+        for _ in range(100):
+            jobs = daemon.handle({'command': 'status', 'pg_venv': TMP_PG_VENV})['jobs']
+            if all(job['state'] == 'done' for job in jobs):
+                break
+            time.sleep(0.1)
+
+        self.assertEqual([(job['id'], job['return_code']) for job in jobs], [(1, 0), (2, 0)])
+        self.assertLessEqual(jobs[0]['end_time'], jobs[1]['start_time'])
+        with open(jobs[1]['log']) as f:
+            self.assertEqual(json.load(f)[0]['pg_venv'], TMP_PG_VENV)
+        shutil.rmtree(os.path.join(self.pg_venv_home, '.pg_venvd'))
+
+
+    def test_bulk(self):
+        os.makedirs(get_pg_venv_dir('other_pg_venv'))
+        self.assertEqual(select_pg_venvs(all_pg_venvs=True), ['other_pg_venv', TMP_PG_VENV])
+        self.assertEqual(select_pg_venvs(pattern='tmp_*'), [TMP_PG_VENV])
+        self.assertEqual(select_pg_venvs(running=True), [])
+
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertEqual(run_bulk('status', {}, pattern='*_pg_venv', parallel=2), 0)
+        self.assertEqual([line.split()[:2] for line in output.getvalue().splitlines() if ' OK ' in line], [['other_pg_venv', 'OK'], [TMP_PG_VENV, 'OK']])
+        with open(get_phase_log_file('other_pg_venv', 'bulk status')) as f:
+            self.assertIn('pg_venv:    other_pg_venv', f.read())
+
+        # a locked pg_venv waits for the lock to be released
+        with lock_pg_venv(TMP_PG_VENV):
+            code = 'from utils import lock_pg_venv\nwith lock_pg_venv({!r}): pass'.format(TMP_PG_VENV)
+            process = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE)
+            time.sleep(0.5)
+            self.assertIsNone(process.poll())
+        self.assertEqual(process.wait(timeout=10), 0)
+        self.assertIn(b'Waiting for another action', process.stdout.read())
+
+        shutil.rmtree(get_pg_venv_dir('other_pg_venv'))
+        shutil.rmtree(os.path.join(get_pg_venv_dir(TMP_PG_VENV), 'logs'))
+
+
+    def test_api(self):
+        self.assertEqual(api.status(TMP_PG_VENV)['pg_venv'], TMP_PG_VENV)
+        self.assertEqual([info['pg_venv'] for info in api.list_pg_venvs()], [TMP_PG_VENV])
+        # the blocking functions run in threads
+        self.assertEqual(asyncio.run(api.status_async(TMP_PG_VENV))['pg_venv'], TMP_PG_VENV)
+        with self.assertRaises(PgVenvError):
+            api.status('nonexistent_pg_venv')
+
+        async def run_concurrently():
+            return await asyncio.gather(*[execute_cmd_async(['sh', '-c', 'echo {}'.format(i)], 'echo {}'.format(i), TMP_PG_VENV) for i in range(2)])
+        results = asyncio.run(run_concurrently())
+        self.assertEqual([result['output'] for result in results], ['0\n', '1\n'])
+        self.assertEqual(results[0]['return_code'], 0)
+        with open(results[0]['log_file']) as f:
+            self.assertEqual(f.read(), '0\n')
+
+        with self.assertRaises(CommandError) as context:
+            asyncio.run(execute_cmd_async(['sh', '-c', 'echo failed; exit 3'], 'fail', TMP_PG_VENV))
+        self.assertEqual(context.exception.return_code, 3)
+        self.assertEqual(context.exception.output, 'failed\n')
+
+        # the errors of the actions called in the current process are raised
+        with patch.dict(os.environ), self.assertRaises(PgVenvError):
+            os.environ.pop('PG_VENV', None)
+            get_env_var('PG_VENV')
+
+        shutil.rmtree(os.path.join(get_pg_venv_dir(TMP_PG_VENV), 'logs'))
+
+
+    def test_disk_usage(self):
+        self.assertEqual(format_size(512), '512')
+        self.assertEqual(format_size(8 * 1024), '8.0K')
+        self.assertEqual(format_size(340 * 1024 * 1024), '340M')
+
+        data_dir = get_pg_data(TMP_PG_VENV)
+        with open(os.path.join(data_dir, 'file'), 'wb') as f:
+            f.write(os.urandom(64 * 1024))
+        os.link(os.path.join(data_dir, 'file'), os.path.join(data_dir, 'hardlink'))
+
+        size, shared_size, complete = scan_disk_usage(data_dir)
+        self.assertTrue(complete)
+        # the hardlinked file is only counted once
+        self.assertTrue(64 * 1024 <= size < 2 * 64 * 1024)
+        self.assertEqual(shared_size, size)
+
+        os.unlink(os.path.join(data_dir, 'file'))
+        os.unlink(os.path.join(data_dir, 'hardlink'))
+
+        # reading the disk usage doesn't write the metadata, the log is
+        # measured without being recorded
+        update_disk_usage(TMP_PG_VENV)
+        with open(get_pg_log(TMP_PG_VENV), 'a') as f:
+            f.write('x' * 64 * 1024)
+        with patch('utils.update_pg_metadata', side_effect=AssertionError):
+            self.assertGreaterEqual(get_disk_usage_breakdown(TMP_PG_VENV)['log']['bytes'], 64 * 1024)
+        os.unlink(get_pg_log(TMP_PG_VENV))
+
+
+    def test_initdb_template_failure(self):
+        # an initdb that fails after writing in its data directory
+        pg_bin = get_pg_bin(TMP_PG_VENV)
+        os.makedirs(pg_bin, exist_ok=True)
+        with open(os.path.join(pg_bin, 'initdb'), 'w') as f:
+            f.write('#!/bin/sh\nmkdir -p "$2" && touch "$2/PG_VERSION"\nexit 1\n')
+        os.chmod(os.path.join(pg_bin, 'initdb'), 0o755)
+        os.rmdir(get_pg_data(TMP_PG_VENV))
+
+        templates_dir = os.path.join(self.pg_venv_home, '.initdb_templates')
+        with patch.dict(os.environ, {'PG_INITDB_TEMPLATE': '1'}), patch('utils.get_initdb_template_dir', return_value=os.path.join(templates_dir, 'template')), contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(CommandError):
+                initdb(TMP_PG_VENV, exit_on_fail=True)
+        # the half-initialized template doesn't stay behind
+        self.assertEqual(os.listdir(templates_dir), [])
+
+        shutil.rmtree(templates_dir)
+        os.unlink(os.path.join(pg_bin, 'initdb'))
+        os.makedirs(get_pg_data(TMP_PG_VENV))
+
+
+    def test_update_pg_metadata(self):
+        # concurrent updates don't lose each other's keys
+        code = 'import sys\nfrom utils import update_pg_metadata\nfor i in range(20): update_pg_metadata({!r}, **{{sys.argv[1]: i}})'.format(TMP_PG_VENV)
+        processes = [subprocess.Popen([sys.executable, '-c', code, 'key{}'.format(i)]) for i in range(4)]
+        self.assertEqual([p.wait(timeout=30) for p in processes], [0] * 4)
+
+        metadata = get_pg_metadata(TMP_PG_VENV)
+        self.assertEqual([metadata['key{}'.format(i)] for i in range(4)], [19] * 4)
+        update_pg_metadata(TMP_PG_VENV, **{'key{}'.format(i): None for i in range(4)})
+
+
+    def test_install_store(self):
+        pg_venv_dir = get_pg_venv_dir(TMP_PG_VENV)
+        staging_dir = os.path.join(self.pg_venv_home, 'install_staging')
+
+        def stage(files):
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            for path, content in files.items():
+                staged_file = os.path.join(staging_dir, pg_venv_dir.lstrip(os.sep), path)
+                os.makedirs(os.path.dirname(staged_file), exist_ok=True)
+                with open(staged_file, 'w') as f:
+                    f.write(content)
+
+        stage({'bin/postgres': 'postgres', 'share/extension/a.sql': 'a', 'share/doc/index.html': 'doc'})
+        install_from_staging_dir(TMP_PG_VENV, staging_dir)
+        self.assertEqual(os.stat(os.path.join(pg_venv_dir, 'bin', 'postgres')).st_nlink, 2)
+
+        # files that can't be hardlinked are copied, and kept in the store
+        stage({'bin/postgres': 'postgres', 'share/extension/b.sql': 'b'})
+        with patch('os.link', side_effect=OSError):
+            manifest = install_from_staging_dir(TMP_PG_VENV, staging_dir)
+        self.assertEqual(os.stat(os.path.join(pg_venv_dir, 'share', 'extension', 'b.sql')).st_nlink, 1)
+
+        # a.sql isn't installed anymore, the documentation wasn't installed
+        # again
+        self.assertEqual(gc_install_store(), len('a'))
+        self.assertFalse(os.path.exists(os.path.join(pg_venv_dir, 'share', 'extension', 'a.sql')))
+        self.assertEqual(sorted(manifest['files']), ['bin/postgres', 'share/doc/index.html', 'share/extension/b.sql'])
+
+        os.unlink(get_install_manifest_file(TMP_PG_VENV))
+        for install_dir in ['bin', 'share']:
+            shutil.rmtree(os.path.join(pg_venv_dir, install_dir))
+        self.assertEqual(gc_install_store(), len('postgres') + len('b') + len('doc'))
+        shutil.rmtree(staging_dir)
+
+
+    @patch.dict(os.environ, {'PG_SNAPSHOT_METHOD': 'tar'})
+    def test_snapshot(self):
+        data_dir = get_pg_data(TMP_PG_VENV)
+        for f in os.listdir(data_dir):
+            os.unlink(os.path.join(data_dir, f))
+        with open(os.path.join(data_dir, 'PG_VERSION'), 'w') as f:
+            f.write('16\n')
+
+        self.assertEqual(snapshot('loaded', pg_venv=TMP_PG_VENV), 0)
+        # snapshot names are unique
+        self.assertEqual(snapshot('loaded', pg_venv=TMP_PG_VENV), 1)
+        self.assertEqual([s['name'] for s in get_snapshots(TMP_PG_VENV)], ['loaded'])
+
+        with open(os.path.join(data_dir, 'PG_VERSION'), 'w') as f:
+            f.write('17\n')
+        self.assertEqual(restore(pg_venv=TMP_PG_VENV), 0)
+        with open(os.path.join(data_dir, 'PG_VERSION')) as f:
+            self.assertEqual(f.read(), '16\n')
+
+        self.assertEqual(rm_snapshot('loaded', pg_venv=TMP_PG_VENV), 0)
+        self.assertEqual(get_snapshots(TMP_PG_VENV), [])
+        self.assertEqual(restore(pg_venv=TMP_PG_VENV), 1)
+        os.unlink(os.path.join(data_dir, 'PG_VERSION'))
+
+
+    def test_tmpfs(self):
+        tmpfs_dir = os.path.join(self.pg_venv_home, 'tmpfs')
+        data_dir = get_pg_data(TMP_PG_VENV)
+        with patch.dict(os.environ, {'PG_TMPFS_DIR': tmpfs_dir}):
+            set_tmpfs(TMP_PG_VENV, 'data', True)
+            self.assertEqual(os.readlink(data_dir), os.path.join(tmpfs_dir, TMP_PG_VENV, 'data'))
+            self.assertEqual(recreate_tmpfs_dirs(TMP_PG_VENV), [])
+
+            # simulate a reboot
+            shutil.rmtree(tmpfs_dir)
+            self.assertEqual(recreate_tmpfs_dirs(TMP_PG_VENV), ['data'])
+            self.assertTrue(os.path.isdir(data_dir))
+
+            set_tmpfs(TMP_PG_VENV, 'data', False)
+            self.assertFalse(os.path.islink(data_dir))
+            self.assertTrue(os.path.isdir(data_dir))
+            self.assertEqual(recreate_tmpfs_dirs(TMP_PG_VENV), [])
+
+
+class StartupTestCase(unittest.TestCase):
+    '''
+    Test what the CLI loads to get to the action, since scripts run actions
+    such as start and stop in loops
+    '''
+    def test_startup_imports(self):
+        # the modules only some actions need are imported by these actions,
+        # not when parsing the arguments of `pg stop`
+        code = 'import pg_venv; pg_venv.parse_args(["stop"])'
+        # parsing must not touch the filesystem, which needs PG_VIRTUALENV_HOME
+        env = {k: v for k, v in os.environ.items() if k != 'PG_VIRTUALENV_HOME'}
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', code],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=env,
+            stderr=subprocess.PIPE,
+            check=True,
+        )
+
+        # import time: self [us] | cumulative | imported package
+        modules = [line.split('|')[-1].strip() for line in process.stderr.decode('utf-8').splitlines() if line.startswith('import time:')]
+        self.assertIn('pg_venv', modules)
+        for module in ['api', 'asyncio', 'concurrent.futures', 'hashlib', 'multiprocessing', 'random', 'socket', 'sqlite3', 'tempfile']:
+            self.assertNotIn(module, modules)
+
+
+    def test_stop_imports(self):
+        # running `pg stop`, on a pg_venv whose server isn't running, doesn't
+        # go through the Python API, slow to import
+        pg_venv_home = os.path.join(TMP_DIR, 'startup')
+        os.makedirs(os.path.join(pg_venv_home, 'stopped_pg_venv', 'data'))
+        code = 'import pg_venv; pg_venv.main(["stop", "stopped_pg_venv"])'
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', code],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=dict(os.environ, PG_VIRTUALENV_HOME=pg_venv_home),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+            check=True,
+        )
+
+        modules = [line.split('|')[-1].strip() for line in process.stderr.decode('utf-8').splitlines() if line.startswith('import time:')]
+        self.assertIn('actions', modules)
+        for module in ['api', 'asyncio']:
+            self.assertNotIn(module, modules)
+
+        shutil.rmtree(pg_venv_home)
+
+
 if __name__ == '__main__':
     # use -v or --verbose flag to get tested functions' output
     verbose = '--verbose' in sys.argv or '-v' in sys.argv
 
     runner = unittest.TextTestRunner(buffer=not verbose)
 
+    utils_test_suite = unittest.TestSuite()
+    utils_test_suite.addTest(unittest.makeSuite(UtilsTestCase))
+    utils_test_suite.addTest(unittest.makeSuite(StartupTestCase))
+    runner.run(utils_test_suite)
+
     # run expensive tests only if --all is in the arguments
     if '--all' in sys.argv:
         create_virtualenv_test_suite = unittest.TestSuite()
@@ -1,10 +1,131 @@
+import collections
+import contextlib
+import contextvars
+import fcntl
+import fnmatch
+import json
 import os
+import re
+import resource
+import shutil
+import struct
 import subprocess
 import sys
+import time
+
+# modules that are slow to import (concurrent.futures, hashlib, random,
+# socket, sqlite3) are imported by the functions that use them, so that the
+# CLI starts fast (see StartupTestCase)
 
 
 _LOG_PREFIX = 'pg: '
 
+# action, phase and pg_venv the commands run by execute_cmd are timed for,
+# see timed
+_timing_context = contextvars.ContextVar('timing_context', default=None)
+
+# number of builds for which ccache statistics are kept in a pg_venv's metadata
+_CCACHE_BUILDS_KEPT = 20
+
+# directories of a pg_venv where postgresql is installed
+_INSTALL_DIRS = ['bin', 'include', 'lib', 'share']
+
+# pgbench's built-in workloads, see run_pgbench
+BENCH_WORKLOADS = ['select-only', 'simple-update', 'tpcb-like']
+
+# configuration profiles, see get_conf_profile_settings
+CONF_PROFILES = ['benchmark-durable', 'benchmark-unsafe', 'dev', 'low-memory']
+
+# file of the data directory where the settings of a profile are written
+_CONF_PROFILE_FILE = 'postgresql.pg_venv.conf'
+
+# settings of the profiles that are only taken into account at server start
+CONF_RESTART_SETTINGS = ['max_connections', 'max_wal_senders', 'max_worker_processes', 'shared_buffers', 'wal_buffers', 'wal_level']
+
+# first major version supporting the settings of the profiles that are not
+# supported by all versions
+_CONF_SETTINGS_MIN_VERSION = {
+    'max_parallel_maintenance_workers': (11,),
+    'max_parallel_workers': (10,),
+    'max_parallel_workers_per_gather': (9, 6),
+    'max_wal_size': (9, 5),
+    'min_wal_size': (9, 5),
+}
+
+
+class PgVenvError(Exception):
+    '''
+    Raised when an action can't go on, after the reason has been logged, so
+    that the actions can be used as a library (see api.py). pg_venv.py exits
+    with code -1.
+    '''
+
+
+class CommandError(PgVenvError):
+    '''
+    Raised by execute_cmd when a command fails and exit_on_fail is set, and
+    by execute_cmd_async when a command fails
+    output is the end of the output of the command, if it was captured.
+    '''
+    def __init__(self, cmd, return_code, log_file=None, output=None):
+        super().__init__('`{}` returned {}'.format(cmd, return_code))
+        self.cmd = cmd
+        self.return_code = return_code
+        self.log_file = log_file
+        self.output = output
+
+
+class OutputLog():
+    '''
+    Where the output of a process goes, line by line, when it isn't displayed
+    (see stream_output and execute_cmd_async)
+    '''
+    def __init__(self, log_file=None, progress_description=None, tail_lines=None):
+        if tail_lines is None:
+            tail_lines = int(os.environ.get('PG_LOG_TAIL_LINES', 50))
+        self.tail = collections.deque(maxlen=tail_lines)
+
+        self.file = None
+        if log_file is not None:
+            os.makedirs(os.path.dirname(log_file), exist_ok=True)
+            rotate_log(log_file)
+            self.file = open(log_file, 'wb')
+
+        self.progress_description = progress_description
+        self.show_progress = progress_description is not None \
+            and sys.stdout.isatty() \
+            and get_bool_env_var('PG_PROGRESS')
+        self.compiled_files, self.ninja_step = 0, None
+        self.last_progress = 0
+
+
+    def write(self, line):
+        if self.file is not None:
+            self.file.write(line)
+        self.tail.append(line.decode('utf-8', errors='replace'))
+
+        if not self.show_progress:
+            return
+        match = re.match(rb'\[(\d+/\d+)\] ', line)
+        if match:
+            self.ninja_step = match.group(1).decode()
+        elif re.match(rb'\s*(ccache\s+)?\S*(cc|gcc|clang)\s.*\s-c\s', line):
+            self.compiled_files += 1
+        # don't spend time refreshing the terminal more than needed
+        if time.monotonic() - self.last_progress > 0.2 and (self.ninja_step or self.compiled_files):
+            self.last_progress = time.monotonic()
+            progress = self.ninja_step if self.ninja_step else '{} files compiled'.format(self.compiled_files)
+            print('\r{}{}... {} '.format(_LOG_PREFIX, self.progress_description, progress), end='', flush=True)
+
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+        if self.show_progress and (self.ninja_step or self.compiled_files):
+            # the result of the command is displayed after the description
+            print('\r\033[K{}{}... '.format(_LOG_PREFIX, self.progress_description), end='', flush=True)
+
 
 def colorize(message, message_type='log'):
     '''
@@ -41,7 +162,7 @@ def log(message, message_type='log', end='\n', prefix=True):
     )
 
 
-def execute_cmd(cmd, cmd_description='', verbose=True, verbose_cmd=False, exit_on_fail=False, process_output=True, error_output=True):
+def execute_cmd(cmd, cmd_description='', verbose=True, verbose_cmd=False, exit_on_fail=False, process_output=True, error_output=True, env=None, pass_fds=()):
     '''
     Execute a shell command, binding stdin and stdout to this process' stdin
     and stdout.
@@ -50,24 +171,48 @@ def execute_cmd(cmd, cmd_description='', verbose=True, verbose_cmd=False, exit_o
     The command to be executed will be printed if verbose_cmd is True.
     The process' output will be displayed if process_output is True, or if the
     process returns a non-zero code.
+    env contains environment variables to set for the process, in addition to
+    the ones of this process.
+    pass_fds are file descriptors the process inherits.
+    If exit_on_fail is True, CommandError is raised if the process fails.
     '''
+    if env is not None:
+        env = dict(os.environ, **env)
+
     if verbose_cmd:
         log('executing `{}`'.format(cmd))
 
     if verbose:
         log(cmd_description + '... ', end='')
 
+    log_file, output_tail = None, []
+    start_time, start = time.time(), time.monotonic()
     if not process_output:
-        process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # the output goes to a log file of the pg_venv, and only its last lines
+        # are kept in memory, to be displayed if the command fails
+        context = _timing_context.get()
+        if context:
+            log_file = get_phase_log_file(context['pg_venv'], cmd_description or cmd)
+        process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env, pass_fds=pass_fds)
+        try:
+            output_tail = stream_output(process.stdout, log_file, cmd_description if verbose else None)
+        finally:
+            process.stdout.close()
     else:
-        process = subprocess.Popen(cmd, shell=True)
-    _, err = process.communicate()
+        process = subprocess.Popen(cmd, shell=True, env=env, pass_fds=pass_fds)
 
-    # display the process output if it returned non-zero, even if process output
-    # is disabled.
+    # wait for the process ourselves, to get its resource usage
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    record_command_timing(cmd, cmd_description, start_time, time.monotonic() - start, usage, process.returncode)
+
+    # display the end of the process output if it returned non-zero, even if
+    # process output is disabled.
     if process.returncode != 0 and not process_output and error_output:
         print() # new line
-        print(err.decode('utf-8'))
+        print(''.join(output_tail), end='')
+        if log_file is not None:
+            log('Full output in {}'.format(log_file), 'error')
 
     if verbose:
         if process.returncode == 0:
@@ -77,11 +222,82 @@ def execute_cmd(cmd, cmd_description='', verbose=True, verbose_cmd=False, exit_o
             log('command used: {}'.format(cmd), 'error', prefix=False)
 
     if exit_on_fail and process.returncode != 0:
-        exit(-1)
+        raise CommandError(cmd, process.returncode, log_file)
 
     return process.returncode
 
 
+async def execute_cmd_async(cmd, cmd_description='', pg_venv=None, env=None, cwd=None, pass_fds=(), progress=False, tail_lines=None):
+    '''
+    Execute a command (a list of arguments, run without a shell) with
+    asyncio.create_subprocess_exec, and return its result as a dict with keys
+    cmd, return_code, duration (in seconds), log_file and output
+
+    The output of the command is written to a log file of pg_venv (see
+    get_phase_log_file), or of the pg_venv of the timed phase it runs in, and
+    only its last lines (tail_lines, PG_LOG_TAIL_LINES by default) are kept in
+    output. If progress is True, the progress of compilations is displayed
+    after cmd_description (see stream_output).
+    env contains environment variables to set for the process, in addition to
+    the ones of this process.
+    pass_fds are file descriptors the process inherits.
+    CommandError is raised if the process fails. If the coroutine is
+    cancelled, the process is killed.
+    '''
+    import asyncio
+
+    if env is not None:
+        env = dict(os.environ, **env)
+
+    context = _timing_context.get()
+    if pg_venv is None and context:
+        pg_venv = context['pg_venv']
+    log_file = get_phase_log_file(pg_venv, cmd_description or ' '.join(cmd))
+
+    start_time, start = time.time(), time.monotonic()
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            env=env,
+            cwd=cwd,
+            pass_fds=pass_fds,
+            # compiler command lines can be longer than the default limit
+            limit=1024 * 1024,
+        )
+    except OSError as e:
+        # like a shell, when the command can't be found or run
+        raise CommandError(' '.join(cmd), 127, None, '{}\n'.format(e))
+    output_log = OutputLog(log_file, cmd_description if progress else None, tail_lines)
+    try:
+        async for line in process.stdout:
+            output_log.write(line)
+        return_code = await process.wait()
+    finally:
+        output_log.close()
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+    # asyncio doesn't give the resource usage of the process
+    duration = time.monotonic() - start
+    record_command_timing(' '.join(cmd), cmd_description, start_time, duration, None, return_code)
+
+    result = {
+        'cmd': cmd,
+        'return_code': return_code,
+        'duration': round(duration, 3),
+        'log_file': log_file,
+        'output': ''.join(output_log.tail),
+    }
+    if return_code != 0:
+        raise CommandError(' '.join(cmd), return_code, log_file, result['output'])
+
+    return result
+
+
 def get_env_var(env_var, error_on_fail=True):
     '''
     Return the value of an environment variable
@@ -98,21 +314,559 @@ def get_env_var(env_var, error_on_fail=True):
                 log('Please set environment variable {}. See help for '
                     'detail (pg help).'.format(env_var), 'error')
 
-            exit(-1)
+            raise PgVenvError('environment variable {} is not set'.format(env_var))
         else:
             return None
 
 
+def get_bool_env_var(env_var, default=True):
+    '''
+    Return the value of an environment variable used as a switch: False if it
+    is 0, no, off or false, True if it is set to anything else, default if
+    it is not set
+    '''
+    value = os.environ.get(env_var)
+    if value is None:
+        return default
+    return value.lower() not in ['0', 'no', 'off', 'false']
+
+
+def get_activation_script(pg_venv):
+    '''
+    Return the path of the script sourced by `pg workon` to activate a pg_venv
+    '''
+    return os.path.join(get_pg_venv_dir(pg_venv), 'activate')
+
+
+def get_bench_db_file():
+    '''
+    Compute the path of the database where the results of benchmarks are
+    stored
+    '''
+    return os.path.join(get_env_var('PG_VIRTUALENV_HOME'), '.bench.sqlite')
+
+
+def get_bench_runs(pg_venv=None, workload=None, limit=None):
+    '''
+    Return the benchmark runs recorded by record_bench_run, oldest first, as
+    dicts
+    pg_venv and workload only return the runs of a pg_venv or a workload,
+    limit only the most recent ones.
+    '''
+    conditions, params = [], []
+    if pg_venv is not None:
+        conditions.append('pg_venv = ?')
+        params.append(pg_venv)
+    if workload is not None:
+        conditions.append('workload = ?')
+        params.append(workload)
+
+    query = 'SELECT * FROM bench_runs'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY time DESC, id DESC'
+    if limit is not None:
+        query += ' LIMIT {:d}'.format(limit)
+
+    with contextlib.closing(open_bench_db()) as db:
+        return [dict(row) for row in reversed(db.execute(query, params).fetchall())]
+
+
+def get_build_cache_dir(pg_venv, commit):
+    '''
+    Compute the directory where the installed files of a pg_venv built from
+    a commit are kept, see save_build_to_cache
+    '''
+    return os.path.join(get_pg_venv_dir(pg_venv), 'build_cache', commit)
+
+
+def get_build_cmd(pg_venv, targets, make_args=''):
+    '''
+    Return the command running make on the build makefile of a pg_venv (see
+    write_build_makefile) for some targets, from the source dir
+
+    Unless make_args sets the number of jobs, it is given by the build
+    scheduler, or computed from the number of CPUs and the current load if
+    the scheduler is disabled. Make doesn't start new jobs while the load is
+    higher than the number of CPUs.
+    '''
+    build_makefile = write_build_makefile(pg_venv)
+
+    # with the build scheduler, the number of jobs is set by the shared job
+    # pool
+    jobs_args = ''
+    if not re.search(r'(^|\s)(-j|--jobs)', make_args):
+        jobs_args = '-l {}'.format(os.cpu_count())
+        if not build_scheduler_enabled():
+            jobs_args = '-j {} '.format(get_build_jobs()) + jobs_args
+
+    return 'make -s -f {} {} {} {}'.format(build_makefile, jobs_args, make_args, ' '.join(targets))
+
+
+def get_build_env(pg_venv):
+    '''
+    Return the environment variables needed by the commands that may compile
+    something in a pg_venv, or None if there is none
+
+    Builds configured to use ccache need to know where the cache is.
+    '''
+    if get_pg_metadata(pg_venv).get('ccache', False):
+        return get_ccache_env(pg_venv)
+
+    return None
+
+
+def get_build_jobs():
+    '''
+    Return how many jobs a build should use: PG_BUILD_JOBS if it is set,
+    otherwise the number of CPUs that are not already busy
+    '''
+    if os.environ.get('PG_BUILD_JOBS'):
+        return int(os.environ['PG_BUILD_JOBS'])
+
+    cpu_count = os.cpu_count()
+    load = os.getloadavg()[0]
+
+    return max(1, min(cpu_count, round(cpu_count - load)))
+
+
+def get_build_phase_log(pg_venv):
+    '''
+    Compute the path of the file where the build makefile of a pg_venv writes
+    when each phase starts and ends
+    '''
+    return os.path.join(get_pg_venv_dir(pg_venv), 'build_phases.log')
+
+
+def get_build_queue():
+    '''
+    Return the tickets of the builds waiting or running, in order of arrival,
+    after removing the ones of processes that don't exist anymore, i.e. that
+    aren't locked anymore (see build_slot_async)
+    '''
+    queue_dir = os.path.join(get_jobserver_dir(), 'queue')
+    tickets = []
+    for ticket in sorted(os.listdir(queue_dir)):
+        try:
+            ticket_fd = os.open(os.path.join(queue_dir, ticket), os.O_RDONLY)
+        except FileNotFoundError:
+            continue
+
+        try:
+            fcntl.flock(ticket_fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            tickets.append(ticket)
+        else:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(os.path.join(queue_dir, ticket))
+        finally:
+            os.close(ticket_fd)
+
+    return tickets
+
+
+def get_build_states():
+    '''
+    Return the state of the builds in the build queue (see
+    build_slot_async), as a dict {pg_venv: state}, where state is waiting or
+    running
+    '''
+    queue_dir = os.path.join(get_jobserver_dir(), 'queue')
+    if not os.path.isdir(queue_dir):
+        return {}
+
+    build_states = {}
+    for ticket in get_build_queue():
+        with contextlib.suppress(FileNotFoundError), open(os.path.join(queue_dir, ticket)) as f:
+            build_states[ticket.split('-', 2)[2]] = 'running' if f.read() == 'running' else 'waiting'
+
+    return build_states
+
+
+def get_build_system(pg_venv):
+    '''
+    Return the build system of a pg_venv (autoconf or meson)
+
+    It is the one recorded when the pg_venv was configured. For a pg_venv that
+    hasn't been configured yet, it is PG_BUILD_SYSTEM if its source supports
+    it, autoconf otherwise.
+    '''
+    build_system = get_pg_metadata(pg_venv).get('build_system')
+    if build_system is not None:
+        return build_system
+
+    supported_build_systems = get_supported_build_systems(pg_venv)
+    build_system = os.environ.get('PG_BUILD_SYSTEM', 'autoconf')
+    if build_system in supported_build_systems or not supported_build_systems:
+        return build_system
+
+    return supported_build_systems[0]
+
+
+def get_builds_ahead(ticket):
+    '''
+    Return how many builds must be done before the build scheduler admits the
+    one owning ticket (see build_slot_async)
+    '''
+    max_builds = int(os.environ.get('PG_MAX_CONCURRENT_BUILDS', max(1, os.cpu_count() // 4)))
+    position = get_build_queue().index(os.path.basename(ticket))
+
+    return max(0, position - max_builds + 1)
+
+
+def get_cc():
+    '''
+    Return the C compiler used to build postgresql: CC if it is set,
+    otherwise the one configure would pick
+    '''
+    if os.environ.get('CC'):
+        return os.environ['CC']
+
+    return 'gcc' if shutil.which('gcc') else 'cc'
+
+
+def get_ccache_dir():
+    '''
+    Return the directory of the compiler cache shared by all pg_venvs
+    '''
+    return os.path.join(get_env_var('PG_VIRTUALENV_HOME'), '.ccache')
+
+
+def get_ccache_env(pg_venv):
+    '''
+    Return the environment variables to pass to the build of a pg_venv so
+    that it uses the shared compiler cache
+
+    The source dir is used as base dir, and the current dir is not hashed, so
+    that compilations can be shared between the worktrees of different
+    pg_venvs. Each compilation result is logged in the pg_venv's stats log.
+    '''
+    return {
+        'CCACHE_DIR': get_ccache_dir(),
+        'CCACHE_MAXSIZE': os.environ.get('PG_CCACHE_MAXSIZE', '20G'),
+        'CCACHE_BASEDIR': get_pg_src(pg_venv),
+        'CCACHE_NOHASHDIR': 'true',
+        'CCACHE_STATSLOG': get_ccache_stats_log(pg_venv),
+    }
+
+
+def get_ccache_stats_log(pg_venv):
+    '''
+    Compute the path of the log where ccache records the result of every
+    compilation of a pg_venv
+    '''
+    return os.path.join(get_pg_venv_dir(pg_venv), 'ccache_stats.log')
+
+
+def get_conf_profile_settings(profile, cpus, memory, pg_version=None):
+    '''
+    Compute the settings of a configuration profile, for a machine with cpus
+    cores and memory bytes of RAM, as a dict mapping the settings to their
+    values:
+    - dev: small shared_buffers, durable
+    - benchmark-durable: sized for the machine, following the usual tuning
+      advice (25% of RAM for shared_buffers, large WAL, parallel workers for
+      all cores)
+    - benchmark-unsafe: benchmark-durable without fsync, synchronous commits,
+      full page writes and WAL archiving, data is lost on crash
+    - low-memory: as small as possible, to run many servers at the same time
+
+    The settings pg_version doesn't support are left out.
+    '''
+    mb = 1024 * 1024
+
+    def size(value, lower=0, upper=float('inf')):
+        # round to the MB, to keep the configuration readable
+        return '{}MB'.format(int(max(lower, min(value, upper)) // mb))
+
+    if profile == 'low-memory':
+        settings = {
+            'shared_buffers': '32MB',
+            'max_connections': '20',
+            'work_mem': '1MB',
+            'maintenance_work_mem': '16MB',
+            'max_wal_size': '256MB',
+            'min_wal_size': '64MB',
+            'max_worker_processes': str(min(cpus, 4)),
+            'max_parallel_workers': str(min(cpus, 2)),
+            'max_parallel_workers_per_gather': '0',
+            'max_parallel_maintenance_workers': '0',
+        }
+    elif profile == 'dev':
+        settings = {
+            'shared_buffers': size(memory / 16, 128 * mb, 1024 * mb),
+            'work_mem': '16MB',
+            'maintenance_work_mem': size(memory / 32, 64 * mb, 512 * mb),
+            'max_wal_size': '1024MB',
+            'min_wal_size': '80MB',
+            'max_worker_processes': str(max(8, cpus)),
+            'max_parallel_workers': str(cpus),
+            'max_parallel_workers_per_gather': str(min(2, cpus)),
+            'max_parallel_maintenance_workers': str(min(2, cpus)),
+        }
+    elif profile in ['benchmark-durable', 'benchmark-unsafe']:
+        settings = {
+            'shared_buffers': size(memory / 4, 128 * mb),
+            'effective_cache_size': size(memory * 3 / 4, 128 * mb),
+            # each of the parallel workers of the sorts of all the
+            # connections can use work_mem
+            'work_mem': size(memory / 4 / (cpus * 4), 4 * mb, 1024 * mb),
+            'maintenance_work_mem': size(memory / 16, 64 * mb, 2048 * mb),
+            'max_wal_size': size(memory / 4, 1024 * mb, 64 * 1024 * mb),
+            'min_wal_size': size(memory / 16, 256 * mb, 16 * 1024 * mb),
+            'wal_buffers': '64MB',
+            'checkpoint_timeout': '15min',
+            'checkpoint_completion_target': '0.9',
+            'max_worker_processes': str(max(8, cpus)),
+            'max_parallel_workers': str(cpus),
+            'max_parallel_workers_per_gather': str(max(2, min(cpus // 2, 8))),
+            'max_parallel_maintenance_workers': str(max(2, min(cpus // 2, 8))),
+        }
+        if profile == 'benchmark-unsafe':
+            settings.update({
+                'fsync': 'off',
+                'synchronous_commit': 'off',
+                'full_page_writes': 'off',
+                'wal_level': 'minimal',
+                'max_wal_senders': '0',
+            })
+    else:
+        raise ValueError('unknown configuration profile: {}'.format(profile))
+
+    if pg_version is not None:
+        settings = {
+            name: value for name, value in settings.items()
+            if pg_version >= _CONF_SETTINGS_MIN_VERSION.get(name, ())
+        }
+
+    return settings
+
+
+def get_configure_cache_file(pg_venv, configure_options):
+    '''
+    Compute the path of the configure cache to use for a pg_venv
+
+    There is one cache per compiler (identified by its path and version),
+    configure options (without the prefix), environment variables that
+    configure takes into account, and major version of postgresql, so that
+    the cache is not used anymore when one of them changes.
+    '''
+    import hashlib
+
+    cc = get_cc().split()[-1]
+    cc_path = shutil.which(cc) or cc
+    try:
+        cc_version = subprocess.check_output([cc_path, '--version'], stderr=subprocess.DEVNULL).decode('utf-8')
+    except (OSError, subprocess.CalledProcessError):
+        cc_version = ''
+
+    # configure's precious variables
+    env = ['{}={}'.format(v, os.environ.get(v, '')) for v in ['CC', 'CFLAGS', 'CPPFLAGS', 'LDFLAGS', 'LIBS', 'PKG_CONFIG_PATH']]
+
+    key = '\n'.join([cc_path, cc_version, ' '.join(configure_options.split()), get_pg_src_version(pg_venv)] + env)
+    key_hash = hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+    return os.path.join(get_env_var('PG_VIRTUALENV_HOME'), '.configure_cache', '{}.cache'.format(key_hash))
+
+
+def get_daemon_dir():
+    '''
+    Return the directory of pg_venvd, holding its socket and the logs of its
+    jobs
+    '''
+    return os.path.join(get_env_var('PG_VIRTUALENV_HOME'), '.pg_venvd')
+
+
+def get_daemon_socket():
+    '''
+    Return the unix socket pg_venvd listens to
+    '''
+    return os.path.join(get_daemon_dir(), 'socket')
+
+
 def get_disk_usage(pg_venv):
     '''
-    Compute the disk space used by a pg_venv
+    Compute the disk space used by a pg_venv, in a human readable format
+
+    The size comes from the disk usage tracker (see get_disk_usage_breakdown),
+    it is prefixed with '>' if a part of the pg_venv could not be scanned
+    entirely.
+    '''
+    breakdown = get_disk_usage_breakdown(pg_venv)
+    total = sum(c['bytes'] for c in breakdown.values())
+    complete = all(c['complete'] for c in breakdown.values())
+
+    return ('' if complete else '>') + format_size(total)
+
+
+def get_disk_usage_breakdown(pg_venv, budget=None):
+    '''
+    Return the disk space used by each component of a pg_venv (see
+    get_disk_usage_components), as a dict mapping the components to dicts
+    with keys bytes, shared_bytes (used by files shared with other pg_venvs),
+    time (when the component was scanned) and complete
+
+    The sizes are recorded in the pg_venv's metadata by the actions that
+    change them. The components that were never scanned, or not for
+    PG_DISK_USAGE_TTL seconds (600 by default), are scanned again, for at
+    most budget seconds (PG_DISK_USAGE_SCAN_BUDGET, 1s by default), after
+    which the scan is left incomplete. The log is small but grows all the
+    time, so it is measured on each call, without being recorded: reading
+    the disk usage doesn't write the metadata unless a component is stale.
+    '''
+    if budget is None:
+        budget = float(os.environ.get('PG_DISK_USAGE_SCAN_BUDGET', 1))
+    ttl = float(os.environ.get('PG_DISK_USAGE_TTL', 600))
+
+    components = get_disk_usage_components(pg_venv)
+    breakdown = get_pg_metadata(pg_venv).get('disk_usage', {})
+    stale_components = [
+        c for c in components
+        if c != 'log' and (c not in breakdown or time.time() - breakdown[c]['time'] > ttl)
+    ]
+    if stale_components:
+        breakdown = update_disk_usage(pg_venv, stale_components, budget)
+
+    return dict(breakdown, log=scan_component_disk_usage(components['log']))
+
+
+def get_disk_usage_components(pg_venv):
+    '''
+    Return the components of a pg_venv for the disk usage tracker, as a dict
+    mapping their name to their paths
+
+    src and build share the source dir: build is made of the files ignored by
+    git, src of the other ones.
+    '''
+    pg_venv_dir = get_pg_venv_dir(pg_venv)
+
+    return {
+        'src': [get_pg_src(pg_venv)],
+        'build': [get_pg_src(pg_venv)],
+        'install': [os.path.join(pg_venv_dir, d) for d in _INSTALL_DIRS],
+        'data': [get_pg_data(pg_venv)],
+        'log': [get_pg_log(pg_venv), os.path.join(pg_venv_dir, 'logs')],
+        'snapshots': [get_snapshots_dir(pg_venv)],
+    }
+
+
+def get_host_info():
+    '''
+    Return what describes the machine a benchmark runs on, as a dict
+    '''
+    import socket
+
+    return {
+        'hostname': socket.gethostname(),
+        'kernel': '{} {}'.format(os.uname().sysname, os.uname().release),
+        'cpus': os.cpu_count(),
+        'memory': get_total_memory(),
+    }
+
+
+def get_index_file():
+    '''
+    Return the file indexing the pg_venvs (see read_index)
+    '''
+    return os.path.join(get_env_var('PG_VIRTUALENV_HOME'), '.index')
+
+
+def get_initdb_template_dir(pg_venv):
+    '''
+    Compute the directory of the initdb template to use for a pg_venv
+
+    The pg_venvs can share a template if initdb produces the same cluster for
+    them: same major version, catalog version, configure options and initdb
+    options (PG_INITDB_OPTIONS). The files initdb reads from the share
+    directory (catalog data, sql scripts, configuration samples) are hashed
+    too, since patches often change the catalog without changing the
+    catalog version.
+    '''
+    import hashlib
+
+    metadata = get_pg_metadata(pg_venv)
+    catversion = '0'
+    catversion_file = os.path.join(get_pg_venv_dir(pg_venv), 'include', 'server', 'catalog', 'catversion.h')
+    with contextlib.suppress(FileNotFoundError), open(catversion_file) as f:
+        match = re.search(r'#define\s+CATALOG_VERSION_NO\s+(\d+)', f.read())
+        if match is not None:
+            catversion = match.group(1)
+
+    key = hashlib.sha256()
+    key.update(get_pg_version(pg_venv).encode('utf-8'))
+    key.update(metadata.get('configure_options', '').encode('utf-8'))
+    key.update(os.environ.get('PG_INITDB_OPTIONS', '').encode('utf-8'))
+    # depending on the prefix, the share directory is share or share/postgresql
+    pg_config = os.path.join(get_pg_bin(pg_venv), 'pg_config')
+    share_dir = subprocess.check_output([pg_config, '--sharedir']).strip().decode('utf-8')
+    for entry in sorted(os.scandir(share_dir), key=lambda e: e.name):
+        if entry.is_file():
+            key.update(entry.name.encode('utf-8'))
+            key.update(hash_file(entry.path).encode('utf-8'))
+
+    major_version = '.'.join(map(str, get_pg_major_version(pg_venv)))
+
+    return os.path.join(
+        get_initdb_templates_dir(),
+        '{}-{}-{}'.format(major_version, catversion, key.hexdigest()[:12]),
+    )
+
+
+def get_initdb_templates_dir():
+    '''
+    Return the directory containing the initdb templates of all the pg_venvs
+    '''
+    return os.path.join(get_env_var('PG_VIRTUALENV_HOME'), '.initdb_templates')
+
+
+def get_install_manifest_file(pg_venv):
+    '''
+    Compute the path of the file listing the files installed in a pg_venv from
+    the install store
+    '''
+    return os.path.join(get_pg_venv_dir(pg_venv), 'install_manifest.json')
+
+
+def get_install_store_dir():
+    '''
+    Return the directory of the content-addressed store, that holds the files
+    installed in all the pg_venvs
+    '''
+    return os.path.join(get_env_var('PG_VIRTUALENV_HOME'), '.install_store')
+
+
+def get_jobserver_dir():
+    '''
+    Return the directory of the build scheduler shared by all the pg_venvs
+    '''
+    return os.path.join(get_env_var('PG_VIRTUALENV_HOME'), '.jobserver')
+
+
+def get_lost_tmpfs_components(pg_venv, components=None):
+    '''
+    Return the directories of a pg_venv (among components if it is set) that
+    were on tmpfs and have been lost, e.g. after a reboot
+    '''
+    tmpfs_components = get_tmpfs_components(pg_venv)
+    lost_components = []
+    for component in get_pg_metadata(pg_venv).get('tmpfs', []):
+        if components is not None and component not in components:
+            continue
+
+        path = tmpfs_components[component]
+        if os.path.islink(path) and not os.path.isdir(path):
+            lost_components.append(component)
+
+    return lost_components
+
+
+def get_make_version():
     '''
-    cmd = 'du -hd 0 {} | cut -f 1'.format(get_pg_venv_dir(pg_venv))
-    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, _ = process.communicate()
-    out = out.decode('utf-8').strip()
+    Return the version of GNU make, as a tuple of ints
+    '''
+    output = subprocess.check_output(['make', '--version']).decode('utf-8')
 
-    return out
+    return parse_pg_version(output.split('\n')[0].split()[-1])
 
 
 def get_pg_bin(pg_venv):
@@ -122,6 +876,42 @@ def get_pg_bin(pg_venv):
     return os.path.join(get_pg_venv_dir(pg_venv), 'bin')
 
 
+def get_pg_build_dir(pg_venv):
+    '''
+    Compute the build directory of a pg_venv using meson (autoconf builds in
+    the source directory)
+    '''
+    return os.path.join(get_pg_src(pg_venv), 'build')
+
+
+def get_pg_ctl_start_cmd(pg_venv, wait=True, timeout=None):
+    '''
+    Return the arguments of the pg_ctl command starting the server of a
+    pg_venv, and whether pg_ctl waits for the server to accept connections
+
+    pg_ctl waits, for at most timeout seconds (PG_READY_TIMEOUT by default),
+    if wait is True and it can do it reliably (pg10 and later). Otherwise
+    the caller has to poll the server itself (see wait_for_pg_ready).
+    '''
+    if timeout is None:
+        timeout = float(os.environ.get('PG_READY_TIMEOUT', 60))
+
+    pg_ctl_waits = wait and get_pg_major_version(pg_venv) >= (10,)
+    wait_options = ['-w', '-t', str(max(1, int(timeout)))] if pg_ctl_waits else ['-W']
+
+    cmd = [
+        os.path.join(get_pg_bin(pg_venv), 'pg_ctl'),
+        'start',
+        *wait_options,
+        '-D', get_pg_data(pg_venv),
+        '-l', get_pg_log(pg_venv),
+        '--core-files',
+        '-o', '-p {}'.format(get_pg_port(pg_venv)),
+    ]
+
+    return cmd, pg_ctl_waits
+
+
 def get_pg_data(pg_venv):
     '''
     Compute PGDATA for a pg_venv
@@ -143,6 +933,36 @@ def get_pg_log(pg_venv):
     return os.path.join(get_pg_venv_dir(pg_venv), '{}.log'.format(pg_venv))
 
 
+def get_pg_major_version(pg_venv):
+    '''
+    Return the major version of postgresql in a pg_venv, as a tuple that can
+    be compared with e.g. (10,) or (9, 6)
+    '''
+    version = parse_pg_version(get_pg_version(pg_venv))
+
+    # before pg10, the major version is made of the first two numbers
+    return version[:1] if version >= (10,) else version[:2]
+
+
+def get_pg_metadata(pg_venv):
+    '''
+    Return the metadata of a pg_venv, as a dict
+    '''
+    try:
+        with open(get_pg_metadata_file(pg_venv)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def get_pg_metadata_file(pg_venv):
+    '''
+    Compute the path of the file where pg_venv stores information about a
+    pg_venv (e.g. how it has been built)
+    '''
+    return os.path.join(get_pg_venv_dir(pg_venv), 'pg_venv.json')
+
+
 def get_pg_port(pg_venv):
     '''
     Compute the port postgres will listen to, depending on its virtualenv name
@@ -163,6 +983,23 @@ def get_pg_src(pg_venv):
     return os.path.join(get_pg_venv_dir(pg_venv), 'src')
 
 
+def get_pg_src_version(pg_venv):
+    '''
+    Return the major version of the source code of a pg_venv, as written in
+    its configure script (which works before postgresql is built)
+    '''
+    try:
+        with open(os.path.join(get_pg_src(pg_venv), 'configure')) as f:
+            for line in f:
+                if line.startswith('PACKAGE_VERSION='):
+                    version = parse_pg_version(line.split('=', 1)[1].strip().strip("'"))
+                    return '.'.join(map(str, version[:1] if version >= (10,) else version[:2]))
+    except FileNotFoundError:
+        pass
+
+    return ''
+
+
 def get_pg_venv_dir(pg_venv):
     '''
     Return the directory containing a pg_venv
@@ -171,9 +1008,54 @@ def get_pg_venv_dir(pg_venv):
     return os.path.join(pg_venv_home, pg_venv)
 
 
-def get_pg_version(pg_venv):
+def get_pg_venv_info(pg_venv, index_entry):
     '''
-    Return the version of postgresql in a pg_venv
+    Return the information about a pg_venv displayed by action list, as a
+    dict with keys pg_venv, port, version, running and disk_usage
+
+    index_entry is the entry of the pg_venv in the index (see
+    refresh_index_entry), it is updated. The disk usage comes from the disk
+    usage tracker.
+    '''
+    refresh_index_entry(pg_venv, index_entry)
+
+    return {
+        'pg_venv': pg_venv,
+        'port': index_entry['port'],
+        'version': index_entry['version'],
+        'running': index_entry['running'],
+        'disk_usage': get_disk_usage(pg_venv),
+    }
+
+
+def get_pg_venvs_info(pg_venvs):
+    '''
+    Return the information about several pg_venvs displayed by action list
+    (see get_pg_venv_info)
+
+    The pg_venvs are probed concurrently, and the index is updated with the
+    result.
+    '''
+    import concurrent.futures
+
+    with lock_index():
+        existing_pg_venvs = available_pg_venvs()
+        index = {pg_venv: info for pg_venv, info in read_index().items() if pg_venv in existing_pg_venvs}
+        for pg_venv in pg_venvs:
+            index.setdefault(pg_venv, {})
+
+        # the probes mostly wait for subprocesses and I/O, so threads are enough
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, len(pg_venvs) or 1)) as executor:
+            pg_venvs_info = list(executor.map(lambda p: get_pg_venv_info(p, index[p]), pg_venvs))
+
+        write_index(index)
+
+    return pg_venvs_info
+
+
+def get_pg_version(pg_venv):
+    '''
+    Return the version of postgresql in a pg_venv
     '''
     pg_config = os.path.join(get_pg_bin(pg_venv), 'pg_config')
     cmd = '{} --version'.format(pg_config)
@@ -182,43 +1064,1840 @@ def get_pg_version(pg_venv):
     return version
 
 
+def get_phase_log_file(pg_venv, phase):
+    '''
+    Compute the path of the file where the output of a phase of a pg_venv's
+    actions is written (e.g. logs/compiling-postgresql.log), None if there is
+    no pg_venv
+    '''
+    if not pg_venv or not os.path.isdir(get_pg_venv_dir(pg_venv)):
+        return None
+
+    name = re.sub(r'[^a-z0-9]+', '-', phase.lower()).strip('-')[:64] or 'command'
+
+    return os.path.join(get_pg_venv_dir(pg_venv), 'logs', '{}.log'.format(name))
+
+
+def get_snapshot_compressor():
+    '''
+    Return the command used to compress tarball snapshots, and the extension
+    of the tarballs: zstd if available, otherwise pigz or gzip
+    '''
+    if shutil.which('zstd'):
+        return 'zstd -T0', 'tar.zst'
+    if shutil.which('pigz'):
+        return 'pigz', 'tar.gz'
+    return 'gzip', 'tar.gz'
+
+
+def get_snapshot_dir(pg_venv, snapshot_name):
+    '''
+    Compute the directory where a snapshot of a pg_venv's data is stored
+    '''
+    return os.path.join(get_snapshots_dir(pg_venv), snapshot_name)
+
+
+def get_snapshot_method(pg_venv):
+    '''
+    Choose how to snapshot the data directory of a pg_venv: PG_SNAPSHOT_METHOD
+    if it is set, otherwise the fastest method the filesystem supports:
+    - btrfs: the data directory is a btrfs subvolume, snapshots are subvolume
+      snapshots
+    - reflink: snapshots are copies sharing their blocks with the data
+      directory (btrfs, xfs...)
+    - tar: snapshots are compressed tarballs, restoring them takes about as
+      long as writing the data again
+    '''
+    method = os.environ.get('PG_SNAPSHOT_METHOD')
+    if method:
+        return method
+
+    pg_data = get_pg_data(pg_venv)
+    snapshots_dir = get_snapshots_dir(pg_venv)
+    os.makedirs(snapshots_dir, exist_ok=True)
+
+    if is_btrfs_subvolume(pg_data) and shutil.which('btrfs'):
+        return 'btrfs'
+
+    if os.stat(pg_data).st_dev == os.stat(snapshots_dir).st_dev and reflink_supported(snapshots_dir):
+        return 'reflink'
+
+    return 'tar'
+
+
+def get_snapshots(pg_venv):
+    '''
+    Return the snapshots of a pg_venv's data, oldest first, as dicts with keys
+    name, time, method, file (what is restored, relative to the snapshot's
+    directory), pg_version and bytes
+    '''
+    snapshots_dir = get_snapshots_dir(pg_venv)
+    if not os.path.isdir(snapshots_dir):
+        return []
+
+    snapshots = []
+    for snapshot_name in os.listdir(snapshots_dir):
+        # snapshots being taken are hidden
+        if snapshot_name.startswith('.'):
+            continue
+        try:
+            with open(os.path.join(snapshots_dir, snapshot_name, 'snapshot.json')) as f:
+                snapshots.append(json.load(f))
+        except (FileNotFoundError, NotADirectoryError, ValueError):
+            continue
+
+    return sorted(snapshots, key=lambda s: s['time'])
+
+
+def get_snapshots_dir(pg_venv):
+    '''
+    Compute the directory where the snapshots of a pg_venv's data are stored
+    '''
+    return os.path.join(get_pg_venv_dir(pg_venv), 'snapshots')
+
+
+def get_supported_build_systems(pg_venv):
+    '''
+    Return the build systems the source of a pg_venv can be built with
+    (meson is supported starting with pg16)
+    '''
+    pg_src = get_pg_src(pg_venv)
+    build_systems = []
+    if os.path.isfile(os.path.join(pg_src, 'configure')):
+        build_systems.append('autoconf')
+    if os.path.isfile(os.path.join(pg_src, 'meson.build')):
+        build_systems.append('meson')
+
+    return build_systems
+
+
+def get_timings_file(pg_venv):
+    '''
+    Compute the path of the file where the timings of a pg_venv's actions
+    are recorded, see timed
+    '''
+    return os.path.join(get_pg_venv_dir(pg_venv), 'timings.jsonl')
+
+
+def get_tmpfs_components(pg_venv):
+    '''
+    Return the directories of a pg_venv that can be moved to tmpfs, as a dict
+    mapping their name to their path
+
+    With autoconf, postgresql is built in the source directory, so only the
+    build directory of meson can be moved.
+    '''
+    return {
+        'data': get_pg_data(pg_venv),
+        'build': get_pg_build_dir(pg_venv),
+    }
+
+
+def get_tmpfs_dir(pg_venv):
+    '''
+    Compute the directory where the directories of a pg_venv that are on
+    tmpfs are stored: a subdirectory of PG_TMPFS_DIR
+    (/dev/shm/pg_venv-<uid> by default)
+    '''
+    tmpfs_dir = os.environ.get('PG_TMPFS_DIR', '/dev/shm/pg_venv-{}'.format(os.getuid()))
+
+    return os.path.join(tmpfs_dir, pg_venv)
+
+
+def get_total_memory():
+    '''
+    Return the amount of RAM of the machine, in bytes
+    '''
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def apply_conf_profile(pg_venv, profile):
+    '''
+    Write the settings of a configuration profile (see
+    get_conf_profile_settings) in the data directory of a pg_venv, and
+    include them in its postgresql.conf
+
+    The profile is recorded in the pg_venv's metadata, so that it is applied
+    again by initdb. Returns the names of the settings that changed.
+    '''
+    pg_data = get_pg_data(pg_venv)
+    with open(os.path.join(pg_data, 'PG_VERSION')) as f:
+        pg_version = parse_pg_version(f.read().strip())
+
+    settings = get_conf_profile_settings(profile, os.cpu_count(), get_total_memory(), pg_version)
+    previous_settings = read_conf_profile(pg_venv)
+
+    conf_profile_file = os.path.join(pg_data, _CONF_PROFILE_FILE)
+    with open(conf_profile_file + '.tmp', 'w') as f:
+        f.write('# profile {}, written by pg_venv, see `pg profile`\n'.format(profile))
+        for name, value in settings.items():
+            f.write("{} = '{}'\n".format(name, value))
+    os.replace(conf_profile_file + '.tmp', conf_profile_file)
+
+    # the include comes last, so that the profile overrides postgresql.conf
+    include = "include_if_exists = '{}'".format(_CONF_PROFILE_FILE)
+    with open(os.path.join(pg_data, 'postgresql.conf'), 'r+') as f:
+        if include not in f.read():
+            f.write('\n{}\n'.format(include))
+
+    update_pg_metadata(pg_venv, conf_profile=profile)
+
+    return [
+        name for name in sorted(set(settings) | set(previous_settings))
+        if settings.get(name) != previous_settings.get(name)
+    ]
+
+
 def available_pg_venvs():
-    return os.listdir(get_env_var('PG_VIRTUALENV_HOME'))
+    # hidden entries hold data shared by all pg_venvs (e.g. the compiler cache)
+    return [d for d in os.listdir(get_env_var('PG_VIRTUALENV_HOME')) if not d.startswith('.')]
+
+
+def bootstrap_ci(values, confidence=0.95, iterations=10000):
+    '''
+    Compute a confidence interval of the mean of values, by bootstrap:
+    values are resampled with replacement, and the interval is made of the
+    percentiles of the means of the samples
+
+    The resampling is seeded, so that the same values always give the same
+    interval.
+    '''
+    import random
+
+    rng = random.Random(0)
+    means = sorted(
+        sum(rng.choice(values) for _ in values) / len(values)
+        for _ in range(iterations)
+    )
+    alpha = (1 - confidence) / 2 * 100
+
+    return percentile(means, alpha), percentile(means, 100 - alpha)
+
+
+def build_scheduler_enabled():
+    '''
+    Check if builds should go through the build scheduler shared by the
+    pg_venvs, which is the case unless PG_BUILD_SCHEDULER=0
+    '''
+    return get_bool_env_var('PG_BUILD_SCHEDULER')
+
+
+@contextlib.asynccontextmanager
+async def build_slot_async(pg_venv, verbose=False):
+    '''
+    Wait until the build scheduler shared by all the pg_venvs admits a build
+    of pg_venv, then yield the environment variables and the file descriptors
+    to give to the build so that make draws its jobs from the shared job pool
+
+    Builds are admitted in order of arrival, at most
+    PG_MAX_CONCURRENT_BUILDS at a time. The job pool is a GNU make jobserver
+    (a named pipe holding one token per job), so the builds of all the
+    pg_venvs never run more than PG_BUILD_JOBS jobs together, plus one per
+    admitted build.
+    Nothing is waited for if PG_BUILD_SCHEDULER=0. The wait is only displayed
+    if verbose is True.
+    '''
+    import asyncio
+
+    if not build_scheduler_enabled():
+        yield {}, ()
+        return
+
+    ticket, ticket_fd = enter_build_queue(pg_venv)
+    try:
+        interval = 0.1
+        waiting_logged = not verbose
+        while get_builds_ahead(ticket):
+            if not waiting_logged:
+                log('Waiting for {} other build(s) to be done'.format(get_builds_ahead(ticket)))
+                waiting_logged = True
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, 2)
+
+        with open_jobserver(ticket) as jobserver:
+            yield jobserver
+    finally:
+        leave_build_queue(ticket, ticket_fd)
+
+
+def ccache_enabled():
+    '''
+    Check if compilations should go through ccache: it must be installed, and
+    not disabled with PG_CCACHE=0
+    '''
+    if not get_bool_env_var('PG_CCACHE'):
+        return False
+
+    return shutil.which('ccache') is not None
+
+
+def check_pg_ready(pg_venv):
+    '''
+    Check once if postgres accepts connections: return True if it does, False
+    if it never will (it is stopping), None if it may later
+
+    pg10 and later write their status in postmaster.pid, older versions are
+    polled through their socket or port.
+    '''
+    postmaster_pid = read_postmaster_pid(pg_venv)
+    if postmaster_pid is None or not pid_is_alive(postmaster_pid['pid']):
+        return None
+
+    status = postmaster_pid['status']
+    if status in ['ready', 'standby']:
+        return True
+    elif status == 'stopping':
+        return False
+    elif status is None and pg_accepts_connections(
+        postmaster_pid['socket_dir'],
+        postmaster_pid['port'],
+        postmaster_pid['listen_addr'],
+    ):
+        return True
+
+    return None
+
+
+def configure_cache_enabled():
+    '''
+    Check if configure should use the cache shared by the pg_venvs, which is
+    the case unless PG_CONFIGURE_CACHE=0
+    '''
+    return get_bool_env_var('PG_CONFIGURE_CACHE')
+
+
+def configure_cache_is_valid(cache_file):
+    '''
+    Check that a cache file written by configure contains test results
+    '''
+    try:
+        with open(cache_file) as f:
+            return any(line.startswith('ac_cv_') for line in f)
+    except FileNotFoundError:
+        return False
+
+
+def daemon_request(command, **arguments):
+    '''
+    Send a command to pg_venvd (see pg_venvd.py) and return its answer, as a
+    dict, or None if pg_venvd is not running
+
+    The request and the answer are JSON objects on a line each, the answer
+    has a key error if the command failed.
+    '''
+    import socket
+
+    if not os.path.exists(get_daemon_socket()):
+        return None
+
+    request = dict(arguments, command=command)
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(float(os.environ.get('PG_VENVD_TIMEOUT', 10)))
+            sock.connect(get_daemon_socket())
+            sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            with sock.makefile('rb') as f:
+                return json.loads(f.readline())
+    except (ConnectionRefusedError, FileNotFoundError):
+        # the socket of a pg_venvd that didn't exit cleanly
+        return None
+
+
+def enter_build_queue(pg_venv):
+    '''
+    Put a ticket for a build of pg_venv in the queue of the build scheduler
+    (see build_slot_async), and return its path and its file descriptor, which
+    must be given to leave_build_queue
+    '''
+    jobserver_dir = get_jobserver_dir()
+    queue_dir = os.path.join(jobserver_dir, 'queue')
+    os.makedirs(queue_dir, exist_ok=True)
+
+    # the ticket's name orders the queue. The ticket is locked as long as the
+    # build runs, the lock is released by the kernel if the process dies. It
+    # is locked before entering the queue, so that it isn't taken for the
+    # ticket of a dead process.
+    ticket_name = '{:020d}-{}-{}'.format(time.time_ns(), os.getpid(), pg_venv)
+    ticket = os.path.join(queue_dir, ticket_name)
+    ticket_fd = os.open(os.path.join(jobserver_dir, ticket_name), os.O_WRONLY | os.O_CREAT, 0o600)
+    fcntl.flock(ticket_fd, fcntl.LOCK_EX)
+    os.rename(os.path.join(jobserver_dir, ticket_name), ticket)
+
+    return ticket, ticket_fd
+
+
+def estimate_compilation_duration(builds):
+    '''
+    Estimate how long (in seconds) the compilation of a file takes, from
+    ccache statistics of builds that actually compiled files
+
+    This is used to tell how much time cache hits saved. It includes
+    everything else the builds did (e.g. linking), so it's an upper bound.
+    '''
+    compile_duration = sum(b['duration'] for b in builds if b['misses'] > 0)
+    compilations = sum(b['misses'] for b in builds)
+
+    if compilations == 0:
+        return None
+
+    return compile_duration / compilations
+
+
+def find_closest_pg_venv(pg_venv, configure_options):
+    '''
+    Return the built pg_venv whose last build is the closest to the HEAD of
+    pg_venv in git history, among the ones configured with autoconf and
+    configure_options, or None if there is none
+    '''
+    pg_dir = get_env_var('PG_DIR')
+    cmd = 'cd {} && git rev-parse HEAD'.format(get_pg_src(pg_venv))
+    head = subprocess.check_output(cmd, shell=True).strip().decode('utf-8')
+
+    closest_pg_venv = None
+    closest_distance = None
+    for candidate in available_pg_venvs():
+        metadata = get_pg_metadata(candidate)
+        if candidate == pg_venv \
+                or 'build_commit' not in metadata \
+                or metadata.get('build_system', 'autoconf') != 'autoconf' \
+                or metadata.get('configure_options', '').strip() != configure_options.strip() \
+                or not os.path.isdir(get_pg_src(candidate)):
+            continue
+
+        # number of commits that are in only one of both histories
+        cmd = 'cd {} && git rev-list --count {}...{}'.format(pg_dir, head, metadata['build_commit'])
+        try:
+            distance = int(subprocess.check_output(cmd, shell=True, stderr=subprocess.DEVNULL))
+        except subprocess.CalledProcessError:
+            # e.g. the commit doesn't exist anymore
+            continue
+
+        if closest_distance is None or distance < closest_distance:
+            closest_pg_venv = candidate
+            closest_distance = distance
+
+    return closest_pg_venv
+
+
+def format_duration(duration):
+    '''
+    Format a duration in seconds in a human readable format, e.g. 3m12s
+    '''
+    if duration < 10:
+        return '{:.1f}s'.format(duration)
+    duration = round(duration)
+    if duration < 60:
+        return '{}s'.format(duration)
+    if duration < 3600:
+        return '{}m{:02d}s'.format(duration // 60, duration % 60)
+    return '{}h{:02d}m'.format(duration // 3600, duration % 3600 // 60)
+
+
+def format_size(size):
+    '''
+    Format a number of bytes the way `du -h` does
+    '''
+    for unit in ['', 'K', 'M', 'G', 'T']:
+        if size < 1024 or unit == 'T':
+            break
+        size /= 1024
+
+    if unit == '':
+        return '{}'.format(int(size))
+
+    return '{:.1f}{}'.format(size, unit) if size < 10 else '{:.0f}{}'.format(size, unit)
+
+
+def gc_initdb_templates():
+    '''
+    Remove the initdb templates that no pg_venv would use anymore (e.g. the
+    ones of older builds)
+
+    Returns the number of bytes freed.
+    '''
+    templates_dir = get_initdb_templates_dir()
+    if not os.path.isdir(templates_dir):
+        return 0
+
+    used_templates = set()
+    for pg_venv in available_pg_venvs():
+        with contextlib.suppress(OSError, subprocess.CalledProcessError):
+            used_templates.add(os.path.basename(get_initdb_template_dir(pg_venv)))
+
+    freed = 0
+    for template in os.listdir(templates_dir):
+        if template not in used_templates:
+            freed += scan_disk_usage(os.path.join(templates_dir, template))[0]
+            shutil.rmtree(os.path.join(templates_dir, template), ignore_errors=True)
+
+    return freed
+
+
+def gc_install_store():
+    '''
+    Remove the files of the install store that aren't used by any pg_venv
+    anymore, i.e. that have no other hardlink than the one in the store, and
+    that aren't listed in the install manifest of a pg_venv or of its build
+    cache (files that couldn't be hardlinked were copied, see
+    install_from_staging_dir)
+
+    Returns the number of bytes freed.
+    '''
+    freed = 0
+    store_dir = get_install_store_dir()
+    if not os.path.isdir(store_dir):
+        return freed
+
+    with lock_install_store():
+        used_hashes = set()
+        for pg_venv in available_pg_venvs():
+            manifest_files = [get_install_manifest_file(pg_venv)]
+            with contextlib.suppress(FileNotFoundError):
+                for entry in os.scandir(os.path.join(get_pg_venv_dir(pg_venv), 'build_cache')):
+                    manifest_files.append(os.path.join(entry.path, 'install_manifest.json'))
+            for manifest_file in manifest_files:
+                with contextlib.suppress(FileNotFoundError), open(manifest_file) as f:
+                    used_hashes.update(json.load(f)['files'].values())
+
+        for store_subdir in os.scandir(store_dir):
+            for entry in os.scandir(store_subdir.path):
+                stat = entry.stat(follow_symlinks=False)
+                if stat.st_nlink == 1 and entry.name not in used_hashes:
+                    os.unlink(entry.path)
+                    freed += stat.st_size
+
+    return freed
+
+
+def hash_file(path):
+    '''
+    Compute the key of a file in the install store: the sha256 of its content,
+    with a suffix for executable files
+    '''
+    import hashlib
+
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(block)
+
+    executable = os.stat(path).st_mode & 0o111
+
+    return sha256.hexdigest() + ('x' if executable else '')
+
+
+def histogram_percentile(histogram, p):
+    '''
+    Compute the p-th percentile of values counted in a histogram (a dict
+    mapping each value to its number of occurrences), like percentile
+    '''
+    total = sum(histogram.values())
+    if total == 0:
+        return None
+
+    rank = (total - 1) * p / 100
+    lower = int(rank)
+    upper = min(lower + 1, total - 1)
+
+    seen = 0
+    lower_value = None
+    for value in sorted(histogram):
+        seen += histogram[value]
+        if lower_value is None and seen > lower:
+            lower_value = value
+        if seen > upper:
+            return lower_value + (value - lower_value) * (rank - lower)
+
+
+def indexed_pg_venvs():
+    '''
+    Return the names of the pg_venvs from the index (see read_index), which
+    is rebuilt if it is empty or corrupted while there are pg_venvs
+    '''
+    index = read_index()
+    if not index and available_pg_venvs():
+        index = update_index()
+
+    return sorted(index)
 
 
 def initdb(pg_venv=None, exit_on_fail=False):
     '''
     Run initdb
+
+    Unless PG_INITDB_TEMPLATE=0, initdb is only run once for each template
+    (see get_initdb_template_dir), and the data directory is a copy of the
+    template. Copies use reflinks if the filesystem supports them, and are
+    never hardlinks since postgres modifies its files in place.
+    PG_INITDB_OPTIONS is passed to initdb.
     '''
     if not pg_venv:
         pg_venv = get_env_var('PG_VENV')
 
     pg_bin = get_pg_bin(pg_venv)
+    pg_data = os.path.realpath(get_pg_data(pg_venv))
+    initdb_options = os.environ.get('PG_INITDB_OPTIONS', '')
+
+    if not initdb_template_enabled():
+        cmd = os.path.join(pg_bin, 'initdb {} -D {}'.format(initdb_options, pg_data))
+        initdb_return_code = execute_cmd(cmd, 'Initializing database', process_output=False, exit_on_fail=exit_on_fail)
+        if initdb_return_code == 0:
+            initdb_conf_profile(pg_venv)
+        update_disk_usage(pg_venv, ['data'])
+
+        return initdb_return_code
+
+    if os.path.isdir(pg_data) and os.listdir(pg_data):
+        log('Data directory {} is not empty, not initializing it'.format(pg_data), 'error')
+        if exit_on_fail:
+            raise PgVenvError('data directory {} is not empty'.format(pg_data))
+        return 1
 
-    cmd = os.path.join(pg_bin, 'initdb -D {}'.format(get_pg_data(pg_venv)))
-    initdb_return_code = execute_cmd(cmd, 'Initializing database', process_output=False, exit_on_fail=exit_on_fail)
+    template_dir = get_initdb_template_dir(pg_venv)
+    if not os.path.isdir(template_dir):
+        # initialize the template aside, so that it only becomes visible once
+        # it's complete
+        tmp_template_dir = '{}.{}.tmp'.format(template_dir, os.getpid())
+        cmd = os.path.join(pg_bin, 'initdb {} -D {}'.format(initdb_options, tmp_template_dir))
+        # the half-initialized template is removed before failing
+        initdb_return_code = execute_cmd(cmd, 'Initializing database template', process_output=False)
+        if initdb_return_code != 0:
+            shutil.rmtree(tmp_template_dir, ignore_errors=True)
+            if exit_on_fail:
+                raise CommandError(cmd, initdb_return_code)
+            return initdb_return_code
+
+        try:
+            os.rename(tmp_template_dir, template_dir)
+        except OSError:
+            # another pg_venv created the same template in the meantime
+            shutil.rmtree(tmp_template_dir, ignore_errors=True)
+
+    cmd = 'mkdir -p {} && cp -a --reflink=auto {}/. {} && chmod 700 {}'.format(pg_data, template_dir, pg_data, pg_data)
+    initdb_return_code = execute_cmd(cmd, 'Initializing database from template', process_output=False, exit_on_fail=exit_on_fail)
+    if initdb_return_code == 0:
+        initdb_conf_profile(pg_venv)
+    update_disk_usage(pg_venv, ['data'])
 
     return initdb_return_code
 
 
-def pg_is_running(pg_venv=None):
+def initdb_conf_profile(pg_venv):
     '''
-    Check if postgres is running
+    Apply its configuration profile to a new data directory: the one
+    recorded in the pg_venv's metadata, or PG_CONF_PROFILE for a new pg_venv
     '''
-    if not pg_venv:
-        pg_venv = get_env_var('PG_VENV')
+    profile = get_pg_metadata(pg_venv).get('conf_profile') or os.environ.get('PG_CONF_PROFILE')
+    if profile and profile not in CONF_PROFILES:
+        log('Unknown configuration profile {}, keeping the default configuration'.format(profile), 'warning')
+    elif profile:
+        log('Applying configuration profile {}'.format(profile))
+        apply_conf_profile(pg_venv, profile)
 
-    pg_ctl = os.path.join(get_pg_bin(pg_venv), 'pg_ctl')
 
-    if os.path.isfile(pg_ctl):
-        cmd = '{} status -D {}'.format(pg_ctl, get_pg_data(pg_venv))
-        return_code = execute_cmd(cmd, verbose=False, process_output=False, error_output=False)
+def initdb_template_enabled():
+    '''
+    Check if data directories should be copied from initdb templates, which
+    is the case unless PG_INITDB_TEMPLATE=0
+    '''
+    return get_bool_env_var('PG_INITDB_TEMPLATE')
+
 
-        return return_code == 0
-    else:
-        # binary does not exist so postgres likely isn't running
+def install_from_build_cache(pg_venv, commit):
+    '''
+    Install the files of a pg_venv built from a commit, saved by
+    save_build_to_cache, instead of building it again
+    '''
+    pg_venv_dir = get_pg_venv_dir(pg_venv)
+    build_cache_dir = get_build_cache_dir(pg_venv, commit)
+
+    for install_dir in _INSTALL_DIRS:
+        shutil.rmtree(os.path.join(pg_venv_dir, install_dir), ignore_errors=True)
+        if os.path.isdir(os.path.join(build_cache_dir, install_dir)):
+            cmd = ['cp', '-al', os.path.join(build_cache_dir, install_dir), os.path.join(pg_venv_dir, install_dir)]
+            subprocess.check_call(cmd)
+    shutil.copyfile(os.path.join(build_cache_dir, 'install_manifest.json'), get_install_manifest_file(pg_venv))
+
+    update_pg_metadata(pg_venv, build_commit=commit)
+
+
+def install_from_staging_dir(pg_venv, staging_dir):
+    '''
+    Move the files installed in staging_dir (with `make install DESTDIR=...`)
+    to the install store, and hardlink them in the pg_venv's install prefix
+
+    Each file is stored under the hash of its content (and of its executable
+    bit), so that identical files are only stored once for all the pg_venvs.
+    Files of the prefix are replaced atomically, never modified in place, as
+    they are shared with other pg_venvs. If a file can't be hardlinked (e.g.
+    the store is on another filesystem), it is copied instead.
+
+    Returns the manifest of the installed files: a dict whose key 'files'
+    maps the path of the files (relative to the prefix) to their hash, and
+    whose key 'symlinks' maps the path of the symlinks to their target.
+    '''
+    pg_venv_dir = get_pg_venv_dir(pg_venv)
+    store_dir = get_install_store_dir()
+    # the install prefix is the pg_venv dir, it is reproduced in staging_dir
+    staged_prefix = os.path.join(staging_dir, pg_venv_dir.lstrip(os.sep))
+
+    previous_manifest = {'files': {}, 'symlinks': {}}
+    with contextlib.suppress(FileNotFoundError), open(get_install_manifest_file(pg_venv)) as f:
+        previous_manifest = json.load(f)
+
+    # hashing is the slow part, it's done before locking the store
+    manifest = {'files': {}, 'symlinks': {}}
+    staged_files = {}
+    for dirpath, dirnames, filenames in os.walk(staged_prefix):
+        relative_dir = os.path.relpath(dirpath, staged_prefix)
+        os.makedirs(os.path.join(pg_venv_dir, relative_dir), exist_ok=True)
+
+        # os.walk lists symlinks to directories as directories
+        for name in filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]:
+            staged_file = os.path.join(dirpath, name)
+            relative_path = os.path.normpath(os.path.join(relative_dir, name))
+            if os.path.islink(staged_file):
+                manifest['symlinks'][relative_path] = os.readlink(staged_file)
+            else:
+                manifest['files'][relative_path] = hash_file(staged_file)
+                staged_files[relative_path] = staged_file
+
+    # gc_install_store must not remove the files between the moment they are
+    # published in the store and the moment they are linked in the prefix,
+    # or listed in the manifest when they are copied
+    with lock_install_store():
+        for relative_path, link_target in manifest['symlinks'].items():
+            target = os.path.join(pg_venv_dir, relative_path)
+            os.symlink(link_target, target + '.pg_venv_tmp')
+            os.replace(target + '.pg_venv_tmp', target)
+
+        for relative_path, file_hash in manifest['files'].items():
+            target = os.path.join(pg_venv_dir, relative_path)
+            store_file = os.path.join(store_dir, file_hash[:2], file_hash)
+            if not os.path.exists(store_file):
+                os.makedirs(os.path.dirname(store_file), exist_ok=True)
+                os.replace(staged_files[relative_path], store_file)
+
+            if os.path.isfile(target) and os.path.samefile(target, store_file):
+                continue
+
+            try:
+                os.link(store_file, target + '.pg_venv_tmp')
+            except OSError:
+                shutil.copy2(store_file, target + '.pg_venv_tmp')
+            os.replace(target + '.pg_venv_tmp', target)
+
+        # the files of the previous install that this one doesn't have
+        # anymore are removed, unless this install didn't install anything in
+        # their directory (e.g. the documentation, only installed by
+        # `pg build --docs`)
+        installed_dirs = {os.path.dirname(p) for p in list(manifest['files']) + list(manifest['symlinks'])}
+        for kind in ['files', 'symlinks']:
+            for relative_path, value in previous_manifest[kind].items():
+                if relative_path in manifest['files'] or relative_path in manifest['symlinks']:
+                    continue
+                if os.path.dirname(relative_path) in installed_dirs:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.unlink(os.path.join(pg_venv_dir, relative_path))
+                else:
+                    manifest[kind][relative_path] = value
+
+        with open(get_install_manifest_file(pg_venv), 'w') as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+
+    return manifest
+
+
+def install_store_enabled():
+    '''
+    Check if pg_venvs should be installed through the install store, which is
+    the case unless PG_INSTALL_STORE=0
+    '''
+    return get_bool_env_var('PG_INSTALL_STORE')
+
+
+def is_btrfs_subvolume(path):
+    '''
+    Check if a directory is the root of a btrfs subvolume
+    '''
+    # the root directory of a subvolume always has inode 256
+    try:
+        if os.stat(path).st_ino != 256:
+            return False
+    except FileNotFoundError:
         return False
 
+    cmd = ['stat', '-f', '-c', '%T', path]
+    try:
+        return subprocess.check_output(cmd, stderr=subprocess.DEVNULL).decode('utf-8').strip() == 'btrfs'
+    except subprocess.CalledProcessError:
+        return False
 
-def pg_virtualenv_exists(pg_venv):
-    return os.path.isdir(get_pg_venv_dir(pg_venv))
+
+def leave_build_queue(ticket, ticket_fd):
+    '''
+    Remove a ticket returned by enter_build_queue from the queue of the build
+    scheduler
+    '''
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(ticket)
+    os.close(ticket_fd)
+
+
+@contextlib.contextmanager
+def lock_index():
+    '''
+    Context manager preventing concurrent updates of the index (see
+    read_index)
+    '''
+    with open(get_index_file() + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+@contextlib.contextmanager
+def lock_install_store():
+    '''
+    Context manager preventing gc_install_store from removing files of the
+    install store while they are installed in a pg_venv
+    '''
+    os.makedirs(get_install_store_dir(), exist_ok=True)
+    with open(get_install_store_dir() + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+@contextlib.contextmanager
+def lock_pg_venv(pg_venv):
+    '''
+    Context manager serializing the actions that change a pg_venv, in all
+    the processes (see Action)
+    '''
+    with open(os.path.join(get_pg_venv_dir(pg_venv), '.lock'), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            log('Waiting for another action on {} to be done'.format(pg_venv))
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def open_bench_db():
+    '''
+    Open the database where the results of benchmarks are stored, creating
+    it if needed
+    '''
+    import sqlite3
+
+    db = sqlite3.connect(get_bench_db_file(), timeout=30)
+    db.row_factory = sqlite3.Row
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS bench_runs (
+            id INTEGER PRIMARY KEY,
+            time INTEGER NOT NULL,
+            pg_venv TEXT NOT NULL,
+            pg_version TEXT,
+            git_commit TEXT,
+            configure_options TEXT,
+            conf_profile TEXT,
+            workload TEXT NOT NULL,
+            scale INTEGER,
+            clients INTEGER,
+            threads INTEGER,
+            duration INTEGER,
+            transactions INTEGER,
+            tps REAL,
+            latency_avg REAL,
+            latency_p50 REAL,
+            latency_p90 REAL,
+            latency_p99 REAL,
+            hostname TEXT,
+            kernel TEXT,
+            cpus INTEGER,
+            memory INTEGER
+        )
+    ''')
+
+    return db
+
+
+@contextlib.contextmanager
+def open_jobserver(ticket):
+    '''
+    Open the job pool shared by the builds of all the pg_venvs for the build
+    owning ticket, and yield the environment variables and the file
+    descriptors to give to the build (see build_slot_async)
+
+    The pool holds PG_BUILD_JOBS - 1 tokens (the number of CPUs by default),
+    since each make also runs one job without a token. When no other build
+    is running, nobody holds tokens, so the pool is refilled: a pipe loses
+    its content once nobody has it open, and a build that was killed may not
+    have given its tokens back.
+    '''
+    jobserver_dir = get_jobserver_dir()
+    fifo = os.path.join(jobserver_dir, 'fifo')
+    pool_size = int(os.environ.get('PG_BUILD_JOBS', os.cpu_count()))
+
+    with open(os.path.join(jobserver_dir, 'lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        if not os.path.exists(fifo):
+            os.mkfifo(fifo)
+
+        # opening the fifo for reading and writing never blocks
+        jobserver_fd = os.open(fifo, os.O_RDWR)
+
+        # running builds are marked in their ticket
+        queue_dir = os.path.join(jobserver_dir, 'queue')
+        running_builds = 0
+        for other_ticket in get_build_queue():
+            with contextlib.suppress(FileNotFoundError), open(os.path.join(queue_dir, other_ticket)) as f:
+                running_builds += f.read() == 'running'
+        with open(ticket, 'w') as f:
+            f.write('running')
+
+        if running_builds == 0:
+            os.set_blocking(jobserver_fd, False)
+            with contextlib.suppress(BlockingIOError):
+                while os.read(jobserver_fd, 1024):
+                    pass
+            os.set_blocking(jobserver_fd, True)
+            os.write(jobserver_fd, b'+' * max(0, pool_size - 1))
+
+    try:
+        make_flags = '{} -j --jobserver-{}={},{}'.format(
+            os.environ.get('MAKEFLAGS', ''),
+            'auth' if get_make_version() >= (4, 2) else 'fds',
+            jobserver_fd,
+            jobserver_fd,
+        )
+        yield {'MAKEFLAGS': make_flags}, (jobserver_fd,)
+    finally:
+        # leave the queue before closing the pool, so that a build starting
+        # in between knows it can refill the pool
+        os.unlink(ticket)
+        os.close(jobserver_fd)
+
+
+def parse_pg_version(version):
+    '''
+    Convert a version string (e.g. '9.6.1', '12.1' or '16devel') into a tuple
+    of ints
+    '''
+    numbers = []
+    for part in version.split('.'):
+        match = re.match(r'\d+', part)
+        if match is None:
+            break
+        numbers.append(int(match.group()))
+
+        # stop at suffixes such as 'devel', 'beta1' or 'rc1'
+        if match.end() != len(part):
+            break
+
+    return tuple(numbers)
+
+
+def parse_pgbench_output(output):
+    '''
+    Extract the number of transactions, the TPS and the average latency (in
+    ms) from the output of pgbench, as a dict
+    '''
+    result = {'transactions': None, 'tps': None, 'latency_avg': None}
+
+    match = re.search(r'^number of transactions actually processed: (\d+)', output, re.MULTILINE)
+    if match:
+        result['transactions'] = int(match.group(1))
+
+    match = re.search(r'^latency average = ([\d.]+) ms', output, re.MULTILINE)
+    if match:
+        result['latency_avg'] = float(match.group(1))
+
+    # without the time spent connecting when pgbench reports it both ways
+    # (before pg14)
+    tps = re.findall(r'^tps = ([\d.]+)(?: \((\w+))?', output, re.MULTILINE)
+    for value, qualifier in tps:
+        if result['tps'] is None or qualifier in ['excluding', 'without']:
+            result['tps'] = float(value)
+
+    return result
+
+
+def percentile(sorted_values, p):
+    '''
+    Compute the p-th percentile of a sorted list, by linear interpolation
+    '''
+    if not sorted_values:
+        return None
+
+    rank = (len(sorted_values) - 1) * p / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(sorted_values) - 1)
+
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+
+
+def pg_accepts_connections(socket_dir, port, listen_addr=None, timeout=1):
+    '''
+    Check if a postgres server accepts connections, the way pg_isready does:
+    send a startup packet and look at the first message of the answer.
+    The unix socket is tried first, then TCP if listen_addr is set.
+    '''
+    import socket
+
+    user = os.environ.get('PGUSER') or os.environ.get('USER') or 'postgres'
+    params = 'user\0{}\0database\0postgres\0\0'.format(user).encode('utf-8')
+    # protocol version 3.0
+    startup_packet = struct.pack('!ii', 8 + len(params), 196608) + params
+
+    addresses = []
+    if socket_dir:
+        addresses.append((socket.AF_UNIX, os.path.join(socket_dir, '.s.PGSQL.{}'.format(port))))
+    if listen_addr:
+        host = 'localhost' if listen_addr in ['*', '0.0.0.0', '::'] else listen_addr
+        addresses.append((socket.AF_INET6 if ':' in host else socket.AF_INET, (host, port)))
+
+    for family, address in addresses:
+        try:
+            with socket.socket(family, socket.SOCK_STREAM) as sock:
+                sock.settimeout(timeout)
+                sock.connect(address)
+                sock.sendall(startup_packet)
+                answer = sock.recv(1024)
+        except OSError:
+            continue
+
+        if not answer:
+            continue
+
+        # an authentication request means the server is up
+        if answer[:1] == b'R':
+            return True
+
+        # an error is fine too (e.g. unknown role), unless the server says it
+        # is starting up (SQLSTATE 57P03)
+        if answer[:1] == b'E':
+            return b'C57P03\0' not in answer
+
+    return False
+
+
+def pg_is_running(pg_venv=None):
+    '''
+    Check if postgres is running
+
+    Like `pg_ctl status`, but without starting a process: postgres is running
+    if postmaster.pid exists and the process it contains is alive.
+    '''
+    if not pg_venv:
+        pg_venv = get_env_var('PG_VENV')
+
+    postmaster_pid = read_postmaster_pid(pg_venv)
+
+    return postmaster_pid is not None and pid_is_alive(postmaster_pid['pid'])
+
+
+def pg_virtualenv_exists(pg_venv):
+    return os.path.isdir(get_pg_venv_dir(pg_venv))
+
+
+def pid_is_alive(pid):
+    '''
+    Check if a process exists
+    '''
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # the process exists but belongs to someone else
+        return True
+
+    return True
+
+
+def read_build_phase_log(pg_venv):
+    '''
+    Return the phases of the last build of a pg_venv that used the build
+    makefile, as a list of dicts with keys phase, start (relative to the start
+    of the first phase) and duration, in seconds
+    '''
+    try:
+        with open(get_build_phase_log(pg_venv)) as f:
+            lines = [l.split() for l in f if len(l.split()) == 3]
+    except FileNotFoundError:
+        return []
+
+    if not lines:
+        return []
+
+    build_start = min(float(l[1]) for l in lines)
+    phases = [
+        {
+            'phase': phase,
+            'start': round(float(start) - build_start, 1),
+            'duration': round(float(end) - float(start), 1),
+        }
+        for phase, start, end in lines
+    ]
+
+    return sorted(phases, key=lambda p: p['start'])
+
+
+def read_ccache_stats_log(pg_venv, offset=0):
+    '''
+    Count cache hits and misses in a pg_venv's ccache stats log, starting at
+    byte offset
+
+    Each compilation is logged as a '# <source file>' line followed by its
+    counters. Returns a dict with keys hits, misses and uncacheable.
+    '''
+    stats = {'hits': 0, 'misses': 0, 'uncacheable': 0}
+
+    try:
+        with open(get_ccache_stats_log(pg_venv)) as f:
+            f.seek(offset)
+            blocks = f.read().split('# ')
+    except FileNotFoundError:
+        return stats
+
+    for block in blocks:
+        counters = block.split('\n')[1:]
+        if not any(counters):
+            continue
+
+        if any(c.endswith('cache_hit') for c in counters):
+            stats['hits'] += 1
+        elif any(c.endswith('cache_miss') for c in counters):
+            stats['misses'] += 1
+        else:
+            stats['uncacheable'] += 1
+
+    return stats
+
+
+def read_conf_profile(pg_venv):
+    '''
+    Return the settings of the configuration profile applied to a pg_venv, as
+    a dict (empty if no profile was applied)
+    '''
+    settings = {}
+    try:
+        with open(os.path.join(get_pg_data(pg_venv), _CONF_PROFILE_FILE)) as f:
+            for line in f:
+                match = re.match(r"^(\w+) = '(.*)'$", line.strip())
+                if match:
+                    settings[match.group(1)] = match.group(2)
+    except FileNotFoundError:
+        pass
+
+    return settings
+
+
+def read_index():
+    '''
+    Return the index of the pg_venvs, as a dict {pg_venv: entry}, where entry
+    is a dict with keys running, port, version and pg_config_mtime (see
+    refresh_index_entry), or an empty dict if there is no index
+
+    The index is a text file with one line per pg_venv, made of its name,
+    status (running or stopped), port, version and the mtime of its
+    pg_config separated by tabs ('-' if unknown), so that the shell
+    completion can read it without starting python. It is updated by the
+    actions that change these values, and rebuilt by action list.
+    '''
+    index = {}
+    try:
+        with open(get_index_file()) as f:
+            for line in f:
+                pg_venv, status, port, version, pg_config_mtime = line.rstrip('\n').split('\t')
+                index[pg_venv] = {
+                    'running': status == 'running',
+                    'port': int(port),
+                    'version': version if version != '-' else None,
+                    'pg_config_mtime': float(pg_config_mtime) if pg_config_mtime != '-' else None,
+                }
+    except FileNotFoundError:
+        pass
+    except ValueError:
+        # corrupted index, it will be rebuilt
+        return {}
+
+    return index
+
+
+def read_pgbench_latencies(log_dir):
+    '''
+    Read the latencies of the transactions logged by pgbench with --log in
+    log_dir, in ms, and remove the logs
+
+    The logs can hold millions of transactions, so rather than keeping the
+    latencies, they are rounded to 3 significant digits and counted: the
+    result is a histogram, mapping each latency to its number of
+    transactions (see histogram_percentile).
+    '''
+    histogram = collections.Counter()
+    for log_file in os.listdir(log_dir):
+        if not log_file.startswith('pgbench_log.'):
+            continue
+        with open(os.path.join(log_dir, log_file)) as f:
+            for line in f:
+                # client_id transaction_no latency_us script_no epoch epoch_us
+                fields = line.split()
+                # failed or skipped transactions have no latency
+                if len(fields) > 2 and fields[2].isdigit():
+                    latency = int(fields[2])
+                    histogram[round(latency, 3 - len(fields[2].lstrip('0')))] += 1
+        os.unlink(os.path.join(log_dir, log_file))
+
+    return {latency / 1000: count for latency, count in histogram.items()}
+
+
+def read_postmaster_pid(pg_venv):
+    '''
+    Parse postmaster.pid in the data directory of a pg_venv
+
+    Returns a dict with keys pid, data_dir, start_time, port, socket_dir,
+    listen_addr and status, or None if there is no (complete) postmaster.pid.
+    status is only written by pg10 and later, it is None for older versions.
+    '''
+    try:
+        with open(os.path.join(get_pg_data(pg_venv), 'postmaster.pid')) as f:
+            lines = f.read().split('\n')
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+    # the file is written in several steps when the server starts up
+    if len(lines) < 4 or not lines[0].strip().isdigit() or not lines[3].strip().isdigit():
+        return None
+
+    def line(number):
+        return lines[number].strip() if len(lines) > number and lines[number].strip() else None
+
+    return {
+        'pid': int(lines[0]),
+        'data_dir': line(1),
+        'start_time': line(2),
+        'port': int(lines[3]),
+        'socket_dir': line(4),
+        'listen_addr': line(5),
+        'status': line(7),
+    }
+
+
+def read_timings(pg_venv):
+    '''
+    Return the timings recorded for a pg_venv (see timed), oldest first
+    '''
+    timings = []
+    try:
+        with open(get_timings_file(pg_venv)) as f:
+            for line in f:
+                # skip lines being written, or truncated by a crash
+                with contextlib.suppress(ValueError):
+                    timings.append(json.loads(line))
+    except FileNotFoundError:
+        pass
+
+    return timings
+
+
+def record_bench_run(run):
+    '''
+    Store the result of a benchmark run (a dict with the columns of
+    bench_runs) in the results database, returns its id
+    '''
+    columns = sorted(run)
+    query = 'INSERT INTO bench_runs ({}) VALUES ({})'.format(', '.join(columns), ', '.join('?' for _ in columns))
+
+    with contextlib.closing(open_bench_db()) as db:
+        with db:
+            return db.execute(query, [run[c] for c in columns]).lastrowid
+
+
+def record_ccache_build(pg_venv, stats, duration):
+    '''
+    Save the ccache statistics of a build in the pg_venv's metadata, and
+    return the updated list of builds
+
+    Only the last _CCACHE_BUILDS_KEPT builds are kept.
+    '''
+    builds = get_pg_metadata(pg_venv).get('ccache_builds', [])
+    builds.append(dict(stats, date=int(time.time()), duration=round(duration, 1)))
+    builds = builds[-_CCACHE_BUILDS_KEPT:]
+    update_pg_metadata(pg_venv, ccache_builds=builds)
+
+    return builds
+
+
+def record_command_timing(cmd, cmd_description, start_time, wall, usage, return_code):
+    '''
+    Record the timing of a command run by execute_cmd, if it runs in a timed
+    phase (see timed)
+    '''
+    context = _timing_context.get()
+    if context is None:
+        return
+
+    # the resource usage isn't known for commands run by execute_cmd_async
+    max_rss = usage.ru_maxrss * 1024 if usage is not None else None
+    if max_rss is not None:
+        context['max_rss'] = max(context['max_rss'], max_rss)
+    record_timing(context['pg_venv'], {
+        'run': context['run'],
+        'action': context['action'],
+        'phase': cmd_description or cmd,
+        'kind': 'command',
+        'command': cmd,
+        'time': int(start_time),
+        'wall': round(wall, 3),
+        'user': round(usage.ru_utime, 3) if usage is not None else None,
+        'sys': round(usage.ru_stime, 3) if usage is not None else None,
+        'max_rss': max_rss,
+        'return_code': return_code,
+    })
+
+
+def record_timing(pg_venv, timing):
+    '''
+    Append a timing to the history of a pg_venv, see timed
+    '''
+    if not pg_venv or not os.path.isdir(get_pg_venv_dir(pg_venv)):
+        return
+
+    # lines are written with a single write, so that concurrent writers
+    # don't interleave them
+    with open(get_timings_file(pg_venv), 'a') as f:
+        f.write(json.dumps(timing, sort_keys=True) + '\n')
+
+
+def recreate_tmpfs_dirs(pg_venv, components=None):
+    '''
+    Create again the directories of a pg_venv that were on tmpfs and have
+    been lost (e.g. after a reboot), empty
+
+    Returns the list of the components that were lost.
+    '''
+    lost_components = get_lost_tmpfs_components(pg_venv, components)
+    tmpfs_components = get_tmpfs_components(pg_venv)
+    for component in lost_components:
+        os.makedirs(os.readlink(tmpfs_components[component]), mode=0o700)
+
+    return lost_components
+
+
+def reflink_supported(directory):
+    '''
+    Check if files can be copied with reflinks in a directory
+    '''
+    probe = os.path.join(directory, '.reflink_probe.{}'.format(os.getpid()))
+    try:
+        with open(probe, 'w') as f:
+            f.write('probe')
+        cmd = ['cp', '--reflink=always', probe, probe + '.copy']
+        return subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+    finally:
+        for path in [probe, probe + '.copy']:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+
+
+def refresh_index_entry(pg_venv, index_entry):
+    '''
+    Update the entry of a pg_venv in the index (see read_index): whether its
+    server is running, its port, and its version, which is only read again
+    if pg_config changed
+    '''
+    pg_config = os.path.join(get_pg_bin(pg_venv), 'pg_config')
+    pg_config_mtime = os.stat(pg_config).st_mtime if os.path.isfile(pg_config) else None
+    if 'version' not in index_entry or index_entry.get('pg_config_mtime') != pg_config_mtime:
+        try:
+            index_entry['version'] = get_pg_version(pg_venv) if pg_config_mtime else None
+        except subprocess.CalledProcessError:
+            index_entry['version'] = None
+        index_entry['pg_config_mtime'] = pg_config_mtime
+
+    index_entry['port'] = get_pg_port(pg_venv)
+    index_entry['running'] = pg_is_running(pg_venv)
+
+    return index_entry
+
+
+def remove_data_dir(path):
+    '''
+    Remove a data directory or a snapshot, which may be btrfs subvolumes
+    '''
+    if is_btrfs_subvolume(path) and shutil.which('btrfs'):
+        cmd = ['btrfs', 'subvolume', 'delete', path]
+        if subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0:
+            return
+
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def rotate_log(log_file, kept=None):
+    '''
+    Rename log_file to log_file.1, log_file.1 to log_file.2... keeping kept
+    old logs (PG_LOG_ROTATE, 3 by default)
+    '''
+    if kept is None:
+        kept = int(os.environ.get('PG_LOG_ROTATE', 3))
+
+    for i in range(kept - 1, 0, -1):
+        if os.path.exists('{}.{}'.format(log_file, i)):
+            os.replace('{}.{}'.format(log_file, i), '{}.{}'.format(log_file, i + 1))
+    if kept > 0 and os.path.exists(log_file):
+        os.replace(log_file, '{}.1'.format(log_file))
+
+
+def save_build_to_cache(pg_venv, commit):
+    '''
+    Keep the files installed in a pg_venv, built from a commit, so that they
+    can be installed again without building (see install_from_build_cache)
+
+    The cache is made of hardlinks to the install store, so it only works
+    with the install store, whose files are never modified in place. Returns
+    False if the build can't be cached.
+    '''
+    if not install_store_enabled() or not os.path.isfile(get_install_manifest_file(pg_venv)):
+        return False
+
+    pg_venv_dir = get_pg_venv_dir(pg_venv)
+    build_cache_dir = get_build_cache_dir(pg_venv, commit)
+    if os.path.isdir(build_cache_dir):
+        return True
+
+    # the cache is built aside, so that it only becomes visible once it's
+    # complete
+    tmp_build_cache_dir = '{}.{}.tmp'.format(build_cache_dir, os.getpid())
+    os.makedirs(tmp_build_cache_dir)
+    for install_dir in _INSTALL_DIRS:
+        if os.path.isdir(os.path.join(pg_venv_dir, install_dir)):
+            cmd = ['cp', '-al', os.path.join(pg_venv_dir, install_dir), os.path.join(tmp_build_cache_dir, install_dir)]
+            subprocess.check_call(cmd)
+    shutil.copyfile(get_install_manifest_file(pg_venv), os.path.join(tmp_build_cache_dir, 'install_manifest.json'))
+    os.rename(tmp_build_cache_dir, build_cache_dir)
+
+    return True
+
+
+def scan_component_disk_usage(paths, deadline=None):
+    '''
+    Compute the disk space used by the paths of a component of a pg_venv
+    (see get_disk_usage_components), as a dict with keys bytes,
+    shared_bytes, time and complete (see scan_disk_usage)
+    '''
+    size, shared_size, complete = 0, 0, True
+    for path in paths:
+        path_size, path_shared_size, path_complete = scan_disk_usage(os.path.realpath(path), deadline)
+        size += path_size
+        shared_size += path_shared_size
+        complete = complete and path_complete
+
+    return {'bytes': size, 'shared_bytes': shared_size, 'time': int(time.time()), 'complete': complete}
+
+
+def scan_disk_usage(path, deadline=None, seen_inodes=None):
+    '''
+    Compute the disk space used by a file or directory, by walking through it
+
+    Files with several hardlinks are only counted once per seen_inodes set.
+    If deadline (a time.monotonic() value) is reached, the scan stops.
+    Returns a tuple (bytes, shared bytes, complete), where shared bytes are
+    used by files that have other hardlinks (e.g. from the install store).
+    '''
+    if seen_inodes is None:
+        seen_inodes = set()
+
+    size = 0
+    shared_size = 0
+    pending = [path]
+    while pending:
+        if deadline is not None and time.monotonic() > deadline:
+            return size, shared_size, False
+
+        current = pending.pop()
+        try:
+            entries = list(os.scandir(current)) if os.path.isdir(current) and not os.path.islink(current) else [current]
+        except (FileNotFoundError, PermissionError):
+            continue
+
+        for entry in entries:
+            try:
+                if isinstance(entry, str):
+                    stat = os.lstat(entry)
+                elif entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                    stat = entry.stat(follow_symlinks=False)
+                else:
+                    stat = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+
+            if (stat.st_dev, stat.st_ino) in seen_inodes:
+                continue
+            if stat.st_nlink > 1:
+                seen_inodes.add((stat.st_dev, stat.st_ino))
+                shared_size += stat.st_blocks * 512
+            size += stat.st_blocks * 512
+
+    return size, shared_size, True
+
+
+def select_pg_venvs(all_pg_venvs=False, running=False, pattern=None):
+    '''
+    Return the names of the pg_venvs an action runs on when it is run on
+    several of them: all of them if all_pg_venvs is True, otherwise the ones
+    whose name matches the glob pattern, if set, and whose server is running,
+    if running is True
+    '''
+    pg_venvs = sorted(available_pg_venvs())
+    if all_pg_venvs:
+        return pg_venvs
+
+    if pattern is not None:
+        pg_venvs = fnmatch.filter(pg_venvs, pattern)
+    if running:
+        pg_venvs = [pg_venv for pg_venv in pg_venvs if pg_is_running(pg_venv)]
+
+    return pg_venvs
+
+
+def set_tmpfs(pg_venv, component, enabled):
+    '''
+    Move a directory of a pg_venv (see get_tmpfs_components) to tmpfs, and
+    replace it by a symlink, or move it back if enabled is False
+
+    The components on tmpfs are recorded in the pg_venv's metadata.
+    '''
+    path = get_tmpfs_components(pg_venv)[component]
+    tmpfs_path = os.path.join(get_tmpfs_dir(pg_venv), component)
+
+    if enabled and not os.path.islink(path):
+        os.makedirs(get_tmpfs_dir(pg_venv), mode=0o700, exist_ok=True)
+        shutil.rmtree(tmpfs_path, ignore_errors=True)
+        if os.path.isdir(path):
+            shutil.move(path, tmpfs_path)
+        else:
+            os.makedirs(tmpfs_path, mode=0o700)
+        os.symlink(tmpfs_path, path)
+    elif not enabled and os.path.islink(path):
+        os.unlink(path)
+        if os.path.isdir(tmpfs_path):
+            shutil.move(tmpfs_path, path)
+        else:
+            os.makedirs(path, mode=0o700)
+
+    tmpfs_components = set(get_pg_metadata(pg_venv).get('tmpfs', []))
+    if enabled:
+        tmpfs_components.add(component)
+    else:
+        tmpfs_components.discard(component)
+    update_pg_metadata(pg_venv, tmpfs=sorted(tmpfs_components))
+
+
+def stream_output(output, log_file=None, progress_description=None):
+    '''
+    Read the output of a process line by line, write it to log_file (after
+    rotating the previous logs, see rotate_log), and return its last lines
+    (PG_LOG_TAIL_LINES, 50 by default)
+
+    If progress_description is set and stdout is a terminal, the progress of
+    compilations is displayed after it, unless PG_PROGRESS=0: the number of
+    files compiled with make, the step of the build with ninja.
+    '''
+    output_log = OutputLog(log_file, progress_description)
+    try:
+        for line in output:
+            output_log.write(line)
+    finally:
+        output_log.close()
+
+    return list(output_log.tail)
+
+
+@contextlib.contextmanager
+def timed(phase, pg_venv=None, kind='phase'):
+    '''
+    Record how long a phase of an action takes in the timings of a pg_venv
+    (timings.jsonl): wall time, user and system CPU time of the processes it
+    runs, and the peak RSS of the largest one. The commands run by
+    execute_cmd during the phase are recorded too.
+
+    Phases can be nested, pg_venv defaults to the one of the enclosing
+    phase. Yields a dict, whose items (e.g. return_code) are added to the
+    record, and which contains the record once the phase is over.
+    '''
+    parent_context = _timing_context.get()
+    context = {
+        'pg_venv': pg_venv or (parent_context['pg_venv'] if parent_context else None),
+        'action': parent_context['action'] if parent_context else phase,
+        'run': parent_context['run'] if parent_context else '{}-{}'.format(time.time_ns(), os.getpid()),
+        'max_rss': 0,
+    }
+    token = _timing_context.set(context)
+
+    timing = {}
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    start_time, start = time.time(), time.monotonic()
+    try:
+        yield timing
+    finally:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        _timing_context.reset(token)
+        if parent_context is not None:
+            parent_context['max_rss'] = max(parent_context['max_rss'], context['max_rss'])
+
+        timing.update(dict({
+            'run': context['run'],
+            'action': context['action'],
+            'phase': phase,
+            'kind': kind,
+            'time': int(start_time),
+            'wall': round(time.monotonic() - start, 3),
+            'user': round(usage.ru_utime - usage_before.ru_utime, 3),
+            'sys': round(usage.ru_stime - usage_before.ru_stime, 3),
+            'max_rss': context['max_rss'],
+        }, **timing))
+        record_timing(context['pg_venv'], timing)
+
+
+def update_disk_usage(pg_venv, components=None, budget=None):
+    '''
+    Scan some components of a pg_venv (all of them by default) and record
+    their disk usage in the pg_venv's metadata, see get_disk_usage_breakdown
+
+    If the scan takes more than budget seconds, it is stopped. Incomplete
+    scans only replace components that were never scanned.
+    Returns the updated breakdown.
+    '''
+    all_components = get_disk_usage_components(pg_venv)
+    if components is None:
+        components = list(all_components)
+    deadline = time.monotonic() + budget if budget is not None else None
+
+    breakdown = get_pg_metadata(pg_venv).get('disk_usage', {})
+    scanned = {}
+
+    # the files of the build are the ones git ignores in the source dir, so
+    # they can be found without walking through the whole source dir
+    if 'src' in components or 'build' in components:
+        cmd = 'cd {} && git ls-files -z --others --ignored --exclude-standard'.format(get_pg_src(pg_venv))
+        try:
+            build_files = subprocess.check_output(cmd, shell=True, stderr=subprocess.DEVNULL).decode('utf-8').split('\0')
+        except subprocess.CalledProcessError:
+            build_files = []
+
+        build_size = 0
+        for build_file in filter(None, build_files):
+            with contextlib.suppress(FileNotFoundError):
+                build_size += os.lstat(os.path.join(get_pg_src(pg_venv), build_file)).st_blocks * 512
+        scanned['build'] = {'bytes': build_size, 'shared_bytes': 0, 'time': int(time.time()), 'complete': True}
+
+    for component in components:
+        if component in scanned:
+            continue
+
+        scanned[component] = scan_component_disk_usage(all_components[component], deadline)
+
+        # src is what remains of the source dir once the build is removed
+        if component == 'src':
+            scanned['src']['bytes'] = max(0, scanned['src']['bytes'] - scanned['build']['bytes'])
+
+    for component, usage in scanned.items():
+        if usage['complete'] or component not in breakdown:
+            breakdown[component] = usage
+
+    if os.path.isdir(get_pg_venv_dir(pg_venv)):
+        update_pg_metadata(pg_venv, disk_usage=breakdown)
+
+    return breakdown
+
+
+def update_index(pg_venvs=()):
+    '''
+    Refresh the entries of pg_venvs in the index (see read_index), add the
+    missing pg_venvs and remove the ones that don't exist anymore
+    '''
+    with lock_index():
+        existing_pg_venvs = available_pg_venvs()
+        index = {pg_venv: info for pg_venv, info in read_index().items() if pg_venv in existing_pg_venvs}
+        for pg_venv in existing_pg_venvs:
+            if pg_venv in pg_venvs or pg_venv not in index:
+                refresh_index_entry(pg_venv, index.setdefault(pg_venv, {}))
+
+        write_index(index)
+
+    return index
+
+
+def update_pg_metadata(pg_venv, **metadata):
+    '''
+    Add or replace keys in the metadata of a pg_venv
+
+    The updates of all the processes (and threads) are serialized, so that
+    none of them loses the keys written by another one.
+    '''
+    metadata_file = get_pg_metadata_file(pg_venv)
+    os.makedirs(os.path.dirname(metadata_file), exist_ok=True)
+
+    with open(metadata_file + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        pg_venv_metadata = get_pg_metadata(pg_venv)
+        pg_venv_metadata.update(metadata)
+
+        # write to a temporary file first so that the metadata can't get
+        # corrupted
+        tmp_file = '{}.{}.tmp'.format(metadata_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(pg_venv_metadata, f, indent=4, sort_keys=True)
+        os.replace(tmp_file, metadata_file)
+
+    return pg_venv_metadata
+
+
+def wait_for_pg_ready(pg_venv, timeout=None, interval=0.05, max_interval=1, backoff=2):
+    '''
+    Wait until postgres accepts connections, and return True if it does
+    before timeout (in seconds), False otherwise
+
+    The server is detected using postmaster.pid (see check_pg_ready).
+    The delay between two checks starts at interval, and is multiplied by
+    backoff after each check, up to max_interval.
+    If timeout is not set, PG_READY_TIMEOUT is used (60s by default).
+    '''
+    if timeout is None:
+        timeout = float(os.environ.get('PG_READY_TIMEOUT', 60))
+
+    deadline = time.monotonic() + timeout
+    while True:
+        ready = check_pg_ready(pg_venv)
+        if ready is not None:
+            return ready
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+
+        time.sleep(min(interval, remaining))
+        interval = min(interval * backoff, max_interval)
+
+
+async def wait_for_pg_ready_async(pg_venv, timeout=None, interval=0.05, max_interval=1, backoff=2):
+    '''
+    Same as wait_for_pg_ready, without blocking the event loop
+    '''
+    import asyncio
+
+    if timeout is None:
+        timeout = float(os.environ.get('PG_READY_TIMEOUT', 60))
+
+    deadline = time.monotonic() + timeout
+    while True:
+        ready = check_pg_ready(pg_venv)
+        if ready is not None:
+            return ready
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+
+        await asyncio.sleep(min(interval, remaining))
+        interval = min(interval * backoff, max_interval)
+
+
+def write_activation_script(pg_venv):
+    '''
+    Generate the activation script of a pg_venv (see get_activation_script),
+    which does the same thing as the output of `pg workon`, without starting
+    python. The paths of the previously active pg_venv are removed from PATH
+    and LD_LIBRARY_PATH in shell, so the script does not depend on the
+    environment it is generated in.
+    '''
+    pg_venv_home = get_env_var('PG_VIRTUALENV_HOME')
+    pg_port = get_pg_port(pg_venv)
+
+    script = '# Generated by pg_venv, sourced by `pg workon {}`\n'.format(pg_venv)
+    script += '_pg_venv_path=":$PATH:"\n'
+    script += '_pg_venv_ld_library_path=":$LD_LIBRARY_PATH:"\n'
+    script += 'if [ -n "$PG_VENV" ]; then\n'
+    # remove previous version from PATH and LD_LIBRARY_PATH
+    for var, subdir in [('_pg_venv_path', 'bin'), ('_pg_venv_ld_library_path', 'lib')]:
+        previous_path = '{}/$PG_VENV/{}'.format(pg_venv_home, subdir)
+        script += '    while [[ ${var} == *":{path}:"* ]]; do {var}=${{{var}//":{path}:"/:}}; done\n'.format(var=var, path=previous_path)
+    script += 'fi\n'
+    script += '_pg_venv_path=${_pg_venv_path#:}\n'
+    script += '_pg_venv_ld_library_path=${_pg_venv_ld_library_path#:}\n'
+    script += 'export PATH={}:${{_pg_venv_path%:}}\n'.format(get_pg_bin(pg_venv))
+    script += 'export LD_LIBRARY_PATH={}:${{_pg_venv_ld_library_path%:}}\n'.format(get_pg_lib(pg_venv))
+    script += 'unset _pg_venv_path _pg_venv_ld_library_path\n'
+    script += 'export PGPORT={}\n'.format(pg_port)
+    # same as in workon
+    script += r'export PS1="[pg:' + pg_venv + ':' + str(pg_port) + r']${PS1#\[pg:*\]}"' + '\n'
+    script += 'export PG_VENV={}\n'.format(pg_venv)
+    script += 'export PGDATA={}\n'.format(get_pg_data(pg_venv))
+    script += 'export PG_SRC={}\n'.format(get_pg_src(pg_venv))
+
+    activation_script = get_activation_script(pg_venv)
+    with open(activation_script + '.tmp', 'w') as f:
+        f.write(script)
+    os.replace(activation_script + '.tmp', activation_script)
+
+
+def write_build_makefile(pg_venv):
+    '''
+    Write the makefile used to build and install a pg_venv built with
+    autoconf, and return its path
+
+    It has a target for each phase of the build (core, contrib and docs, and
+    their -install counterparts), so that they can all be run by a single
+    make, sharing its jobserver. Contrib is built once core is, since its
+    makefiles rebuild the parts of core they need (generated headers, libpq,
+    libpgport...), which would race with the build of core. It is compiled
+    while core is installed, and the documentation alongside everything.
+    Each phase appends its name, start and end time to the build phase log.
+    '''
+    pg_src = get_pg_src(pg_venv)
+    phase_log = get_build_phase_log(pg_venv)
+
+    # target: (dependencies, command)
+    phases = {
+        'core': ('', '$(MAKE) -C $(SRC) all'),
+        'contrib': ('core', '$(MAKE) -C $(SRC)/contrib all'),
+        'docs': ('', '$(MAKE) -C $(SRC)/doc all'),
+        'core-install': ('core', '$(MAKE) -C $(SRC) install'),
+        'contrib-install': ('contrib core-install', '$(MAKE) -C $(SRC)/contrib install'),
+        'docs-install': ('docs', '$(MAKE) -C $(SRC)/doc install'),
+    }
+
+    makefile = '# Generated by pg_venv, do not edit\n'
+    makefile += 'SRC = {}\n'.format(pg_src)
+    makefile += 'PHASE_LOG = {}\n\n'.format(phase_log)
+    makefile += '.PHONY: {}\n\n'.format(' '.join(phases))
+    for target, (dependencies, cmd) in phases.items():
+        makefile += '{}: {}\n'.format(target, dependencies)
+        makefile += '\t+@start=$$(date +%s.%N); {} || exit $$?; echo "$@ $$start $$(date +%s.%N)" >> $(PHASE_LOG)\n\n'.format(cmd)
+
+    build_makefile = os.path.join(get_pg_venv_dir(pg_venv), 'build.mk')
+    with open(build_makefile, 'w') as f:
+        f.write(makefile)
+
+    return build_makefile
+
+
+def write_index(index):
+    '''
+    Write the index of the pg_venvs (see read_index)
+    '''
+    index_file = get_index_file()
+    with open(index_file + '.tmp', 'w') as f:
+        for pg_venv, entry in sorted(index.items()):
+            f.write('\t'.join([
+                pg_venv,
+                'running' if entry['running'] else 'stopped',
+                str(entry['port']),
+                entry['version'] or '-',
+                str(entry['pg_config_mtime']) if entry['pg_config_mtime'] is not None else '-',
+            ]) + '\n')
+    os.replace(index_file + '.tmp', index_file)